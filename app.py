@@ -1,36 +1,359 @@
-from flask import Flask, request, render_template_string, jsonify
+import time
+
+_APP_IMPORT_STARTED = time.perf_counter()
+
+from flask import Flask, Request, Response, request, render_template_string, jsonify, stream_with_context
+from werkzeug.formparser import FormDataParser
 import os
+import re
 import json
+import hashlib
+import hmac
+import secrets
+import functools
+import importlib
+import threading
+import tracemalloc
+import contextvars
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+# Optional SDKs are imported lazily on first use (see lazy_import) so that
+# startup is not dominated by openai / google-genai / PyMuPDF import time:
+#   openai        -> lazy_import("openai")
+#   google-genai  -> lazy_import("google.genai")   (`pip install google-genai`)
+#   PyMuPDF       -> lazy_import("fitz")
+#   PyYAML        -> lazy_import("yaml")           (for agents.yaml)
+IMPORT_TIMINGS = {}
+_LAZY_MODULES = {}
+_LAZY_LOCK = threading.Lock()
+WARM_MODULES = ("openai", "google.genai", "fitz")
+
+
+def lazy_import(name: str):
+    """Import an optional module on first use. Returns None if it is not installed."""
+    try:
+        return _LAZY_MODULES[name]
+    except KeyError:
+        pass
+    with _LAZY_LOCK:
+        if name not in _LAZY_MODULES:
+            started = time.perf_counter()
+            try:
+                module = importlib.import_module(name)
+            except Exception:
+                module = None
+            IMPORT_TIMINGS[name] = {
+                "seconds": round(time.perf_counter() - started, 4),
+                "available": module is not None,
+                "thread": threading.current_thread().name,
+            }
+            _LAZY_MODULES[name] = module
+        return _LAZY_MODULES[name]
+
+
+def warm_imports(names=WARM_MODULES):
+    """Import heavy SDKs in a background thread (e.g. once the window is shown)."""
+    t = threading.Thread(target=lambda: [lazy_import(n) for n in names], name="warm-imports", daemon=True)
+    t.start()
+    return t
+
+
+def import_profile() -> dict:
+    """Import-time report: app module import plus each lazily imported SDK."""
+    return {
+        "app_import_seconds": APP_IMPORT_SECONDS,
+        "lazy_imports": dict(IMPORT_TIMINGS),
+        "pending": [n for n in WARM_MODULES if n not in IMPORT_TIMINGS],
+    }
+
+
+# Span tracing: a root span per request (or per bridge call / background job) with
+# child spans for form parsing, extraction, prompt assembly, LLM calls, continuation
+# rounds, review chunks and serialization. Finished traces are kept in memory for the
+# /traces viewer (WOW_ADMIN_TOKEN only) and exported as JSON files (WOW_TRACE_DIR) and/or OTLP/HTTP JSON
+# (WOW_OTLP_ENDPOINT, e.g. http://127.0.0.1:4318/v1/traces).
+TRACE_ENABLED = os.getenv("WOW_TRACE", "1") not in ("0", "false", "off")
+TRACE_DIR = os.getenv("WOW_TRACE_DIR", "")
+OTLP_ENDPOINT = os.getenv("WOW_OTLP_ENDPOINT", "")
+TRACE_KEEP = 200
+CURRENT_SPAN = contextvars.ContextVar("current_span", default=None)
+_OPEN_TRACES = {}  # trace_id -> finished child spans, until the root span ends
+_TRACES_LOCK = threading.Lock()
+_EXPORT_QUEUE = None
+
+
+def _recent_traces():
+    from collections import deque
+
+    global RECENT_TRACES
+    if RECENT_TRACES is None:
+        RECENT_TRACES = deque(maxlen=TRACE_KEEP)
+    return RECENT_TRACES
+
+
+RECENT_TRACES = None
+
+
+def start_span(name: str, parent=None, **attrs) -> dict:
+    """Create a span under parent (default: the current span; False: a new trace). Does not make it current."""
+    parent = CURRENT_SPAN.get() if parent is None else (parent or None)
+    with _TRACES_LOCK:
+        if parent is not None and parent["trace_id"] not in _OPEN_TRACES:
+            # Work that outlives its request (prefetch, stream pumps) starts its own trace
+            attrs["follows_trace"], parent = parent["trace_id"], None
+        trace_id = parent["trace_id"] if parent else secrets.token_hex(16)
+        _OPEN_TRACES.setdefault(trace_id, [])
+    return {
+        "trace_id": trace_id,
+        "span_id": secrets.token_hex(8),
+        "parent_id": parent["span_id"] if parent else None,
+        "name": name,
+        "start_ns": time.time_ns(),
+        "end_ns": None,
+        "thread": threading.current_thread().name,
+        "status": "ok",
+        "attrs": attrs,
+    }
+
+
+def end_span(sp: dict, error: str = None):
+    sp["end_ns"] = time.time_ns()
+    if error:
+        sp["status"] = "error"
+        sp["attrs"]["error"] = error[:300]
+    with _TRACES_LOCK:
+        spans = _OPEN_TRACES.get(sp["trace_id"])
+        if spans is None:
+            return
+        spans.append(sp)
+        if sp["parent_id"] is not None:
+            return
+        del _OPEN_TRACES[sp["trace_id"]]
+        trace = {
+            "trace_id": sp["trace_id"],
+            "name": sp["name"],
+            "start_ns": sp["start_ns"],
+            "duration_ms": round((sp["end_ns"] - sp["start_ns"]) / 1e6, 3),
+            "status": sp["status"],
+            "spans": sorted(spans, key=lambda x: x["start_ns"]),
+        }
+        _recent_traces().append(trace)
+    export_trace(trace)
+
+
+@contextmanager
+def span(name: str, parent=None, **attrs):
+    """Trace a block as a child of the current span; yields the span so attributes can be added."""
+    if not TRACE_ENABLED:
+        yield {"attrs": {}}
+        return
+    sp = start_span(name, parent, **attrs)
+    token = CURRENT_SPAN.set(sp)
+    error = None
+    try:
+        yield sp
+    except BaseException as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        CURRENT_SPAN.reset(token)
+        end_span(sp, error)
+
+
+def traced(name: str, attrs=None):
+    """Decorator form of span(); attrs(*args, **kwargs) may return span attributes."""
+    def wrap(fn):
+        @functools.wraps(fn)
+        def inner(*args, **kwargs):
+            if not TRACE_ENABLED:
+                return fn(*args, **kwargs)
+            with span(name, **(attrs(*args, **kwargs) if attrs else {})):
+                return fn(*args, **kwargs)
+
+        return inner
+
+    return wrap
+
+
+def otlp_payload(trace: dict) -> dict:
+    """OTLP/HTTP JSON encoding of a finished trace."""
+
+    def value(v):
+        if isinstance(v, bool):
+            return {"boolValue": v}
+        if isinstance(v, int):
+            return {"intValue": str(v)}
+        if isinstance(v, float):
+            return {"doubleValue": v}
+        return {"stringValue": str(v)}
+
+    spans = [
+        {
+            "traceId": sp["trace_id"],
+            "spanId": sp["span_id"],
+            **({"parentSpanId": sp["parent_id"]} if sp["parent_id"] else {}),
+            "name": sp["name"],
+            "kind": 2 if sp["parent_id"] is None else 1,
+            "startTimeUnixNano": str(sp["start_ns"]),
+            "endTimeUnixNano": str(sp["end_ns"]),
+            "attributes": [{"key": k, "value": value(v)} for k, v in sp["attrs"].items() if v is not None],
+            "status": {"code": 2 if sp["status"] == "error" else 1},
+        }
+        for sp in trace["spans"]
+    ]
+    resource = [{"key": "service.name", "value": {"stringValue": "wow-510k-assistant"}}]
+    return {"resourceSpans": [{"resource": {"attributes": resource}, "scopeSpans": [{"scope": {"name": "wow.tracing"}, "spans": spans}]}]}
 
-try:
-    import openai
-except Exception:
-    openai = None
 
-# Newer Gemini SDK: google-genai (`pip install google-genai`)
-try:
-    from google import genai
-except Exception:
-    genai = None
+def export_trace(trace: dict):
+    """Hand a finished trace to the exporter thread (file and/or OTLP); never blocks the request."""
+    global _EXPORT_QUEUE
+    if not (TRACE_DIR or OTLP_ENDPOINT):
+        return
+    if _EXPORT_QUEUE is None:
+        import queue
+
+        with _TRACES_LOCK:
+            if _EXPORT_QUEUE is None:
+                _EXPORT_QUEUE = queue.Queue(maxsize=1000)
+                threading.Thread(target=_export_loop, name="trace-export", daemon=True).start()
+    try:
+        _EXPORT_QUEUE.put_nowait(trace)
+    except Exception:
+        pass  # exporter backed up: drop rather than slow requests down
 
-try:
-    import fitz  # PyMuPDF
-except Exception:
-    fitz = None
 
-try:
-    import yaml  # For agents.yaml
-except Exception:
-    yaml = None
+def _export_loop():
+    import urllib.request
+
+    while True:
+        trace = _EXPORT_QUEUE.get()
+        if TRACE_DIR:
+            try:
+                os.makedirs(TRACE_DIR, exist_ok=True)
+                with open(os.path.join(TRACE_DIR, trace["trace_id"] + ".json"), "w", encoding="utf-8") as f:
+                    json.dump(trace, f)
+            except Exception:
+                pass
+        if OTLP_ENDPOINT:
+            try:
+                req = urllib.request.Request(
+                    OTLP_ENDPOINT,
+                    data=json.dumps(otlp_payload(trace)).encode("utf-8"),
+                    headers={"Content-Type": "application/json"},
+                )
+                urllib.request.urlopen(req, timeout=2).close()
+            except Exception:
+                pass
+
 
 app = Flask(__name__)
 
-# In-memory API keys store (do not expose values)
+# Where the ledger, archive, sessions and secret key live unless their own WOW_* path is set
+DATA_DIR = os.getenv("WOW_DATA_DIR") or os.path.dirname(os.path.abspath(__file__))
+
+# Server-wide default API keys from the environment (read-only; do not expose values)
 API_KEYS = {
     "openai": os.getenv("OPENAI_API_KEY") or "",
     "gemini": os.getenv("GEMINI_API_KEY") or os.getenv("GOOGLE_API_KEY") or "",
+    "local": os.getenv("WOW_LOCAL_LLM_KEY") or "",
 }
 
+# Keys saved from the UI are scoped to a tenant and resolved per call through a
+# context variable, so concurrent requests with different keys never touch shared
+# process state. Tenants are issued by the server: a random id signed with the app
+# secret, carried in the wow_tenant cookie (HTTP) or as tenant_token (js_api bridge,
+# X-Tenant-Token for scripts). Client-chosen ids are never trusted.
+TENANT_KEYS = {}
+TENANT_KEYS_LOCK = threading.Lock()
+CURRENT_TENANT = contextvars.ContextVar("current_tenant", default="default")
+TENANT_COOKIE = "wow_tenant"
+TENANT_COOKIE_MAX_AGE = 365 * 24 * 3600
+SECRET_KEY_FILE = os.getenv("WOW_SECRET_KEY_FILE") or os.path.join(DATA_DIR, ".secret_key")
+_SECRET_KEY_LOCK = threading.Lock()
+
+
+def load_secret_key() -> bytes:
+    """WOW_SECRET_KEY, else a random key kept in SECRET_KEY_FILE so identities survive restarts."""
+    if os.getenv("WOW_SECRET_KEY"):
+        return os.getenv("WOW_SECRET_KEY").encode("utf-8")
+    try:
+        with open(SECRET_KEY_FILE, "rb") as f:
+            key = f.read().strip()
+        if len(key) >= 32:
+            return key
+    except OSError:
+        pass
+    key = secrets.token_hex(32).encode("ascii")
+    try:
+        os.makedirs(os.path.dirname(SECRET_KEY_FILE) or ".", exist_ok=True)
+        fd = os.open(SECRET_KEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(key)
+    except OSError:
+        pass  # identities then last until restart
+    return key
+
+
+def secret_key() -> bytes:
+    """The app secret, resolved on first use (not at import, which must not write files)."""
+    if app.secret_key is None:
+        with _SECRET_KEY_LOCK:
+            if app.secret_key is None:
+                app.secret_key = load_secret_key()
+    return app.secret_key
+
+
+def _tenant_serializer():
+    from itsdangerous import URLSafeSerializer
+
+    return URLSafeSerializer(secret_key(), salt="wow-tenant")
+
+
+def issue_tenant() -> str:
+    return "t-" + secrets.token_urlsafe(12)
+
+
+def tenant_token(tenant: str) -> str:
+    return _tenant_serializer().dumps(tenant)
+
+
+def tenant_id_for(form=None, headers=None, cookies=None):
+    """The tenant proven by a server-issued token (form field, header or cookie), or None."""
+    from itsdangerous import BadSignature
+
+    token = (
+        (form or {}).get("tenant_token")
+        or (headers or {}).get("X-Tenant-Token")
+        or (cookies or {}).get(TENANT_COOKIE)
+        or ""
+    )
+    if not token:
+        return None
+    try:
+        tenant = _tenant_serializer().loads(token)
+    except BadSignature:
+        return None
+    return tenant if isinstance(tenant, str) and tenant else None
+
+
+@contextmanager
+def use_tenant(tenant: str):
+    """Run a block (e.g. a bridge call) with the given tenant's credentials."""
+    token = CURRENT_TENANT.set(tenant or "default")
+    try:
+        yield
+    finally:
+        CURRENT_TENANT.reset(token)
+
+
+def api_key(provider: str) -> str:
+    """API key for provider in the current tenant context, falling back to env defaults."""
+    with TENANT_KEYS_LOCK:
+        key = (TENANT_KEYS.get(CURRENT_TENANT.get()) or {}).get(provider)
+    return key or API_KEYS.get(provider) or ""
+
 PAINTERS = [
     "Van Gogh", "Monet", "Picasso", "Da Vinci", "Rembrandt", "Matisse", "Kandinsky",
     "Hokusai", "Yayoi Kusama", "Frida Kahlo", "Salvador Dali", "Rothko", "Pollock",
@@ -53,25 +376,75 @@ REVIEW_PROMPT_DEFAULT = (
 )
 
 NOTE_PROMPT_DEFAULT = (
-    "Organize the following note into clear markdown with sections, bullet points, and a "
-    "keyword summary. Highlight important keywords inline using HTML spans like "
-    "<span style=\"color:coral\">keyword</span> so they appear in coral color."
+    "Organize the following note into clear markdown with sections and bullet points. "
+    "Do not add HTML, keyword highlighting or a keyword summary; those are added automatically."
+)
+
+# Appended to review / agent prompts when the submission PDF is attached natively (Gemini)
+REVIEW_DOCUMENT_NOTE = (
+    "\n\nThe original submission PDF is attached; check tables, figures and details the text above leaves out."
 )
+AGENT_DOCUMENT_NOTE = "\n\nThe submission PDF is attached for reference."
+
+# JSON schema for structured review reports (provider structured-output mode)
+REVIEW_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "summary": {"type": "string"},
+        "findings": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "checklist_item": {"type": "string"},
+                    "status": {"type": "string", "enum": ["met", "partially_met", "not_met", "not_applicable"]},
+                    "detail": {"type": "string"},
+                    "page": {"type": "string"},
+                },
+                "required": ["checklist_item", "status", "detail", "page"],
+                "additionalProperties": False,
+            },
+        },
+        "actions": {"type": "array", "items": {"type": "string"}},
+        "missing_documents": {"type": "array", "items": {"type": "string"}},
+    },
+    "required": ["summary", "findings", "actions", "missing_documents"],
+    "additionalProperties": False,
+}
 
-# Agents loaded from agents.yaml
-AGENTS = []
+# Agents loaded from agents.yaml on first use (see agents()). The list is never mutated
+# in place: reloads build a new list and swap it in, so readers always see a consistent snapshot.
+AGENTS = None
+AGENTS_LOCK = threading.Lock()
 
 
-def load_agents():
-    """Load agents from agents.yaml if present."""
+def agents() -> list:
+    """The configured agents, reading agents.yaml the first time they are needed."""
+    if AGENTS is None:
+        with AGENTS_LOCK:
+            if AGENTS is None:
+                _set_agents(_read_agents())
+    return AGENTS
+
+
+def _set_agents(value: list):
     global AGENTS
-    AGENTS = []
-    if yaml is None:
-        return
+    AGENTS = value
+
+
+def load_agents():
+    """(Re)load agents from agents.yaml if present."""
+    with AGENTS_LOCK:
+        _set_agents(_read_agents())
+
+
+def _read_agents() -> list:
+    agents = []
     base_dir = os.path.dirname(os.path.abspath(__file__))
     path = os.path.join(base_dir, "agents.yaml")
-    if not os.path.exists(path):
-        return
+    yaml = lazy_import("yaml") if os.path.exists(path) else None
+    if yaml is None:
+        return agents
     try:
         with open(path, "r", encoding="utf-8") as f:
             data = yaml.safe_load(f) or []
@@ -79,12 +452,12 @@ def load_agents():
             # Allow a dict with "agents": [...]
             data = data.get("agents", [])
         if not isinstance(data, list):
-            return
+            return agents
         for idx, ag in enumerate(data):
             if not isinstance(ag, dict):
                 continue
             agent_id = str(ag.get("id", idx))
-            AGENTS.append(
+            agents.append(
                 {
                     "id": agent_id,
                     "name": ag.get("name", f"Agent {agent_id}"),
@@ -96,10 +469,10 @@ def load_agents():
             )
     except Exception:
         # Fail silently; agents will be empty
-        AGENTS = []
-
+        return []
+    return agents
 
-load_agents()
+APP_IMPORT_SECONDS = None  # set at the end of this module
 
 INDEX_HTML = """
 <!doctype html>
@@ -461,6 +834,15 @@ INDEX_HTML = """
         <textarea id="submissionText" placeholder="Paste submission here..."></textarea>
         <input type="file" id="submissionFile">
 
+        <label for="docId" class="small">Document ID (optional, enables revision tracking)</label>
+        <input id="docId" type="text" placeholder="e.g. K123456">
+
+        <label for="extractMode" class="small">PDF extraction</label>
+        <select id="extractMode">
+          <option value="plain">Plain text</option>
+          <option value="structured">Structured (headings, tables, page anchors)</option>
+        </select>
+
         <div class="row advanced-row">
           <div style="width:140px">
             <label for="subMaxTokens" class="small">Max tokens</label>
@@ -546,6 +928,19 @@ INDEX_HTML = """
             <label for="revMaxTokens" class="small">Max tokens</label>
             <input id="revMaxTokens" type="number" min="256" max="32000" value="12000">
           </div>
+          <div>
+            <label for="revFormat" class="small">Output</label>
+            <select id="revFormat">
+              <option value="markdown">Markdown</option>
+              <option value="json">Structured (JSON → markdown)</option>
+            </select>
+          </div>
+          <label class="small" style="align-self:flex-end">
+            <input id="revIncremental" type="checkbox"> Incremental (re-review changed sections only)
+          </label>
+          <label class="small" style="align-self:flex-end">
+            <input id="revPrefetch" type="checkbox"> Prefetch (start the review once both inputs are transformed)
+          </label>
         </div>
 
         <div class="row">
@@ -568,6 +963,46 @@ INDEX_HTML = """
           <textarea id="reviewResultEdit" class="result result-edit"></textarea>
           <div id="reviewResultPreview" class="result" style="display:none;"></div>
         </div>
+
+        <!-- Follow-up questions on the submission -->
+        <div>
+          <label>Ask About This Submission</label>
+          <div class="section-caption muted">
+            The submission is loaded once into a provider-side context cache; follow-up questions only send the question.
+          </div>
+          <textarea id="qaQuestion" class="prompt-textarea" placeholder="e.g. Which predicate device is cited, and on which page?"></textarea>
+          <div class="row">
+            <select id="qaModelSel"></select>
+            <button class="btn secondary" id="askQuestion">Ask</button>
+            <button class="btn secondary" id="newConversation">New Conversation</button>
+          </div>
+          <textarea id="qaLog" class="result result-edit" readonly></textarea>
+        </div>
+      </div>
+
+      <hr>
+
+      <!-- Search past results (this browser's archive) -->
+      <div>
+        <h2>Search Past Results</h2>
+        <div class="section-caption muted">
+          Every transform, review, note and answer you produce is archived; find an earlier one instead of re-running it.
+        </div>
+        <div class="row">
+          <input id="archiveQuery" type="text" placeholder="e.g. biocompatibility predicate*" style="flex:1;min-width:200px">
+          <select id="archiveKind">
+            <option value="">All results</option>
+            <option value="submission">Submissions</option>
+            <option value="checklist">Checklists</option>
+            <option value="review">Reviews</option>
+            <option value="note">Notes</option>
+            <option value="noteAgent">Agent outputs</option>
+            <option value="qa">Q&amp;A</option>
+          </select>
+          <button class="btn secondary" id="archiveSearch">Search</button>
+        </div>
+        <div id="archiveResults" class="small"></div>
+        <textarea id="archiveResultView" class="result result-edit" readonly style="display:none;"></textarea>
       </div>
 
       <hr>
@@ -656,6 +1091,9 @@ INDEX_HTML = """
                 <label for="agentMaxTokens" class="small">Max tokens</label>
                 <input id="agentMaxTokens" type="number" min="256" max="32000" value="2000">
               </div>
+              <label class="small" style="align-self:flex-end">
+                <input id="agentWithDoc" type="checkbox"> Attach submission PDF (Gemini)
+              </label>
             </div>
 
             <div class="row">
@@ -750,12 +1188,17 @@ INDEX_HTML = """
         const geminiEl = document.getElementById('geminiKey');
         const openaiKey = openaiEl ? openaiEl.value : '';
         const geminiKey = geminiEl ? geminiEl.value : '';
-        const res = await fetch('/set_api_keys', {
-          method:'POST',
-          headers:{'Content-Type':'application/json'},
-          body:JSON.stringify({openai:openaiKey, gemini:geminiKey})
-        });
-        const data = await res.json();
+        let data;
+        if (bridgeApi()){
+          data = await bridgeApi().set_api_keys({openai:openaiKey, gemini:geminiKey, tenant_token:TENANT_TOKEN});
+        } else {
+          const res = await fetch('/set_api_keys', {
+            method:'POST',
+            headers:{'Content-Type':'application/json'},
+            body:JSON.stringify({openai:openaiKey, gemini:geminiKey})
+          });
+          data = await res.json();
+        }
         setStatus(data.status || 'Keys saved', 'ok');
       } catch(e){
         setStatus('Error saving keys', 'error');
@@ -775,12 +1218,161 @@ INDEX_HTML = """
       };
     }
 
+    // Desktop bridge: when run.py exposes a js_api, call it directly instead of HTTP.
+    // Bridge calls carry the server-issued tenant token that HTTP requests send as a cookie.
+    const TENANT_TOKEN = {{ tenant_token|tojson }};
+    function bridgeApi(){
+      return (window.pywebview && window.pywebview.api && window.pywebview.api.transform_note)
+        ? window.pywebview.api : null;
+    }
+
+    function readFileBase64(file){
+      return new Promise((resolve, reject) => {
+        const fr = new FileReader();
+        fr.onload = () => resolve(String(fr.result).split(',')[1] || '');
+        fr.onerror = reject;
+        fr.readAsDataURL(file);
+      });
+    }
+
+    async function formToBridgeArgs(form){
+      const params = {tenant_token: TENANT_TOKEN};
+      let file = null;
+      for (const [k, v] of form.entries()){
+        if (v instanceof File){
+          file = {name: v.name, data: await readFileBase64(v)};
+        } else {
+          params[k] = v;
+        }
+      }
+      return [params, file];
+    }
+
     // Generic POST helper
     async function postFormData(url, form){
+      const api = bridgeApi();
+      const op = url.slice(1);
+      if (api && api[op]){
+        const [params, file] = await formToBridgeArgs(form);
+        return file ? api[op](params, file) : api[op](params);
+      }
       const res = await fetch(url,{method:'POST', body:form});
       return res.json();
     }
 
+    // Streaming POST helper for NDJSON endpoints; calls onEvent per parsed line
+    let streamSeq = 0;
+    async function postFormStream(url, form, onEvent){
+      const api = bridgeApi();
+      const op = url.slice(1);
+      if (api && api[op + '_stream']){
+        const [params] = await formToBridgeArgs(form);
+        const cb = '__wowStream' + (++streamSeq);
+        await new Promise(resolve => {
+          window[cb] = ev => {
+            onEvent(ev);
+            if (ev.type === 'done' || ev.type === 'error'){ delete window[cb]; resolve(); }
+          };
+          api[op + '_stream'](params, cb);
+        });
+        return;
+      }
+      const res = await fetch(url,{method:'POST', body:form});
+      const reader = res.body.getReader();
+      const decoder = new TextDecoder();
+      let buf = '';
+      while (true){
+        const {done, value} = await reader.read();
+        if (done) break;
+        buf += decoder.decode(value, {stream:true});
+        let nl;
+        while ((nl = buf.indexOf('\\n')) >= 0){
+          const line = buf.slice(0, nl).trim();
+          buf = buf.slice(nl + 1);
+          if (line) onEvent(JSON.parse(line));
+        }
+      }
+      if (buf.trim()) onEvent(JSON.parse(buf));
+    }
+
+    // Server-side session workspace: large texts are synced once, then only as deltas
+    let sessionId = null;
+    const synced = {};
+
+    // Session calls take the desktop bridge too; a bridge error carries the route's http_status
+    async function sessionCall(op, url, body){
+      const api = bridgeApi();
+      if (api && api[op]){
+        const data = await api[op](Object.assign({tenant_token: TENANT_TOKEN}, body));
+        return {status: data.http_status || 200, data: data};
+      }
+      const res = await fetch(url, {
+        method:'POST', headers:{'Content-Type':'application/json'}, body:JSON.stringify(body)
+      });
+      return {status: res.status, data: await res.json()};
+    }
+
+    async function ensureSession(){
+      if (!sessionId){
+        sessionId = (await sessionCall('create_session', '/session', {})).data.session_id;
+      }
+      return sessionId;
+    }
+
+    function updateSession(body){
+      return sessionCall('update_session', '/session/' + sessionId + '/update', Object.assign({session_id: sessionId}, body));
+    }
+
+    function textDelta(oldText, newText){
+      let start = 0;
+      const max = Math.min(oldText.length, newText.length);
+      while (start < max && oldText[start] === newText[start]) start++;
+      let oldEnd = oldText.length, newEnd = newText.length;
+      while (oldEnd > start && newEnd > start && oldText[oldEnd - 1] === newText[newEnd - 1]){ oldEnd--; newEnd--; }
+      return {start:start, end:oldEnd, text:newText.slice(start, newEnd), base_len:oldText.length};
+    }
+
+    async function syncField(field, value){
+      await ensureSession();
+      const old = synced[field];
+      if (old === value) return;
+      const body = (old === undefined)
+        ? {fields: {[field]: value}}
+        : {deltas: [Object.assign({field: field}, textDelta(old, value))]};
+      const res = await updateSession(body);
+      if (res.status === 404){
+        sessionId = null;
+        Object.keys(synced).forEach(k => delete synced[k]);
+        await ensureSession();
+      }
+      if (res.status !== 200){
+        await updateSession({fields: {[field]: value}});
+      }
+      synced[field] = value;
+    }
+
+    // Append a session reference instead of the full text
+    async function appendRef(form, name, field, value){
+      await syncField(field, value);
+      form.append('session_id', sessionId);
+      form.append(name + '_ref', field);
+    }
+
+    // Let the server start the review speculatively with the review panel's settings
+    function appendPrefetch(form){
+      if (!document.getElementById('revPrefetch').checked) return;
+      form.append('prefetch', '1');
+      form.append('review_model', document.getElementById('modelSel3').value);
+      form.append('review_max_tokens', document.getElementById('revMaxTokens').value || '12000');
+      form.append('review_prompt', document.getElementById('revPrompt').value || '');
+      form.append('review_format', document.getElementById('revFormat').value);
+    }
+
+    // Record a server-stored result so later edits are sent as deltas
+    function markSynced(kind, text){
+      if (sessionId && text) synced[kind + '_result'] = text;
+    }
+
     // Result editor/preview wiring
     function updatePreview(kind){
       const srcEl = document.getElementById(kind + 'ResultEdit');
@@ -880,7 +1472,7 @@ INDEX_HTML = """
     (function(){
       const ids = [
         'modelSel','modelSel2','modelSel3',
-        'testModelSel','noteModelSel','noteFollowupModelSel','agentModelSel'
+        'testModelSel','noteModelSel','noteFollowupModelSel','agentModelSel','qaModelSel'
       ];
       ids.forEach(id => {
         const select = document.getElementById(id);
@@ -956,19 +1548,30 @@ INDEX_HTML = """
         const maxTokens = document.getElementById('subMaxTokens').value || '12000';
 
         const form = new FormData();
-        form.append('pasted', text);
+        await appendRef(form, 'pasted', 'submission', text);
         form.append('model', model);
         form.append('user_prompt', prompt);
         form.append('max_tokens', maxTokens);
+        form.append('doc_id', document.getElementById('docId').value || '');
+        form.append('extract_mode', document.getElementById('extractMode').value);
+        appendPrefetch(form);
         if (file) form.append('file', file);
 
         const r = await postFormData('/transform_submission', form);
         const out = r.result || r.error || '';
         document.getElementById('submissionResultEdit').value = out;
+        if (!r.error) markSynced('submission', out);
         updatePreview('submission');
 
         if (r.error){
           setStatus('Error: ' + r.error, 'error');
+        }else if (r.revision){
+          const changed = r.revision.changed_pages || [];
+          const unseen = r.revision.outside_source || [];
+          setStatus('Done (submission transformed; ' + changed.length + ' of ' + r.revision.pages + ' parts changed'
+            + (r.revision.reused ? ', cached result reused' : '')
+            + (unseen.length ? '; ' + unseen.length + ' changed parts beyond the transform window, covered by incremental review' : '')
+            + ')', 'ok');
         }else{
           setStatus('Done (submission transformed)', 'ok');
         }
@@ -988,15 +1591,17 @@ INDEX_HTML = """
         const maxTokens = document.getElementById('chkMaxTokens').value || '12000';
 
         const form = new FormData();
-        form.append('pasted', text);
+        await appendRef(form, 'pasted', 'checklist', text);
         form.append('model', model);
         form.append('user_prompt', prompt);
         form.append('max_tokens', maxTokens);
+        appendPrefetch(form);
         if (file) form.append('file', file);
 
         const r = await postFormData('/transform_checklist', form);
         const out = r.result || r.error || '';
         document.getElementById('checklistResultEdit').value = out;
+        if (!r.error) markSynced('checklist', out);
         updatePreview('checklist');
 
         if (r.error){
@@ -1014,27 +1619,69 @@ INDEX_HTML = """
       const model = document.getElementById('modelSel3').value;
       setStatus('Running review with ' + model + ' …', 'busy');
       try{
-        const submission = document.getElementById('reviewSubmission').value
-          || document.getElementById('submissionResultEdit').value;
-        const checklist = document.getElementById('reviewChecklist').value
-          || document.getElementById('checklistResultEdit').value;
+        const reviewSub = document.getElementById('reviewSubmission').value;
+        const reviewChk = document.getElementById('reviewChecklist').value;
         const prompt = document.getElementById('revPrompt').value || '';
         const maxTokens = document.getElementById('revMaxTokens').value || '12000';
 
         const form = new FormData();
-        form.append('submission', submission);
-        form.append('checklist', checklist);
+        if (reviewSub){
+          await appendRef(form, 'submission', 'review_submission', reviewSub);
+        } else {
+          await appendRef(form, 'submission', 'submission_result', document.getElementById('submissionResultEdit').value);
+        }
+        if (reviewChk){
+          await appendRef(form, 'checklist', 'review_checklist', reviewChk);
+        } else {
+          await appendRef(form, 'checklist', 'checklist_result', document.getElementById('checklistResultEdit').value);
+        }
         form.append('model', model);
         form.append('user_prompt', prompt);
         form.append('max_tokens', maxTokens);
+        form.append('doc_id', document.getElementById('docId').value || '');
+        form.append('incremental', document.getElementById('revIncremental').checked ? '1' : '0');
+
+        if (document.getElementById('revFormat').value === 'json'){
+          form.append('output_format', 'json');
+          form.append('stream', '1');
+          const outEl = document.getElementById('reviewResultEdit');
+          const lines = [];
+          let failed = null;
+          outEl.value = '';
+          await postFormStream('/run_review', form, ev => {
+            if (ev.type === 'item'){
+              const v = ev.value;
+              lines.push(typeof v === 'string'
+                ? '- [' + ev.key + '] ' + v
+                : '- [' + (v.status || ev.key) + '] ' + (v.checklist_item || '') + ': ' + (v.detail || ''));
+              outEl.value = lines.join('\\n');
+            } else if (ev.type === 'done'){
+              outEl.value = ev.result;
+              markSynced('review', ev.result);
+            } else if (ev.type === 'error'){
+              failed = ev.error;
+            }
+          });
+          updatePreview('review');
+          if (failed){
+            setStatus('Error: ' + failed, 'error');
+          } else {
+            setStatus('Done (structured review completed)', 'ok');
+          }
+          return;
+        }
 
         const r = await postFormData('/run_review', form);
         const out = r.result || r.error || '';
         document.getElementById('reviewResultEdit').value = out;
+        if (!r.error) markSynced('review', out);
         updatePreview('review');
 
         if (r.error){
           setStatus('Error: ' + r.error, 'error');
+        }else if (r.revision){
+          setStatus('Done (review patched: ' + r.revision.changed + ' changed, '
+            + r.revision.reused + ' reused sections)', 'ok');
         }else{
           setStatus('Done (review completed)', 'ok');
         }
@@ -1053,7 +1700,7 @@ INDEX_HTML = """
         const maxTokens = document.getElementById('noteMaxTokens').value || '4000';
 
         const form = new FormData();
-        form.append('note', text);
+        await appendRef(form, 'note', 'note', text);
         form.append('model', model);
         form.append('user_prompt', prompt);
         form.append('max_tokens', maxTokens);
@@ -1061,6 +1708,7 @@ INDEX_HTML = """
         const r = await postFormData('/transform_note', form);
         const out = r.result || r.error || '';
         document.getElementById('noteResultEdit').value = out;
+        if (!r.error) markSynced('note', out);
         updatePreview('note');
 
         if (r.error){
@@ -1078,13 +1726,16 @@ INDEX_HTML = """
       const model = document.getElementById('noteFollowupModelSel').value;
       setStatus('Running custom prompt on note with ' + model + ' …', 'busy');
       try{
-        const note = document.getElementById('noteResultEdit').value
-          || document.getElementById('noteInput').value;
+        const noteResult = document.getElementById('noteResultEdit').value;
         const prompt = document.getElementById('noteFollowupPrompt').value || '';
         const maxTokens = document.getElementById('noteFollowupMaxTokens').value || '2000';
 
         const form = new FormData();
-        form.append('note', note);
+        if (noteResult){
+          await appendRef(form, 'note', 'note_result', noteResult);
+        } else {
+          await appendRef(form, 'note', 'note', document.getElementById('noteInput').value);
+        }
         form.append('model', model);
         form.append('user_prompt', prompt);
         form.append('max_tokens', maxTokens);
@@ -1093,6 +1744,7 @@ INDEX_HTML = """
         const out = r.result || r.error || '';
         // Update the main note with new content so the prompt is effectively "kept" on the note
         document.getElementById('noteResultEdit').value = out;
+        if (!r.error) markSynced('note', out);
         updatePreview('note');
 
         if (r.error){
@@ -1113,21 +1765,26 @@ INDEX_HTML = """
         const agentId = document.getElementById('agentSel').value;
         setStatus('Running agent ' + agentId + ' with ' + model + ' …', 'busy');
         try{
-          const note = document.getElementById('noteResultEdit').value
-            || document.getElementById('noteInput').value;
+          const noteResult = document.getElementById('noteResultEdit').value;
           const prompt = document.getElementById('agentPrompt').value || '';
           const maxTokens = document.getElementById('agentMaxTokens').value || '2000';
 
           const form = new FormData();
-          form.append('note', note);
+          if (noteResult){
+            await appendRef(form, 'note', 'note_result', noteResult);
+          } else {
+            await appendRef(form, 'note', 'note', document.getElementById('noteInput').value);
+          }
           form.append('model', model);
           form.append('agent_id', agentId);
           form.append('user_prompt', prompt);
           form.append('max_tokens', maxTokens);
+          if (document.getElementById('agentWithDoc').checked) form.append('with_document', '1');
 
           const r = await postFormData('/run_note_agent', form);
           const out = r.result || r.error || '';
           document.getElementById('noteAgentResultEdit').value = out;
+          if (!r.error) markSynced('noteAgent', out);
           updatePreview('noteAgent');
 
           if (r.error){
@@ -1141,6 +1798,101 @@ INDEX_HTML = """
       };
     }
 
+    // Follow-up Q&A: conversation state and the cached submission live on the server
+    let conversationId = null;
+    document.getElementById('askQuestion').onclick = async () => {
+      const question = document.getElementById('qaQuestion').value.trim();
+      if (!question) return;
+      const model = document.getElementById('qaModelSel').value;
+      setStatus('Asking ' + model + ' …', 'busy');
+      try{
+        const form = new FormData();
+        form.append('question', question);
+        form.append('model', model);
+        if (conversationId) form.append('conversation_id', conversationId);
+        // Only read by the server when it has to (re)load the conversation; synced as a delta
+        const reviewSub = document.getElementById('reviewSubmission').value;
+        if (reviewSub){
+          await appendRef(form, 'submission', 'review_submission', reviewSub);
+        } else {
+          await appendRef(form, 'submission', 'submission_result', document.getElementById('submissionResultEdit').value);
+        }
+
+        const r = await postFormData('/ask', form);
+        if (r.error){
+          setStatus('Error: ' + r.error, 'error');
+          return;
+        }
+        conversationId = r.conversation_id;
+        const log = document.getElementById('qaLog');
+        if (r.new_conversation) log.value = '';
+        log.value += (log.value ? '\\n\\n' : '') + 'Q: ' + question + '\\nA: ' + r.result;
+        log.scrollTop = log.scrollHeight;
+        document.getElementById('qaQuestion').value = '';
+        const c = r.cache || {};
+        setStatus('Answered (question ' + r.turn + '; ' + (c.cached_tokens || 0) + ' of '
+          + (c.prompt_tokens || 0) + ' input tokens cached)', 'ok');
+      }catch(e){
+        setStatus('Error while asking about the submission', 'error');
+      }
+    };
+
+    document.getElementById('newConversation').onclick = () => {
+      if (conversationId){
+        fetch('/ask/' + conversationId + '?session_id=' + encodeURIComponent(sessionId || ''), {method:'DELETE'}).catch(() => {});
+      }
+      conversationId = null;
+      document.getElementById('qaLog').value = '';
+      setStatus('New conversation: the next question reloads the submission', 'ok');
+    };
+
+    // Archive search: snippets come back with <mark> highlights around matched terms
+    function markedSnippet(text){
+      const div = document.createElement('div');
+      div.textContent = text || '';
+      return div.innerHTML.split('&lt;mark&gt;').join('<mark>').split('&lt;/mark&gt;').join('</mark>');
+    }
+
+    async function searchArchive(){
+      const params = new URLSearchParams({q: document.getElementById('archiveQuery').value.trim(), limit: '20'});
+      const kind = document.getElementById('archiveKind').value;
+      if (kind) params.set('kind', kind);
+      const box = document.getElementById('archiveResults');
+      try{
+        const r = await (await fetch('/search?' + params)).json();
+        if (r.error){
+          setStatus('Error: ' + r.error, 'error');
+          return;
+        }
+        box.innerHTML = '';
+        if (!r.results.length) box.textContent = 'No matching results.';
+        r.results.forEach(row => {
+          const item = document.createElement('div');
+          item.className = 'archive-hit';
+          item.style.cssText = 'cursor:pointer;padding:4px 0;border-bottom:1px solid #eee';
+          item.innerHTML = '<b></b> <span class="muted"></span><div>' + markedSnippet(row.snippet) + '</div>';
+          item.querySelector('b').textContent = row.title || '(untitled)';
+          item.querySelector('span').textContent = row.kind + ' · ' + row.day + (row.model ? ' · ' + row.model : '');
+          item.onclick = () => openArchived(row.id);
+          box.appendChild(item);
+        });
+      }catch(e){
+        setStatus('Error while searching past results', 'error');
+      }
+    }
+
+    async function openArchived(id){
+      const r = await (await fetch('/archive/' + id)).json();
+      const view = document.getElementById('archiveResultView');
+      view.style.display = '';
+      view.value = r.error ? 'Error: ' + r.error : r.text;
+    }
+
+    document.getElementById('archiveSearch').onclick = searchArchive;
+    document.getElementById('archiveQuery').addEventListener('keydown', e => {
+      if (e.key === 'Enter') searchArchive();
+    });
+
     // Test LLM Call
     document.getElementById('testLLM').onclick = async () => {
       const model = document.getElementById('testModelSel').value;
@@ -1150,6 +1902,7 @@ INDEX_HTML = """
         const form = new FormData();
         form.append('model', model);
         form.append('prompt', prompt);
+        form.append('session_id', await ensureSession());
         const r = await postFormData('/test_llm', form);
         if (r.status === 'ok'){
           setStatus('LLM test OK for ' + model, 'ok');
@@ -1168,306 +1921,3829 @@ INDEX_HTML = """
 """
 
 
-def extract_text_from_pdf_stream(stream):
-    """Extract text from a PDF file-like object using PyMuPDF."""
-    if fitz is None:
-        return ""
-    doc = fitz.open(stream=stream.read(), filetype="pdf")
-    pages = [p.get_text() for p in doc]
-    return "\n\n".join(pages)
+# OCR fallback for scanned pages (PyMuPDF + local Tesseract install).
+# Pages without a usable text layer are rasterized and OCR'd in a process pool.
+OCR_ENABLED = (os.getenv("WOW_OCR", "1") or "1").lower() not in ("0", "false", "off")
+OCR_MIN_CHARS = int(os.getenv("WOW_OCR_MIN_CHARS", "20"))
+OCR_DPI = int(os.getenv("WOW_OCR_DPI", "200"))
+OCR_LANGUAGE = os.getenv("WOW_OCR_LANG", "eng")
+OCR_WORKERS = int(os.getenv("WOW_OCR_WORKERS", "0")) or max(1, min(4, (os.cpu_count() or 2) - 1))
+OCR_TIMEOUT = float(os.getenv("WOW_OCR_TIMEOUT", "240"))
+OCR_CACHE_MAX = 2000
+# Workers are started fresh rather than forked: a fork of the threaded server would copy
+# whatever locks, SQLite connections and SDK clients other threads hold at that moment.
+OCR_START_METHOD = os.getenv("WOW_OCR_START_METHOD", "forkserver")  # forkserver | spawn
+
+# page hash -> OCR text (insertion ordered, oldest evicted first)
+OCR_CACHE = {}
+OCR_LOCK = threading.Lock()
+_OCR_POOL = None
 
 
-def call_llm(model: str, prompt: str, max_tokens: int = 12000, temperature: float = 0.2) -> dict:
+def _ocr_pool():
+    """Create the OCR process pool on first use."""
+    global _OCR_POOL
+    with OCR_LOCK:
+        if _OCR_POOL is None:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+
+            method = OCR_START_METHOD if OCR_START_METHOD in multiprocessing.get_all_start_methods() else "spawn"
+            _OCR_POOL = ProcessPoolExecutor(max_workers=OCR_WORKERS, mp_context=multiprocessing.get_context(method))
+        return _OCR_POOL
+
+
+def _ocr_page_worker(page_pdf: bytes, dpi: int, language: str) -> str:
     """
-    Generic LLM caller.
-    - OpenAI: uses new-style client if available, falls back to ChatCompletion.
-    - Gemini: uses newer google-genai Client with models.generate_content.
+    Rasterize and OCR a single-page PDF (runs in a worker process).
+    OCR text blocks come back in reading order, separated by blank lines, with the
+    block's own line breaks kept, so callers can tell paragraphs from wrapped lines.
     """
-    provider = "openai" if model.startswith("gpt") else ("gemini" if model.startswith("gemini") else "openai")
+    import fitz as _fitz
 
-    # OPENAI
-    if provider == "openai":
-        if openai is None:
-            return {"error": "openai package not installed on server. Install the openai package."}
-        key = API_KEYS.get("openai") or os.getenv("OPENAI_API_KEY")
-        if not key:
-            return {"error": "OpenAI API key not set."}
-        os.environ["OPENAI_API_KEY"] = key
+    doc = _fitz.open(stream=page_pdf, filetype="pdf")
+    page = doc[0]
+    tp = page.get_textpage_ocr(dpi=dpi, language=language, full=True)
+    blocks = page.get_text("blocks", textpage=tp, sort=True)  # (x0, y0, x1, y1, text, block_no, type)
+    return "\n\n".join(b[4].strip() for b in blocks if b[6] == 0 and b[4].strip())
 
+
+@traced("pdf.ocr", lambda doc, pages: {"pages": len(pages)})
+def ocr_missing_pages(doc, pages: list) -> list:
+    """
+    Fill in text for pages that have no text layer by OCR'ing only those pages.
+    Results are cached by the hash of the isolated page, so re-uploads are free.
+    """
+    fitz = lazy_import("fitz")
+    todo = {}
+    for i, text in enumerate(pages):
+        if len(text.strip()) >= OCR_MIN_CHARS:
+            continue
+        with fitz.open() as single:
+            single.insert_pdf(doc, from_page=i, to_page=i)
+            page_pdf = single.tobytes(garbage=3, deflate=True, no_new_id=True)
+        page_hash = hashlib.sha256(page_pdf).hexdigest()
+        with OCR_LOCK:
+            cached = OCR_CACHE.get(page_hash)
+        if cached is not None:
+            pages[i] = cached
+        else:
+            todo[i] = (page_hash, page_pdf)
+    if not todo:
+        return pages
+
+    pool = _ocr_pool()
+    futures = {i: pool.submit(_ocr_page_worker, pdf, OCR_DPI, OCR_LANGUAGE) for i, (_, pdf) in todo.items()}
+    # The calling request thread blocks here for at most OCR_TIMEOUT seconds in total,
+    # however many pages are queued; pages not done by then are returned empty.
+    deadline = time.monotonic() + OCR_TIMEOUT
+    for i, fut in futures.items():
         try:
-            # New-style OpenAI client
-            if hasattr(openai, "OpenAI"):
-                try:
-                    client = openai.OpenAI(api_key=key)
-                except Exception:
-                    client = openai.OpenAI()
-
-                # Chat completions (preferred)
-                if hasattr(client, "chat") and hasattr(client.chat, "completions") and hasattr(
-                    client.chat.completions, "create"
-                ):
-                    resp = client.chat.completions.create(
-                        model=model,
-                        messages=[{"role": "user", "content": prompt}],
-                        max_tokens=max_tokens,
-                        temperature=temperature,
-                    )
-                    try:
-                        msg = resp.choices[0].message
-                        if isinstance(msg, dict):
-                            text = msg.get("content")
-                        else:
-                            text = getattr(msg, "content", None)
-                    except Exception:
-                        text = getattr(resp.choices[0], "text", None)
-                    if not text:
-                        text = getattr(resp, "output_text", None) or str(resp)
-                    return {"text": text}
-
-                # Responses API fallback
-                if hasattr(client, "responses") and hasattr(client.responses, "create"):
-                    resp = client.responses.create(
-                        model=model,
-                        input=prompt,
-                        max_output_tokens=max_tokens,
-                        temperature=temperature,
-                    )
-                    text = getattr(resp, "output_text", None)
-                    if not text:
-                        parts = []
-                        try:
-                            for item in getattr(resp, "output", []) or []:
-                                content = getattr(item, "content", None) or (
-                                    item.get("content") if isinstance(item, dict) else None
-                                )
-                                if isinstance(content, list):
-                                    for c in content:
-                                        if isinstance(c, dict) and "text" in c:
-                                            parts.append(c["text"])
-                                        elif hasattr(c, "text"):
-                                            parts.append(c.text)
-                                elif isinstance(content, str):
-                                    parts.append(content)
-                        except Exception:
-                            pass
-                        if parts:
-                            text = "\n".join(parts)
-                    if not text:
-                        text = str(resp)
-                    return {"text": text}
-
-            # Legacy ChatCompletion API
-            if hasattr(openai, "ChatCompletion"):
-                openai.api_key = key
-                resp = openai.ChatCompletion.create(
-                    model=model,
-                    messages=[{"role": "user", "content": prompt}],
-                    max_tokens=max_tokens,
-                    temperature=temperature,
-                )
-                choice = resp.choices[0]
-                if hasattr(choice, "message"):
-                    return {"text": choice.message["content"]}
-                return {"text": getattr(choice, "text", "")}
-
-            return {
-                "error": (
-                    "Installed openai package does not expose a supported API. "
-                    "Consider running `OPENAI migrate` or aligning SDK version."
-                )
-            }
-        except Exception as e:
-            msg = str(e)
-            if "ChatCompletion" in msg or "chat" in msg.lower():
-                msg += " — If you recently upgraded the OpenAI SDK, try: OPENAI migrate"
-            return {"error": msg}
+            text = fut.result(timeout=max(0.0, deadline - time.monotonic()))
+        except Exception:
+            # Tesseract missing, page failed or time budget exhausted: keep the empty page.
+            # A page already running finishes in the pool and is cached for the next upload.
+            if not fut.cancel():
+                fut.add_done_callback(lambda f, page_hash=todo[i][0]: _cache_ocr_result(page_hash, f))
+            continue
+        pages[i] = text
+        _cache_ocr_text(todo[i][0], text)
+    return pages
 
-    # GEMINI (google-genai)
-    if provider == "gemini":
-        if genai is None:
-            return {
-                "error": (
-                    "google-genai (google.genai) not installed. "
-                    "Install with: pip install google-genai"
-                )
-            }
-        key = API_KEYS.get("gemini") or os.getenv("GOOGLE_API_KEY") or os.getenv("GEMINI_API_KEY")
-        if not key:
-            return {"error": "Gemini API key not set."}
 
-        # Newer practice: explicit Client with API key, using models.generate_content
-        try:
-            client = genai.Client(api_key=key)
-            resp = client.models.generate_content(
-                model=model,
-                contents=prompt,
-                config={
-                    "temperature": float(temperature),
-                    "max_output_tokens": int(max_tokens),
-                },
-            )
+def _cache_ocr_text(page_hash: str, text: str):
+    with OCR_LOCK:
+        OCR_CACHE[page_hash] = text
+        while len(OCR_CACHE) > OCR_CACHE_MAX:
+            OCR_CACHE.pop(next(iter(OCR_CACHE)))
 
-            text = getattr(resp, "text", None)
-            if not text:
-                text = getattr(resp, "output_text", None)
-            if not text:
-                text = str(resp)
-            return {"text": text}
 
-        except Exception as e:
-            return {"error": f"Gemini call failed: {e}"}
+def _cache_ocr_result(page_hash: str, fut):
+    if not fut.cancelled() and fut.exception() is None:
+        _cache_ocr_text(page_hash, fut.result())
 
-    return {"error": "Unsupported model/provider."}
 
+@traced("pdf.extract")
+def extract_pages_from_pdf_stream(stream, ocr: bool = True):
+    """Extract per-page text from a PDF file-like object using PyMuPDF (OCR for scanned pages)."""
+    fitz = lazy_import("fitz")
+    if fitz is None:
+        return []
+    doc = open_pdf(fitz, stream)
+    pages = [p.get_text() for p in doc]
+    if ocr and OCR_ENABLED:
+        pages = ocr_missing_pages(doc, pages)
+    return pages
 
-@app.route("/")
-def index():
-    # Available models (extend as needed)
-    model_opts = ["gpt-4o-mini", "gpt-4.1-mini", "gemini-2.5-flash", "gemini-3-flash-preview"]
 
-    has_openai_env = bool(os.getenv("OPENAI_API_KEY"))
-    has_gemini_env = bool(os.getenv("GEMINI_API_KEY") or os.getenv("GOOGLE_API_KEY"))
+def extract_text_from_pdf_stream(stream):
+    """Extract text from a PDF file-like object using PyMuPDF."""
+    return "\n\n".join(extract_pages_from_pdf_stream(stream))
 
-    return render_template_string(
-        INDEX_HTML,
-        painters_json=json.dumps(PAINTERS),
-        models_json=json.dumps(model_opts),
-        agents_json=json.dumps(AGENTS),
-        agents=AGENTS,
-        has_openai_env=has_openai_env,
-        has_gemini_env=has_gemini_env,
-        sub_prompt_default=SUBMISSION_PROMPT_DEFAULT,
-        checklist_prompt_default=CHECKLIST_PROMPT_DEFAULT,
-        review_prompt_default=REVIEW_PROMPT_DEFAULT,
-        note_prompt_default=NOTE_PROMPT_DEFAULT,
-    )
 
+# Pre-prompt compaction: page headers/footers, confidentiality banners, page numbers,
+# TOC leader dots and whitespace runs would otherwise eat the 3000/8000-char budgets.
+COMPACT_ENABLED = os.getenv("WOW_COMPACT", "1") not in ("0", "false", "off")
+COMPACT_READ_FACTOR = 2  # read this many times the prompt budget so compaction has room to help
+COMPACT_EDGE_LINES = 3  # header/footer candidates: first and last N non-empty lines of a page
+COMPACT_REPEAT_SHARE = 0.5  # ... that recur on at least this share of pages
+# A page of at least COMPACT_CHECK_CHARS that shrinks below this ratio has most likely lost
+# content rather than boilerplate, so it is passed on uncompacted instead.
+COMPACT_MIN_RATIO = float(os.getenv("WOW_COMPACT_MIN_RATIO", "0.4"))
+COMPACT_CHECK_CHARS = 200
+ANCHOR_RE = re.compile(r"\[p\. \d+\]")
+PAGE_NUMBER_RE = re.compile(r"^\s*(?:page\s*)?[-–]?\s*\d{1,4}\s*[-–]?(?:\s*(?:of|/)\s*\d{1,4})?\s*$", re.IGNORECASE)
+TOC_LEADER_RE = re.compile(r"(?:\s*[.·…_]\s*){4,}(\d{1,4})\s*$")
 
-@app.route("/set_api_keys", methods=["POST"])
-def set_api_keys():
-    data = request.get_json() or {}
-    if "openai" in data and data["openai"]:
-        API_KEYS["openai"] = data["openai"]
-    if "gemini" in data and data["gemini"]:
-        API_KEYS["gemini"] = data["gemini"]
-    return jsonify({"status": "saved"})
 
+def _line_signature(line: str) -> str:
+    # Page-specific numbers ("Page 3 of 40", dates on running footers) must not defeat matching
+    return re.sub(r"\d+", "#", re.sub(r"\s+", " ", line.strip().lower()))
 
-@app.route("/transform_submission", methods=["POST"])
-def transform_submission():
-    pasted = request.form.get("pasted", "")
-    model = request.form.get("model") or "gpt-4o-mini"
-    max_tokens = int(request.form.get("max_tokens") or 12000)
-    user_prompt = (request.form.get("user_prompt") or "").strip() or SUBMISSION_PROMPT_DEFAULT
 
-    f = request.files.get("file")
-    text = pasted
-    if f:
-        fname = f.filename.lower()
-        if fname.endswith(".pdf"):
-            text = extract_text_from_pdf_stream(f.stream)
-        else:
-            try:
-                text = f.stream.read().decode("utf-8")
-            except Exception:
-                text = ""
+def _protected(line: str) -> bool:
+    # Headings and [p. N] anchors are what findings cite; they repeat by design
+    return line.lstrip().startswith("#") or bool(ANCHOR_RE.search(line))
 
-    prompt = user_prompt + "\n\nSource:\n" + text[:3000]
 
-    res = call_llm(model, prompt, max_tokens=max_tokens)
+def compact_text(text: str) -> str:
+    """Collapse whitespace, drop page-number lines and replace TOC leader dots."""
+    lines = []
+    for line in text.split("\n"):
+        line = TOC_LEADER_RE.sub(r" \1", line.rstrip())
+        if PAGE_NUMBER_RE.match(line) and not _protected(line):
+            continue
+        # Keep indentation (nested lists) but squeeze interior runs of spaces/tabs
+        indent = len(line) - len(line.lstrip(" "))
+        lines.append(" " * min(indent, 8) + re.sub(r"[ \t\u00a0]{2,}", " ", line.strip()))
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(lines)).strip()
+
+
+@traced("prompt.compact", lambda pages: {"pages": len(pages)})
+def compact_pages(pages: list) -> tuple:
+    """
+    Strip header/footer lines repeated across pages, then compact each page.
+    Headings and [p. N] anchors are never stripped, and a page that would shrink below
+    COMPACT_MIN_RATIO is kept as it was.
+    Returns (pages, stats) with the compression ratio (output chars / input chars).
+    """
+    chars_in = sum(len(p) for p in pages)
+    boilerplate = set()
+    if len(pages) >= 3:
+        from collections import Counter
+
+        seen = Counter()
+        for page in pages:
+            lines = [l for l in page.split("\n") if l.strip()]
+            edges = lines[:COMPACT_EDGE_LINES] + lines[-COMPACT_EDGE_LINES:]
+            seen.update({_line_signature(l) for l in edges})
+        threshold = max(2, COMPACT_REPEAT_SHARE * len(pages))
+        boilerplate = {sig for sig, n in seen.items() if n >= threshold and sig.strip("# ")}
+    out, removed, fallback = [], 0, 0
+    for page in pages:
+        kept, dropped = [], 0
+        for line in page.split("\n"):
+            if line.strip() and not _protected(line) and _line_signature(line) in boilerplate:
+                dropped += 1
+                continue
+            kept.append(line)
+        compacted = compact_text("\n".join(kept))
+        if len(page) >= COMPACT_CHECK_CHARS and len(compacted) < COMPACT_MIN_RATIO * len(page):
+            out.append(page)
+            fallback += 1
+            continue
+        out.append(compacted)
+        removed += dropped
+    chars_out = sum(len(p) for p in out)
+    return out, {
+        "chars_in": chars_in,
+        "chars_out": chars_out,
+        "ratio": round(chars_out / chars_in, 3) if chars_in else 1.0,
+        "boilerplate_lines": removed,
+        "uncompacted_pages": fallback,
+    }
+
+
+def compact_source(text: str, pages: list = None) -> tuple:
+    """Compact prompt source text (per page when pages are known). Returns (text, pages, stats)."""
+    if not COMPACT_ENABLED:
+        return text, pages, None
+    if pages:
+        pages, stats = compact_pages(pages)
+        return "\n\n".join(p for p in pages if p), pages, stats
+    (text,), stats = compact_pages([text])
+    return text, pages, stats
+
+
+def _table_markdown(table) -> str:
+    """Render a PyMuPDF table as compact markdown."""
+    if hasattr(table, "to_markdown"):
+        try:
+            return table.to_markdown(clean=True).strip()
+        except Exception:
+            pass
+    rows = [[(c or "").replace("\n", " ").strip() for c in row] for row in (table.extract() or [])]
+    if not rows:
+        return ""
+    lines = ["| " + " | ".join(rows[0]) + " |", "|" + "---|" * len(rows[0])]
+    lines += ["| " + " | ".join(r) + " |" for r in rows[1:]]
+    return "\n".join(lines)
+
+
+def _inside(bbox, areas) -> bool:
+    x0, y0, x1, y1 = bbox
+    cx, cy = (x0 + x1) / 2, (y0 + y1) / 2
+    return any(a[0] <= cx <= a[2] and a[1] <= cy <= a[3] for a in areas)
+
+
+@traced("pdf.extract_structured")
+def extract_structured_from_pdf_stream(stream, ocr: bool = True) -> list:
+    """
+    Layout-aware extraction using PyMuPDF's dict output.
+    Returns a list of sections: {"title", "level", "page", "text", "tables"}.
+    Headings are detected from font size/weight relative to the body text size.
+    """
+    fitz = lazy_import("fitz")
+    if fitz is None:
+        return []
+    doc = open_pdf(fitz, stream)
+
+    # Pass 1: collect lines with their dominant font size / boldness
+    page_lines, page_tables, size_weight = [], [], {}
+    for page in doc:
+        tables, areas = [], []
+        if hasattr(page, "find_tables"):
+            try:
+                for tab in page.find_tables().tables:
+                    md = _table_markdown(tab)
+                    if md:
+                        tables.append(md)
+                        areas.append(tuple(tab.bbox))
+            except Exception:
+                tables, areas = [], []
+        lines = []
+        for block in page.get_text("dict").get("blocks", []):
+            if block.get("type") != 0 or _inside(block["bbox"], areas):
+                continue
+            for line in block.get("lines", []):
+                spans = [s for s in line.get("spans", []) if s.get("text", "").strip()]
+                if not spans:
+                    continue
+                text = "".join(s["text"] for s in spans).strip()
+                size = round(max(s["size"] for s in spans), 1)
+                bold = all(s.get("flags", 0) & 16 for s in spans)
+                size_weight[size] = size_weight.get(size, 0) + len(text)
+                lines.append({"text": text, "size": size, "bold": bold, "block": id(block)})
+        page_lines.append(lines)
+        page_tables.append(tables)
+
+    if ocr and OCR_ENABLED:
+        plain = ["\n".join(l["text"] for l in lines) for lines in page_lines]
+        filled = ocr_missing_pages(doc, list(plain))
+        for i, text in enumerate(filled):
+            if text != plain[i] and text.strip():
+                # One OCR block per blank-line separated paragraph: its lines are joined as
+                # wrapped lines, separate blocks stay separate paragraphs
+                page_lines[i] = [
+                    {"text": line.strip(), "size": 0, "bold": False, "block": ("ocr", i, b)}
+                    for b, block in enumerate(re.split(r"\n\s*\n", text))
+                    for line in block.splitlines()
+                    if line.strip()
+                ]
+
+    body_size = max(size_weight, key=size_weight.get) if size_weight else 0
+    heading_sizes = sorted({s for s in size_weight if s >= body_size * 1.15}, reverse=True)
+
+    def heading_level(line):
+        if len(line["text"]) > 120:
+            return 0
+        if line["size"] in heading_sizes:
+            return min(heading_sizes.index(line["size"]) + 1, 3)
+        if line["bold"] and line["size"] >= body_size and len(line["text"]) < 80:
+            return 3
+        return 0
+
+    # Pass 2: group into sections, joining wrapped lines of the same block
+    sections = [{"title": "", "level": 1, "page": 1, "text": "", "tables": []}]
+    for page_no, (lines, tables) in enumerate(zip(page_lines, page_tables), start=1):
+        prev_block = None
+        for line in lines:
+            level = heading_level(line)
+            if level:
+                sections.append({"title": line["text"], "level": level, "page": page_no, "text": "", "tables": []})
+                prev_block = None
+                continue
+            cur = sections[-1]
+            if prev_block == line["block"] and cur["text"]:
+                if cur["text"].endswith("-"):
+                    cur["text"] = cur["text"][:-1] + line["text"]
+                else:
+                    cur["text"] += " " + line["text"]
+            else:
+                cur["text"] += ("\n" if cur["text"] else "") + line["text"]
+            prev_block = line["block"]
+        sections[-1]["tables"].extend(tables)
+    return [s for s in sections if s["title"] or s["text"].strip() or s["tables"]]
+
+
+def render_structured(sections: list) -> str:
+    """Render structured sections as compact markdown with [p. N] page anchors."""
+    out = []
+    for s in sections:
+        if s["title"]:
+            out.append("#" * (s["level"] + 1) + f" {s['title']} [p. {s['page']}]")
+        elif s["text"]:
+            out.append(f"[p. {s['page']}]")
+        if s["text"]:
+            out.append(s["text"].strip())
+        out.extend(s["tables"])
+    return "\n\n".join(out)
+
+
+@traced("prompt.select_sections", lambda text, query, budget: {"chars": len(text), "budget": budget})
+def select_sections(text: str, query: str, budget: int) -> str:
+    """
+    Fit text into a character budget section by section.
+    When it does not fit, keep the sections sharing the most terms with query
+    (targeted retrieval), in document order, instead of cutting off the tail.
+    """
+    if len(text) <= budget:
+        return text
+    sections = split_sections(text)
+    terms = set(re.findall(r"[a-z0-9]{4,}", query.lower()))
+
+    def score(s):
+        words = re.findall(r"[a-z0-9]{4,}", (s["title"] + " " + s["text"]).lower())
+        return sum(1 for w in words if w in terms) / (1 + len(words) ** 0.5)
+
+    ranked = sorted(range(len(sections)), key=lambda i: (-score(sections[i]), i))
+    keep, used = set(), 0
+    for i in ranked:
+        size = len(sections[i]["text"]) + 2
+        if used + size <= budget:
+            keep.add(i)
+            used += size
+    chosen = [sections[i]["text"] for i in sorted(keep)]
+    if not chosen:
+        return text[:budget]
+    return "\n\n".join(chosen)
+
+
+# Revision store for incremental re-review, keyed by tenant and the client-supplied doc_id.
+# Each entry keeps page hashes, the source sections and per-section review results of the
+# last revision; idle entries expire and the least recently used are evicted.
+REVISION_TTL = int(os.getenv("WOW_REVISION_TTL", str(7 * 24 * 3600)))
+REVISION_MAX = int(os.getenv("WOW_REVISION_MAX", "256"))
+
+
+class RevisionStore:
+    """Last revision per (tenant, doc_id), in LRU order; mutate entries under .lock."""
+
+    def __init__(self, ttl: int, max_items: int):
+        self.ttl = ttl
+        self.max_items = max_items
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def entry(self, doc_id: str) -> dict:
+        """The caller's entry for doc_id (created if missing). Call with self.lock held."""
+        key = (CURRENT_TENANT.get(), doc_id)
+        now = time.time()
+        cutoff = now - self.ttl
+        for k in [k for k, e in self.items.items() if e["touched"] < cutoff]:
+            del self.items[k]
+        entry = self.items.pop(key, None) or {}
+        entry["touched"] = now
+        self.items[key] = entry
+        while len(self.items) > self.max_items:
+            del self.items[next(iter(self.items))]
+        return entry
+
+
+REVISIONS = RevisionStore(REVISION_TTL, REVISION_MAX)
+
+SECTION_MAX_CHARS = 6000
+# Paged sources are reviewed in packs of consecutive pages starting at fixed page numbers
+# (1-8, 9-16, ...), cut early at a page boundary when a pack would exceed the char budget.
+REVIEW_SECTION_PAGES = int(os.getenv("WOW_REVIEW_SECTION_PAGES", "8"))
+REVIEW_SECTION_CHARS = 24000
+REVIEW_UPDATE_PROMPT = (
+    "You previously reviewed the submission section below and produced the PRIOR FINDINGS. "
+    "Since then only the pages shown under CHANGED PAGES were edited. Return the full updated "
+    "findings for the whole section: revise what the edits affect and keep everything else as it is."
+)
+HEADING_RE = re.compile(r"^#{1,6}\s+\S.*$", re.MULTILINE)
+
+# Small pool used to re-run changed sections concurrently
+SECTION_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="section")
+
+
+def text_digest(*parts) -> str:
+    """Stable short hash over one or more text parts."""
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(str(part).encode("utf-8", "replace"))
+        h.update(b"\x00")
+    return h.hexdigest()[:24]
+
+
+def split_sections(text: str) -> list:
+    """
+    Split markdown/plain text into sections.
+    - Markdown headings start a new section.
+    - Oversized sections (or heading-less text) are split on paragraph boundaries.
+    """
+    bounds = [m.start() for m in HEADING_RE.finditer(text)]
+    if not bounds or bounds[0] != 0:
+        bounds.insert(0, 0)
+    raw = [text[a:b] for a, b in zip(bounds, bounds[1:] + [len(text)])]
+
+    sections = []
+    for chunk in raw:
+        if not chunk.strip():
+            continue
+        first = chunk.strip().splitlines()[0]
+        title = first.lstrip("#").strip() if first.startswith("#") else ""
+        parts, buf = [], ""
+        for para in re.split(r"\n\s*\n", chunk):
+            if buf and len(buf) + len(para) > SECTION_MAX_CHARS:
+                parts.append(buf)
+                buf = ""
+            buf = (buf + "\n\n" + para) if buf else para
+        if buf.strip():
+            parts.append(buf)
+        for i, part in enumerate(parts):
+            part_title = title or (part.strip().splitlines()[0][:60] if part.strip() else "")
+            if len(parts) > 1:
+                part_title = f"{part_title} (part {i + 1})"
+            sections.append({"title": part_title or "Untitled section", "text": part.strip()})
+    return sections
+
+
+def _page_unit(pages: list, numbers: list, text: str = None, part: int = 0) -> dict:
+    """A review unit over pages[numbers]; offsets locate each page inside text."""
+    first, last = numbers[0], numbers[-1]
+    title = f"Page {first}" if first == last else f"Pages {first}-{last}"
+    if text is None:
+        text, offsets = "", []
+        for n in numbers:
+            start = len(text) + (2 if text else 0)
+            text = (text + "\n\n" + pages[n - 1]) if text else pages[n - 1]
+            offsets.append((start, len(text)))
+    else:
+        offsets = [(0, len(text))]
+    return {
+        "title": title + (f" (part {part})" if part else ""),
+        "text": text,
+        "unit": f"{first}-{last}" + (f".{part}" if part else ""),
+        "pages": numbers,
+        "page_hashes": [text_digest(pages[n - 1]) for n in numbers],
+        "offsets": offsets,
+    }
+
+
+def source_sections(pages: list) -> list:
+    """
+    Review units for a paged source: packs of up to REVIEW_SECTION_PAGES consecutive pages
+    (at most REVIEW_SECTION_CHARS each). Packs start at fixed page numbers, so an edit only
+    changes the pack holding the edited page; a single page over the budget is split alone.
+    """
+    sections = []
+    for start in range(1, len(pages) + 1, REVIEW_SECTION_PAGES):
+        pack, size = [], 0
+        for n in range(start, min(start + REVIEW_SECTION_PAGES, len(pages) + 1)):
+            page = pages[n - 1]
+            if pack and size + len(page) > REVIEW_SECTION_CHARS:
+                sections.append(_page_unit(pages, pack))
+                pack, size = [], 0
+            if len(page) > REVIEW_SECTION_CHARS:
+                parts = split_sections(page)
+                sections.extend(_page_unit(pages, [n], p["text"], i) for i, p in enumerate(parts, 1))
+                continue
+            pack.append(n)
+            size += len(page) + 2
+        if pack:
+            sections.append(_page_unit(pages, pack))
+    return sections
+
+
+def diff_pages(doc_id: str, pages: list, sections: list = None) -> dict:
+    """
+    Record page hashes (and the source sections reviews are driven from) for doc_id
+    and report which pages changed since the last revision.
+    """
+    hashes = [text_digest(p) for p in pages]
+    with REVISIONS.lock:
+        entry = REVISIONS.entry(doc_id)
+        previous = entry.get("pages") or []
+        entry["pages"] = hashes
+        if sections is not None:
+            entry["sections"] = sections
+    changed = [i + 1 for i, h in enumerate(hashes) if i >= len(previous) or previous[i] != h]
+    return {"pages": len(hashes), "changed_pages": changed, "previous_pages": len(previous)}
+
+
+def review_incrementally(doc_id, submission, checklist, model, user_prompt, max_tokens):
+    """
+    Review a document section by section, re-running the LLM only for sections whose
+    text changed since the last revision of doc_id. Sections come from the source
+    recorded by the last transform of doc_id (so a regenerated transform does not
+    invalidate them); without one, the submission text is split instead. A page pack
+    with only some pages edited is updated from its prior findings and the edited pages.
+    Sections that succeed are kept even when another fails, so a retry only re-runs
+    the failed ones. Returns a call_llm-style dict.
+    """
+    context_key = text_digest(model, user_prompt, checklist[:2000], max_tokens)
+    with REVISIONS.lock:
+        entry = REVISIONS.entry(doc_id)
+        sections = entry.get("sections") or split_sections(submission)
+        review = entry.get("review") or {}
+        same_context = review.get("key") == context_key
+        cached = dict(review.get("results") or {}) if same_context else {}
+        units = dict(review.get("units") or {}) if same_context else {}
+    if not sections:
+        return {"error": "Submission is empty."}
+
+    def run_section(section):
+        # A pack with only some pages edited is updated from its prior findings,
+        # sending just the edited pages instead of the whole pack
+        prior = units.get(section.get("unit"))
+        changed = []
+        if prior and prior["pages"] == section.get("pages"):
+            changed = [n for n, old, new in zip(section["pages"], prior["page_hashes"], section["page_hashes"]) if old != new]
+        if changed and len(changed) < len(section["pages"]):
+            spans = dict(zip(section["pages"], section["offsets"]))
+            edited = "\n\n".join(f"[Page {n}]\n" + section["text"][slice(*spans[n])] for n in changed)
+            prompt = (
+                REVIEW_UPDATE_PROMPT
+                + "\n\n" + user_prompt
+                + "\n\nCHECKLIST:\n" + checklist[:2000]
+                + "\n\nSECTION: " + section["title"]
+                + "\n\nPRIOR FINDINGS:\n" + prior["text"]
+                + "\n\nCHANGED PAGES:\n" + edited[:REVIEW_SECTION_CHARS]
+            )
+        else:
+            prompt = (
+                user_prompt
+                + "\n\nReview only the submission section below. Report findings, recommended "
+                "actions, and missing documents for this section only."
+                + "\n\nCHECKLIST:\n"
+                + checklist[:2000]
+                + "\n\nSUBMISSION SECTION ("
+                + section["title"]
+                + "):\n"
+                + section["text"][:REVIEW_SECTION_CHARS]
+            )
+        with span("review.section", title=section["title"][:80], update=bool(changed)):
+            return call_llm_adaptive(model, prompt, max_tokens=max_tokens)
+
+    hashes = [text_digest(s["title"], s["text"]) for s in sections]
+    todo = {h: s for h, s in zip(hashes, sections) if h not in cached}
+    # copy_context() carries the caller's tenant into the worker threads
+    futures = {h: SECTION_POOL.submit(contextvars.copy_context().run, run_section, s) for h, s in todo.items()}
+
+    # Wait for every section and keep the ones that succeeded, so a retry after a
+    # failure only pays for the sections that failed
+    results, error = dict(cached), None
+    for h, fut in futures.items():
+        res = fut.result()
+        if "text" in res:
+            results[h] = res["text"]
+        else:
+            error = error or res
+    for h, s in zip(hashes, sections):
+        if s.get("unit") and h in results:
+            units[s["unit"]] = {"pages": s["pages"], "page_hashes": s["page_hashes"], "text": results[h]}
+    with REVISIONS.lock:
+        entry["review"] = {"key": context_key, "results": {h: results[h] for h in hashes if h in results}, "units": units}
+    if error is not None:
+        return error
+
+    report = "\n\n".join(
+        f"## {s['title']}\n\n{results[h].strip()}" for h, s in zip(hashes, sections)
+    )
+    return {
+        "text": report,
+        "revision": {"sections": len(sections), "changed": len(todo), "reused": len(sections) - len(todo)},
+    }
+
+
+# Usage ledger: one SQLite row per LLM call (tokens, latency, estimated cost),
+# with rolled-up views and optional budgets loaded from budgets.yaml / WOW_BUDGETS.
+LEDGER_DB = os.getenv("WOW_LEDGER_DB") or os.path.join(DATA_DIR, "usage.db")
+LEDGER_LOCK = threading.Lock()
+_LEDGER_CONN = None
+CURRENT_ENDPOINT = contextvars.ContextVar("current_endpoint", default="")
+
+# Estimated USD per 1M tokens: (input, cached input, output). Override in budgets.yaml under "prices".
+MODEL_PRICES = {
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-4.1-mini": (0.40, 0.10, 1.60),
+    "gemini-2.5-flash": (0.30, 0.075, 2.50),
+    "gemini-3-flash-preview": (0.50, 0.05, 3.00),
+    "local": (0.0, 0.0, 0.0),
+}
+# Models missing from the table (and from budgets "prices") are charged at the
+# highest known rate rather than for free, so they still count against budgets.
+_UNPRICED_LOGGED = set()
+
+LEDGER_SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts REAL NOT NULL,
+    day TEXT NOT NULL,
+    month TEXT NOT NULL,
+    tenant TEXT NOT NULL,
+    endpoint TEXT NOT NULL,
+    model TEXT NOT NULL,
+    ok INTEGER NOT NULL,
+    prompt_tokens INTEGER NOT NULL,
+    completion_tokens INTEGER NOT NULL,
+    cached_tokens INTEGER NOT NULL,
+    estimated INTEGER NOT NULL,
+    latency_ms REAL NOT NULL,
+    cost_usd REAL NOT NULL,
+    coalesced INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS usage_month ON usage (month, tenant, model);
+-- One row per logical completion (continuation pieces stitched), for adaptive max_tokens
+CREATE TABLE IF NOT EXISTS output_lengths (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts REAL NOT NULL,
+    endpoint TEXT NOT NULL,
+    agent TEXT NOT NULL,
+    model TEXT NOT NULL,
+    tokens INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS output_lengths_key ON output_lengths (endpoint, agent, model);
+CREATE VIEW IF NOT EXISTS usage_daily AS
+    SELECT day, model, endpoint, COUNT(*) AS calls, SUM(prompt_tokens) AS prompt_tokens,
+           SUM(completion_tokens) AS completion_tokens, SUM(cached_tokens) AS cached_tokens,
+           ROUND(AVG(latency_ms), 1) AS avg_latency_ms, ROUND(SUM(cost_usd), 6) AS cost_usd,
+           SUM(coalesced) AS coalesced
+    FROM usage GROUP BY day, model, endpoint;
+CREATE VIEW IF NOT EXISTS usage_monthly AS
+    SELECT month, tenant, model, COUNT(*) AS calls, SUM(prompt_tokens) AS prompt_tokens,
+           SUM(completion_tokens) AS completion_tokens, SUM(cached_tokens) AS cached_tokens,
+           ROUND(SUM(cost_usd), 6) AS cost_usd, SUM(coalesced) AS coalesced
+    FROM usage GROUP BY month, tenant, model;
+"""
+
+
+def ledger_conn():
+    """Shared SQLite connection for the ledger (created on first use)."""
+    global _LEDGER_CONN
+    if _LEDGER_CONN is None:
+        import sqlite3
+
+        os.makedirs(os.path.dirname(LEDGER_DB) or ".", exist_ok=True)
+        conn = sqlite3.connect(LEDGER_DB, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.executescript(LEDGER_SCHEMA)
+        if "coalesced" not in {r[1] for r in conn.execute("PRAGMA table_info(usage)")}:
+            # Ledgers written before coalesced hits were charged
+            conn.execute("ALTER TABLE usage ADD COLUMN coalesced INTEGER NOT NULL DEFAULT 0")
+            conn.executescript("DROP VIEW usage_daily; DROP VIEW usage_monthly;" + LEDGER_SCHEMA)
+        _LEDGER_CONN = conn
+    return _LEDGER_CONN
+
+
+def usage_from_response(resp) -> dict:
+    """Normalize OpenAI (chat/responses/legacy) and Gemini usage fields."""
+
+    def pick(obj, *names):
+        for name in names:
+            value = obj.get(name) if isinstance(obj, dict) else getattr(obj, name, None)
+            if value is not None:
+                return value
+        return None
+
+    usage = pick(resp, "usage", "usage_metadata")
+    if usage is None:
+        return {}
+    details = pick(usage, "prompt_tokens_details", "input_tokens_details")
+    return {
+        "prompt_tokens": int(pick(usage, "prompt_tokens", "input_tokens", "prompt_token_count") or 0),
+        "completion_tokens": int(pick(usage, "completion_tokens", "output_tokens", "candidates_token_count") or 0),
+        "cached_tokens": int(
+            (pick(details, "cached_tokens") if details is not None else None)
+            or pick(usage, "cached_content_token_count")
+            or 0
+        ),
+    }
+
+
+def finish_reason_of(resp):
+    """Normalize provider finish reasons: "length" when output hit the token limit, else "stop"/raw."""
+    try:
+        if getattr(resp, "choices", None):
+            reason = resp.choices[0].finish_reason
+        elif getattr(resp, "candidates", None):
+            reason = resp.candidates[0].finish_reason
+        elif getattr(resp, "status", None) == "incomplete":
+            reason = getattr(getattr(resp, "incomplete_details", None), "reason", None)
+        else:
+            return "stop"
+    except Exception:
+        return None
+    reason = str(getattr(reason, "name", reason) or "").lower()
+    if reason in ("length", "max_tokens", "max_output_tokens") or reason.endswith("max_tokens"):
+        return "length"
+    return reason or None
+
+
+def model_price(model: str) -> tuple:
+    prices = dict(MODEL_PRICES, **{k: tuple(v) for k, v in (BUDGETS.get("prices") or {}).items()})
+    for name in sorted(prices, key=len, reverse=True):
+        if model.startswith(name):
+            return prices[name]
+    if model not in _UNPRICED_LOGGED:
+        _UNPRICED_LOGGED.add(model)
+        app.logger.warning("No price for model %s; charging the highest known rate. Add it to budgets 'prices'.", model)
+    return tuple(max(p[i] for p in prices.values()) for i in range(3))
+
+
+def estimate_cost(model: str, usage: dict) -> float:
+    price_in, price_cached, price_out = model_price(model)
+    cached = usage.get("cached_tokens", 0)
+    fresh = max(0, usage.get("prompt_tokens", 0) - cached)
+    return (fresh * price_in + cached * price_cached + usage.get("completion_tokens", 0) * price_out) / 1e6
+
+
+def record_usage(
+    model: str, usage: dict, latency: float, ok: bool, prompt: str = "", output: str = "", coalesced: bool = False
+):
+    """
+    Append one call to the ledger. Missing provider usage is estimated at ~4 chars/token.
+    A coalesced row charges the waiting tenant for a result another caller paid the
+    provider for; it counts against tenant budgets, not server or model ones.
+    """
+    estimated = not usage
+    if estimated:
+        usage = {
+            "prompt_tokens": len(prompt or "") // 4,
+            "completion_tokens": len(output or "") // 4,
+            "cached_tokens": 0,
+        }
+    now = time.time()
+    row = (
+        now,
+        time.strftime("%Y-%m-%d", time.gmtime(now)),
+        time.strftime("%Y-%m", time.gmtime(now)),
+        CURRENT_TENANT.get(),
+        CURRENT_ENDPOINT.get() or "internal",
+        model,
+        int(bool(ok)),
+        usage.get("prompt_tokens", 0),
+        usage.get("completion_tokens", 0),
+        usage.get("cached_tokens", 0),
+        int(estimated),
+        round(latency * 1000, 1),
+        estimate_cost(model, usage),
+        int(bool(coalesced)),
+    )
+    try:
+        with LEDGER_LOCK:
+            conn = ledger_conn()
+            conn.execute(
+                "INSERT INTO usage (ts, day, month, tenant, endpoint, model, ok, prompt_tokens, "
+                "completion_tokens, cached_tokens, estimated, latency_ms, cost_usd, coalesced) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                row,
+            )
+            conn.commit()
+            SPEND.add(row[2], row[3], model, row[12], coalesced)
+    except Exception:
+        # Metering must never break an LLM call
+        pass
+
+
+def month_spend(tenant: str = None, model: str = None) -> float:
+    """
+    Estimated spend in the current (UTC) month, optionally filtered by tenant and/or model.
+    Tenant spend includes coalesced charges; server and model spend are provider spend only.
+    """
+    sql, args = "SELECT COALESCE(SUM(cost_usd), 0) FROM usage WHERE month = ?", [time.strftime("%Y-%m", time.gmtime())]
+    if tenant is not None:
+        sql += " AND tenant = ?"
+        args.append(tenant)
+    else:
+        sql += " AND coalesced = 0"
+    if model is not None:
+        sql += " AND model = ?"
+        args.append(model)
+    try:
+        with LEDGER_LOCK:
+            return float(ledger_conn().execute(sql, args).fetchone()[0])
+    except Exception:
+        return 0.0
+
+
+# apply_budget runs before every call, so it reads running totals instead of
+# summing the ledger; they are reloaded from the ledger every SPEND_REFRESH seconds
+# (other processes writing the same ledger show up then) and at month rollover.
+SPEND_REFRESH = float(os.getenv("WOW_SPEND_REFRESH", "60"))
+
+
+class MonthSpend:
+    """Current-month spend totals (server, per tenant, per model) for budget checks."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.month = None
+        self.loaded = 0.0
+        self.total, self.tenants, self.models = 0.0, {}, {}
+
+    def refresh(self):
+        month = time.strftime("%Y-%m", time.gmtime())
+        try:
+            # LEDGER_LOCK before self.lock, as in add(), so no insert is counted twice
+            with LEDGER_LOCK:
+                rows = ledger_conn().execute(
+                    "SELECT tenant, model, coalesced, SUM(cost_usd) FROM usage WHERE month = ? "
+                    "GROUP BY tenant, model, coalesced",
+                    (month,),
+                ).fetchall()
+                total, tenants, models = 0.0, {}, {}
+                for tenant, model, coalesced, cost in rows:
+                    tenants[tenant] = tenants.get(tenant, 0.0) + cost
+                    if not coalesced:
+                        total += cost
+                        models[model] = models.get(model, 0.0) + cost
+                with self.lock:
+                    self.month, self.loaded = month, time.monotonic()
+                    self.total, self.tenants, self.models = total, tenants, models
+        except Exception:
+            with self.lock:
+                self.loaded = time.monotonic()  # keep the last totals; retry after SPEND_REFRESH
+
+    def add(self, month: str, tenant: str, model: str, cost: float, coalesced: bool = False):
+        """Count a row just written to the ledger (call with LEDGER_LOCK held)."""
+        with self.lock:
+            if month != self.month:
+                return  # not loaded yet, or a new month: the next refresh reads it from the ledger
+            self.tenants[tenant] = self.tenants.get(tenant, 0.0) + cost
+            if not coalesced:
+                self.total += cost
+                self.models[model] = self.models.get(model, 0.0) + cost
+
+    def get(self, tenant: str = None, model: str = None) -> float:
+        """Server total, or one tenant's or one model's spend this month."""
+        with self.lock:
+            stale = self.month != time.strftime("%Y-%m", time.gmtime()) or time.monotonic() - self.loaded >= SPEND_REFRESH
+        if stale:
+            self.refresh()
+        with self.lock:
+            if tenant is not None:
+                return self.tenants.get(tenant, 0.0)
+            if model is not None:
+                return self.models.get(model, 0.0)
+            return self.total
+
+
+SPEND = MonthSpend()
+
+
+def load_budgets() -> dict:
+    """
+    Budgets from WOW_BUDGETS (JSON) or budgets.yaml next to app.py, e.g.:
+      monthly_usd: 200            # whole server
+      tenants: {"*": 20, t-abc: 50}  # per tenant ("*" = any tenant without its own entry)
+      models: {gpt-4.1-mini: 80}  # per model
+      fallback_models: {gpt-4.1-mini: gpt-4o-mini}
+      max_tokens_cap: {gpt-4.1-mini: 6000}
+    """
+    raw = os.getenv("WOW_BUDGETS")
+    if raw:
+        try:
+            return json.loads(raw) or {}
+        except Exception:
+            return {}
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "budgets.yaml")
+    yaml = lazy_import("yaml") if os.path.exists(path) else None
+    if yaml is None:
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = yaml.safe_load(f) or {}
+        return data if isinstance(data, dict) else {}
+    except Exception:
+        return {}
+
+
+BUDGETS = load_budgets()
+
+
+def tenant_budget(tenant: str):
+    limits = BUDGETS.get("tenants") or {}
+    return limits.get(tenant, limits.get("*"))
+
+
+def apply_budget(model: str, max_tokens: int) -> tuple:
+    """
+    Enforce budgets before a call. Returns (model, max_tokens, error):
+    an over-budget model is routed to its configured fallback, otherwise the call is refused.
+    """
+    if not BUDGETS:
+        return model, max_tokens, None
+    tenant = CURRENT_TENANT.get()
+    total = BUDGETS.get("monthly_usd")
+    if total is not None and SPEND.get() >= float(total):
+        return model, max_tokens, "Monthly LLM budget exhausted for this server."
+    tenant_limit = tenant_budget(tenant)
+    if tenant_limit is not None and SPEND.get(tenant=tenant) >= float(tenant_limit):
+        return model, max_tokens, "Monthly LLM budget exhausted for this user."
+    seen = set()
+    while model not in seen:
+        seen.add(model)
+        limit = (BUDGETS.get("models") or {}).get(model)
+        if limit is None or SPEND.get(model=model) < float(limit):
+            break
+        fallback = (BUDGETS.get("fallback_models") or {}).get(model)
+        if not fallback:
+            return model, max_tokens, f"Monthly budget for {model} exhausted."
+        model = fallback
+    cap = (BUDGETS.get("max_tokens_cap") or {}).get(model)
+    if cap:
+        max_tokens = min(int(max_tokens), int(cap))
+    return model, max_tokens, None
+
+
+# Adaptive max_tokens: learn output-length distributions per endpoint/agent/model and
+# reserve a tight limit instead of the form's ceiling (12000/4000/2000).
+ADAPTIVE_MAX_TOKENS = os.getenv("WOW_ADAPTIVE_MAX_TOKENS", "1") not in ("0", "false", "off")
+ADAPTIVE_MIN_SAMPLES = 8
+ADAPTIVE_HEADROOM = 1.3
+ADAPTIVE_FLOOR = 256
+OUTPUT_STATS = {}  # (endpoint, agent, model) -> recent completion token counts
+OUTPUT_STATS_LOCK = threading.Lock()
+
+
+def _output_samples(endpoint: str, agent: str, model: str) -> list:
+    """
+    Recent completion lengths; seeded from the ledger's output_lengths table the first
+    time a key is seen. The usage table is not used: it has one row per call, so the
+    pieces of a continued answer (each cut off at the per-call limit) would skew p95.
+    """
+    from collections import deque
+
+    key = (endpoint, agent, model)
+    with OUTPUT_STATS_LOCK:
+        samples = OUTPUT_STATS.get(key)
+    if samples is None:
+        try:
+            with LEDGER_LOCK:
+                rows = ledger_conn().execute(
+                    "SELECT tokens FROM output_lengths WHERE endpoint = ? AND agent = ? AND model = ? "
+                    "ORDER BY id DESC LIMIT 200",
+                    key,
+                ).fetchall()
+            seed = [r[0] for r in reversed(rows)]
+        except Exception:
+            seed = []
+        with OUTPUT_STATS_LOCK:
+            samples = OUTPUT_STATS.setdefault(key, deque(seed, maxlen=200))
+    return samples
+
+
+def record_output_length(endpoint: str, agent: str, model: str, tokens: int):
+    """Record the stitched length of one logical completion (once, after any continuations)."""
+    if tokens <= 0:
+        return
+    samples = _output_samples(endpoint, agent, model)
+    with OUTPUT_STATS_LOCK:
+        samples.append(int(tokens))
+    try:
+        with LEDGER_LOCK:
+            conn = ledger_conn()
+            conn.execute(
+                "INSERT INTO output_lengths (ts, endpoint, agent, model, tokens) VALUES (?, ?, ?, ?, ?)",
+                (time.time(), endpoint, agent, model, int(tokens)),
+            )
+            conn.commit()
+    except Exception:
+        pass
+
+
+def choose_max_tokens(endpoint: str, agent: str, model: str, ceiling: int) -> int:
+    """p95 of observed output lengths plus headroom, clamped to [ADAPTIVE_FLOOR, ceiling]."""
+    if not ADAPTIVE_MAX_TOKENS:
+        return ceiling
+    samples = _output_samples(endpoint, agent, model)
+    with OUTPUT_STATS_LOCK:
+        ordered = sorted(samples)
+    if len(ordered) < ADAPTIVE_MIN_SAMPLES:
+        return ceiling
+    p95 = ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))]
+    return max(ADAPTIVE_FLOOR, min(int(ceiling), int(p95 * ADAPTIVE_HEADROOM) + 64))
+
+
+# Continuation: when a completion stops at max_tokens, ask the model to carry on
+# from where it stopped and stitch the pieces, so per-call limits can stay small.
+CONTINUE_MAX_ROUNDS = int(os.getenv("WOW_CONTINUE_ROUNDS", "4"))
+CONTINUE_CHUNK_TOKENS = int(os.getenv("WOW_CONTINUE_CHUNK_TOKENS", "0"))  # 0 = no per-call cap
+CONTINUE_CONTEXT_CHARS = 6000
+CONTINUE_OVERLAP_CHARS = 400
+FENCE_RE = re.compile(r"^\s*```[\w-]*[ \t]*\n")
+
+
+def continuation_prompt(prompt: str, partial: str) -> str:
+    tail = partial[-CONTINUE_CONTEXT_CHARS:]
+    return (
+        prompt
+        + "\n\nYour previous answer was cut off by the output limit. It ends with:\n<<<\n"
+        + tail
+        + "\n>>>\nContinue exactly where it stops. Do not repeat any text, do not restart "
+        "lists or tables, and do not add an introduction or wrap the answer in a code block."
+    )
+
+
+def stitch(previous: str, piece: str) -> str:
+    """Return the part of a continuation piece that is new relative to the text so far."""
+    if previous.count("```") % 2 == 0:
+        m = FENCE_RE.match(piece)
+        if m:
+            # The model wrapped its continuation in a fence the original did not open
+            piece = piece[m.end():]
+            if piece.rstrip().endswith("```"):
+                piece = piece.rstrip()[:-3]
+    window = previous[-CONTINUE_OVERLAP_CHARS:]
+    for size in range(min(len(window), len(piece)), 7, -1):
+        if piece.startswith(window[-size:]):
+            return piece[size:]
+    # Restated the unfinished last line
+    last_line = previous[previous.rfind("\n") + 1:]
+    if len(last_line) > 8 and piece.startswith(last_line):
+        return piece[len(last_line):]
+    return piece
+
+
+def _merge_usage(total: dict, usage: dict) -> dict:
+    if not usage:
+        return total
+    total = dict(total or {})
+    for k, v in usage.items():
+        if isinstance(v, (int, float)):
+            total[k] = total.get(k, 0) + v
+    return total
+
+
+def call_llm_continued(model: str, prompt: str, max_tokens: int = 12000, per_call: int = None, **kwargs) -> dict:
+    """
+    call_llm with up to CONTINUE_MAX_ROUNDS follow-up calls when the output is cut
+    off at the per-call limit. max_tokens bounds the total output across all calls.
+    """
+    per_call = min(per_call or max_tokens, max_tokens)
+    res = call_llm(model, prompt, max_tokens=per_call, **kwargs)
+    if "text" not in res:
+        return res
+    text, usage, rounds = res["text"], res.get("usage"), 0
+    produced = (usage or {}).get("completion_tokens") or len(text) // 4
+    kwargs.pop("response_schema", None)  # continuations are raw text appended to the partial output
+    while res.get("finish_reason") == "length" and rounds < CONTINUE_MAX_ROUNDS and produced < max_tokens:
+        rounds += 1
+        limit = min(per_call, max_tokens - produced)
+        with span("llm.continuation", round=rounds, max_tokens=limit):
+            nxt = call_llm(model, continuation_prompt(prompt, text), max_tokens=limit, **kwargs)
+        if "text" not in nxt:
+            break
+        text += stitch(text, nxt["text"])
+        usage = _merge_usage(usage, nxt.get("usage"))
+        produced += (nxt.get("usage") or {}).get("completion_tokens") or len(nxt["text"]) // 4
+        res = nxt
+    return dict(res, text=text, usage=usage, continuations=rounds)
+
+
+def _per_call_limit(endpoint: str, agent: str, model: str, ceiling: int) -> int:
+    limit = choose_max_tokens(endpoint, agent, model, ceiling)
+    if CONTINUE_CHUNK_TOKENS > 0:
+        limit = min(limit, CONTINUE_CHUNK_TOKENS)
+    return limit
+
+
+def call_llm_adaptive(model: str, prompt: str, max_tokens: int = 12000, agent: str = "", **kwargs) -> dict:
+    """
+    call_llm with a learned max_tokens. max_tokens is treated as the ceiling; if the
+    output is cut off at the tighter limit, it is continued (not restarted) up to the ceiling.
+    """
+    endpoint = CURRENT_ENDPOINT.get() or "internal"
+    limit = _per_call_limit(endpoint, agent, model, max_tokens)
+    res = call_llm_continued(model, prompt, max_tokens=max_tokens, per_call=limit, **kwargs)
+    if "text" in res:
+        tokens = (res.get("usage") or {}).get("completion_tokens") or len(res["text"]) // 4
+        record_output_length(endpoint, agent, model, tokens)
+    return res
+
+
+def gemini_config(temperature: float, max_tokens: int, response_schema: dict = None) -> dict:
+    """Build a google-genai generation config, optionally requesting JSON output."""
+    config = {
+        "temperature": float(temperature),
+        "max_output_tokens": int(max_tokens),
+    }
+    if response_schema:
+        config["response_mime_type"] = "application/json"
+        config["response_schema"] = _strip_schema_keys(response_schema, ("additionalProperties",))
+    cached = (PROMPT_CACHE.get() or {}).get("gemini")
+    if cached:
+        config["cached_content"] = cached
+    return config
+
+
+def _strip_schema_keys(schema, keys):
+    """Gemini's schema dialect rejects some JSON-schema keywords; drop them recursively."""
+    if isinstance(schema, dict):
+        return {k: _strip_schema_keys(v, keys) for k, v in schema.items() if k not in keys}
+    if isinstance(schema, list):
+        return [_strip_schema_keys(v, keys) for v in schema]
+    return schema
+
+
+# Single-flight: concurrent identical calls (double-clicks, webview retries, several
+# reviewers on one shared document) share one provider call. The key includes a
+# fingerprint of the credential in use so tenants with different keys never share.
+SINGLE_FLIGHT = os.getenv("WOW_SINGLE_FLIGHT", "1") not in ("0", "false", "off")
+
+
+# Provider registry: name -> {"prefixes", "call", "stream"}. The provider whose
+# longest prefix matches the model name handles the call; OpenAI is the fallback.
+PROVIDERS = {}
+
+
+def register_provider(name: str, prefixes: tuple, call, stream=None, probe=None):
+    """
+    Register a backend. call(model, prompt, max_tokens, temperature, response_schema)
+    returns {"text", "usage", "finish_reason"} or {"error"}; stream yields the events
+    of _stream_provider and may raise NotImplementedError to fall back to call.
+    probe(timeout) is a cheap reachability check (no tokens) that raises on failure.
+    """
+    PROVIDERS[name] = {"prefixes": tuple(prefixes), "call": call, "stream": stream, "probe": probe}
+
+
+def provider_for(model: str) -> str:
+    best, best_len = "openai", 0
+    for name, provider in PROVIDERS.items():
+        for prefix in provider["prefixes"]:
+            if model.startswith(prefix) and len(prefix) > best_len:
+                best, best_len = name, len(prefix)
+    return best
+
+
+def flight_key(model: str, prompt: str, max_tokens: int, temperature: float, response_schema: dict) -> str:
+    credential = hashlib.sha256(api_key(provider_for(model)).encode("utf-8")).hexdigest()[:16]
+    schema = json.dumps(response_schema, sort_keys=True) if response_schema else ""
+    document = (ATTACHED_FILE.get() or {}).get("uri", "")
+    cached = (PROMPT_CACHE.get() or {}).get("gemini", "")
+    return text_digest(credential, model, max_tokens, temperature, schema, document, cached, prompt)
+
+
+class SingleFlight:
+    """Run fn once per key among concurrent callers; waiters get a copy of the leader's result."""
+
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.stats = {"calls": 0, "coalesced": 0}
+
+    def do(self, key: str, fn) -> dict:
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = {"done": threading.Event(), "result": None}
+                self.stats["calls"] += 1
+            else:
+                self.stats["coalesced"] += 1
+        if not leader:
+            call["done"].wait()
+            return dict(call["result"], coalesced=True)
+        try:
+            call["result"] = fn()
+        except Exception as e:
+            call["result"] = {"error": str(e)}
+        finally:
+            with self.lock:
+                self.calls.pop(key, None)
+            call["done"].set()
+        return dict(call["result"])
+
+
+class StreamBroadcast:
+    """Events of one provider stream, pumped by a background thread and replayed to every subscriber."""
+
+    def __init__(self):
+        self.events = []
+        self.finished = False
+        self.cond = threading.Condition()
+
+    def pump(self, source, on_finish):
+        try:
+            for ev in source:
+                with self.cond:
+                    self.events.append(ev)
+                    self.cond.notify_all()
+        except Exception as e:
+            with self.cond:
+                self.events.append({"error": str(e)})
+        finally:
+            on_finish()
+            with self.cond:
+                self.finished = True
+                self.cond.notify_all()
+
+    def __iter__(self):
+        i = 0
+        while True:
+            with self.cond:
+                while i >= len(self.events) and not self.finished:
+                    self.cond.wait()
+                batch = self.events[i:]
+                if not batch and self.finished:
+                    return
+            i += len(batch)
+            yield from batch
+
+
+class StreamFlights:
+    """Single-flight for streams; the pump thread keeps going if the first subscriber disconnects."""
+
+    def __init__(self):
+        self.streams = {}
+        self.lock = threading.Lock()
+        self.stats = {"calls": 0, "coalesced": 0}
+
+    def subscribe(self, key: str, make_source) -> tuple:
+        """Returns (events, leader); leader is False for a subscriber that joined a running stream."""
+        with self.lock:
+            broadcast = self.streams.get(key)
+            leader = broadcast is None
+            if leader:
+                broadcast = self.streams[key] = StreamBroadcast()
+                self.stats["calls"] += 1
+                ctx = contextvars.copy_context()
+                done = lambda: self._finish(key, broadcast)
+                threading.Thread(
+                    target=ctx.run, args=(broadcast.pump, make_source(), done), name="stream-flight", daemon=True
+                ).start()
+            else:
+                self.stats["coalesced"] += 1
+        return iter(broadcast), leader
+
+    def _finish(self, key: str, broadcast):
+        with self.lock:
+            if self.streams.get(key) is broadcast:
+                del self.streams[key]
+
+
+CALL_FLIGHTS = SingleFlight()
+STREAM_FLIGHTS = StreamFlights()
+
+
+@traced("llm.call", lambda model, prompt, max_tokens=12000, *a, **k: {"model": model, "max_tokens": max_tokens, "prompt_chars": len(prompt)})
+def call_llm(
+    model: str,
+    prompt: str,
+    max_tokens: int = 12000,
+    temperature: float = 0.2,
+    response_schema: dict = None,
+) -> dict:
+    """
+    Budget-checked, metered LLM call (see _call_provider for the provider logic).
+    Every call is recorded in the usage ledger with tokens, latency and estimated cost.
+    """
+    model, max_tokens, error = apply_budget(model, max_tokens)
+    if error:
+        return {"error": error}
+
+    def run():
+        target = HEALTH.route(model)
+        if target is None or (pinned_to_gemini() and provider_for(target) != "gemini"):
+            return HEALTH.open_error(model)  # Gemini-side files and caches cannot fail over to another provider
+        started = time.perf_counter()
+        with span("llm.provider", provider=provider_for(target), model=target) as sp:
+            res = _call_provider(target, prompt, max_tokens, temperature, response_schema)
+            sp["attrs"].update((res.get("usage") or {}), finish_reason=res.get("finish_reason"), ok="text" in res)
+            if target != model:
+                sp["attrs"]["rerouted_from"] = model
+        latency = time.perf_counter() - started
+        HEALTH.record_result(provider_for(target), res, latency * 1000)
+        record_usage(target, res.get("usage"), latency, "text" in res, prompt, res.get("text"))
+        if "text" in res:
+            res["model"] = target
+            if target != model:
+                res["rerouted_from"] = model
+        return res
+
+    if not SINGLE_FLIGHT:
+        return run()
+    started = time.perf_counter()
+    res = CALL_FLIGHTS.do(flight_key(model, prompt, max_tokens, temperature, response_schema), run)
+    if res.get("coalesced") and "text" in res:
+        # The leader's row charged its own tenant; this tenant got the same answer
+        record_usage(res["model"], res.get("usage"), time.perf_counter() - started, True, prompt, res["text"], coalesced=True)
+    return res
+
+
+async def call_llm_async(model: str, prompt: str, max_tokens: int = 12000, temperature: float = 0.2, response_schema: dict = None) -> dict:
+    """call_llm for asyncio callers; coalesces with identical calls from threads and other tasks."""
+    import asyncio
+    ctx = contextvars.copy_context()
+    fn = functools.partial(call_llm, model, prompt, max_tokens, temperature, response_schema)
+    return await asyncio.get_running_loop().run_in_executor(None, ctx.run, fn)
+
+
+def _call_provider(
+    model: str,
+    prompt: str,
+    max_tokens: int = 12000,
+    temperature: float = 0.2,
+    response_schema: dict = None,
+) -> dict:
+    """
+    Generic LLM caller: dispatches to the provider registered for the model name.
+    - OpenAI: uses new-style client if available, falls back to ChatCompletion.
+    - Gemini: uses newer google-genai Client with models.generate_content.
+    - Local: OpenAI-compatible local server or in-process llama.cpp.
+    - response_schema: optional JSON schema; requests provider-side structured output.
+    """
+    provider = PROVIDERS.get(provider_for(model))
+    if provider is None:
+        return {"error": "Unsupported model/provider."}
+    return provider["call"](model, prompt, max_tokens, temperature, response_schema)
+
+
+def _call_openai(
+    model: str,
+    prompt: str,
+    max_tokens: int = 12000,
+    temperature: float = 0.2,
+    response_schema: dict = None,
+) -> dict:
+    """OpenAI chat completions / Responses API / legacy ChatCompletion."""
+    openai = lazy_import("openai")
+    if openai is None:
+        return {"error": "openai package not installed on server. Install the openai package."}
+    key = api_key("openai")
+    if not key:
+        return {"error": "OpenAI API key not set."}
+
+    try:
+        # New-style OpenAI client
+        if hasattr(openai, "OpenAI"):
+            client = openai_client(openai, key)
+
+            # Chat completions (preferred)
+            if hasattr(client, "chat") and hasattr(client.chat, "completions") and hasattr(
+                client.chat.completions, "create"
+            ):
+                extra = openai_cache_hint()
+                if response_schema:
+                    extra["response_format"] = {
+                        "type": "json_schema",
+                        "json_schema": {"name": "structured_output", "schema": response_schema, "strict": True},
+                    }
+                resp = client.chat.completions.create(
+                    model=model,
+                    messages=[{"role": "user", "content": prompt}],
+                    max_tokens=max_tokens,
+                    temperature=temperature,
+                    **extra,
+                )
+                try:
+                    msg = resp.choices[0].message
+                    if isinstance(msg, dict):
+                        text = msg.get("content")
+                    else:
+                        text = getattr(msg, "content", None)
+                except Exception:
+                    text = getattr(resp.choices[0], "text", None)
+                if not text:
+                    text = getattr(resp, "output_text", None) or str(resp)
+                return {"text": text, "usage": usage_from_response(resp), "finish_reason": finish_reason_of(resp)}
+
+            # Responses API fallback
+            if hasattr(client, "responses") and hasattr(client.responses, "create"):
+                extra = openai_cache_hint()
+                if response_schema:
+                    extra["text"] = {
+                        "format": {
+                            "type": "json_schema",
+                            "name": "structured_output",
+                            "schema": response_schema,
+                            "strict": True,
+                        }
+                    }
+                resp = client.responses.create(
+                    model=model,
+                    input=prompt,
+                    max_output_tokens=max_tokens,
+                    temperature=temperature,
+                    **extra,
+                )
+                text = getattr(resp, "output_text", None)
+                if not text:
+                    parts = []
+                    try:
+                        for item in getattr(resp, "output", []) or []:
+                            content = getattr(item, "content", None) or (
+                                item.get("content") if isinstance(item, dict) else None
+                            )
+                            if isinstance(content, list):
+                                for c in content:
+                                    if isinstance(c, dict) and "text" in c:
+                                        parts.append(c["text"])
+                                    elif hasattr(c, "text"):
+                                        parts.append(c.text)
+                            elif isinstance(content, str):
+                                parts.append(content)
+                    except Exception:
+                        pass
+                    if parts:
+                        text = "\n".join(parts)
+                if not text:
+                    text = str(resp)
+                return {"text": text, "usage": usage_from_response(resp), "finish_reason": finish_reason_of(resp)}
+
+        # Legacy ChatCompletion API
+        if hasattr(openai, "ChatCompletion"):
+            resp = openai.ChatCompletion.create(
+                api_key=key,
+                request_timeout=PROVIDER_TIMEOUT,
+                model=model,
+                messages=[{"role": "user", "content": prompt}],
+                max_tokens=max_tokens,
+                temperature=temperature,
+            )
+            choice = resp.choices[0]
+            meta = {"usage": usage_from_response(resp), "finish_reason": finish_reason_of(resp)}
+            if hasattr(choice, "message"):
+                return dict(meta, text=choice.message["content"])
+            return dict(meta, text=getattr(choice, "text", ""))
+
+        return {
+            "error": (
+                "Installed openai package does not expose a supported API. "
+                "Consider running `OPENAI migrate` or aligning SDK version."
+            )
+        }
+    except Exception as e:
+        msg = str(e)
+        if "ChatCompletion" in msg or "chat" in msg.lower():
+            msg += " — If you recently upgraded the OpenAI SDK, try: OPENAI migrate"
+        return {"error": msg}
+
+
+def _call_gemini(
+    model: str,
+    prompt: str,
+    max_tokens: int = 12000,
+    temperature: float = 0.2,
+    response_schema: dict = None,
+) -> dict:
+    """Gemini via google-genai models.generate_content."""
+    genai = lazy_import("google.genai")
+    if genai is None:
+        return {
+            "error": (
+                "google-genai (google.genai) not installed. "
+                "Install with: pip install google-genai"
+            )
+        }
+    key = api_key("gemini")
+    if not key:
+        return {"error": "Gemini API key not set."}
+
+    # Newer practice: explicit Client with API key, using models.generate_content
+    try:
+        client = gemini_client(genai, key)
+        resp = client.models.generate_content(
+            model=model,
+            contents=gemini_contents(genai, prompt),
+            config=gemini_config(temperature, max_tokens, response_schema),
+        )
+
+        text = getattr(resp, "text", None)
+        if not text:
+            text = getattr(resp, "output_text", None)
+        if not text:
+            text = str(resp)
+        return {"text": text, "usage": usage_from_response(resp), "finish_reason": finish_reason_of(resp)}
+
+    except Exception as e:
+        return {"error": f"Gemini call failed: {e}"}
+
+
+def stream_llm(
+    model: str,
+    prompt: str,
+    max_tokens: int = 12000,
+    temperature: float = 0.2,
+    response_schema: dict = None,
+):
+    """
+    Streaming counterpart of call_llm.
+    Yields {"delta": str} chunks, then {"done": True}; errors are yielded as {"error": str}.
+    The call is budget-checked and recorded in the usage ledger once the stream ends.
+    """
+    model, max_tokens, error = apply_budget(model, max_tokens)
+    if error:
+        yield {"error": error}
+        return
+    source = lambda: _metered_stream(model, prompt, max_tokens, temperature, response_schema)
+    if not SINGLE_FLIGHT:
+        yield from source()
+        return
+    started = time.perf_counter()
+    events, leader = STREAM_FLIGHTS.subscribe(flight_key(model, prompt, max_tokens, temperature, response_schema), source)
+    if leader:
+        yield from events
+        return
+    parts, ok = [], False
+    try:
+        for ev in events:
+            if "delta" in ev:
+                parts.append(ev["delta"])
+            ok = ok or "done" in ev
+            yield ev
+    finally:
+        if ok:
+            # Usage is not replayed to subscribers, so the charge is estimated from the text
+            record_usage(model, None, time.perf_counter() - started, True, prompt, "".join(parts), coalesced=True)
+
+
+def _metered_stream(model: str, prompt: str, max_tokens: int, temperature: float, response_schema: dict):
+    target = HEALTH.route(model)
+    if target is None or (pinned_to_gemini() and provider_for(target) != "gemini"):
+        yield HEALTH.open_error(model)
+        return
+    started = time.perf_counter()
+    usage, parts, ok, error = None, [], False, None
+    sp = start_span("llm.stream", provider=provider_for(target), model=target) if TRACE_ENABLED else None
+    try:
+        for ev in _stream_provider(target, prompt, max_tokens, temperature, response_schema):
+            if "usage" in ev:
+                usage = ev["usage"]
+                continue
+            if "delta" in ev:
+                parts.append(ev["delta"])
+            error = error or ev.get("error")
+            ok = ok or "done" in ev
+            yield ev
+    finally:
+        latency = time.perf_counter() - started
+        if sp is not None:
+            sp["attrs"].update(usage or {}, chunks=len(parts))
+            end_span(sp, error)
+        if ok or error:  # a consumer walking away mid-stream says nothing about the provider
+            HEALTH.record_result(provider_for(target), {"text": ""} if ok else {"error": error}, latency * 1000)
+        record_usage(target, usage, latency, ok, prompt, "".join(parts))
+
+
+def stream_llm_continued(model: str, prompt: str, max_tokens: int = 12000, agent: str = "", **kwargs):
+    """
+    Streaming counterpart of call_llm_adaptive: pieces from continuation calls are
+    overlap-trimmed and yielded as one stream of {"delta"} events.
+    """
+    endpoint = CURRENT_ENDPOINT.get() or "internal"
+    per_call = _per_call_limit(endpoint, agent, model, max_tokens)
+    text, produced, cur_prompt = "", 0, prompt
+    for rounds in range(CONTINUE_MAX_ROUNDS + 1):
+        limit = min(per_call, max_tokens - produced)
+        pending, finish, piece_tokens = None if rounds == 0 else "", None, None
+        start = len(text)
+        for ev in stream_llm(model, cur_prompt, max_tokens=limit, **kwargs):
+            if "error" in ev:
+                if rounds == 0:
+                    yield ev
+                    return
+                break
+            if "usage" in ev:
+                piece_tokens = ev["usage"].get("completion_tokens")
+                continue
+            if "delta" in ev:
+                if pending is None:
+                    text += ev["delta"]
+                    yield ev
+                    continue
+                # Hold back the start of a continuation until the overlap can be judged
+                pending += ev["delta"]
+                if len(pending) >= CONTINUE_OVERLAP_CHARS:
+                    delta = stitch(text, pending)
+                    text, pending = text + delta, None
+                    if delta:
+                        yield {"delta": delta}
+            if "done" in ev:
+                finish = ev.get("finish_reason")
+        if pending:
+            delta = stitch(text, pending)
+            text += delta
+            if delta:
+                yield {"delta": delta}
+        produced += piece_tokens or (len(text) - start) // 4
+        if finish != "length" or produced >= max_tokens:
+            break
+        cur_prompt = continuation_prompt(prompt, text)
+        kwargs.pop("response_schema", None)
+    record_output_length(endpoint, agent, model, produced or len(text) // 4)
+    yield {"done": True, "finish_reason": finish}
+
+
+def _stream_provider(
+    model: str,
+    prompt: str,
+    max_tokens: int = 12000,
+    temperature: float = 0.2,
+    response_schema: dict = None,
+):
+    """Provider streaming; also yields a {"usage": {...}} event when the provider reports it."""
+    provider = PROVIDERS.get(provider_for(model)) or {}
+    started = False
+    if provider.get("stream"):
+        try:
+            for ev in provider["stream"](model, prompt, max_tokens, temperature, response_schema):
+                started = True
+                yield ev
+            return
+        except NotImplementedError:
+            if started:
+                return
+            # SDK without streaming support: fall back to one non-streamed call
+        except Exception as e:
+            yield {"error": f"Streaming call failed: {e}"}
+            return
+
+    res = _call_provider(model, prompt, max_tokens, temperature, response_schema)
+    if "text" in res:
+        if res.get("usage"):
+            yield {"usage": res["usage"]}
+        yield {"delta": res["text"]}
+        yield {"done": True, "finish_reason": res.get("finish_reason")}
+    else:
+        yield {"error": res.get("error", "unknown")}
+
+
+def _stream_openai(model: str, prompt: str, max_tokens: int, temperature: float, response_schema: dict):
+    openai = lazy_import("openai")
+    if openai is None or not hasattr(openai, "OpenAI"):
+        raise NotImplementedError
+    key = api_key("openai")
+    if not key:
+        yield {"error": "OpenAI API key not set."}
+        return
+    client = openai_client(openai, key)
+    extra = openai_cache_hint()
+    if response_schema:
+        extra["response_format"] = {
+            "type": "json_schema",
+            "json_schema": {"name": "structured_output", "schema": response_schema, "strict": True},
+        }
+    stream = client.chat.completions.create(
+        model=model,
+        messages=[{"role": "user", "content": prompt}],
+        max_tokens=max_tokens,
+        temperature=temperature,
+        stream=True,
+        stream_options={"include_usage": True},
+        **extra,
+    )
+    finish = None
+    for chunk in stream:
+        if chunk.choices and getattr(chunk.choices[0].delta, "content", None):
+            yield {"delta": chunk.choices[0].delta.content}
+        if chunk.choices and chunk.choices[0].finish_reason:
+            finish = finish_reason_of(chunk)
+        if getattr(chunk, "usage", None):
+            yield {"usage": usage_from_response(chunk)}
+    yield {"done": True, "finish_reason": finish}
+
+
+def _stream_gemini(model: str, prompt: str, max_tokens: int, temperature: float, response_schema: dict):
+    genai = lazy_import("google.genai")
+    if genai is None:
+        raise NotImplementedError
+    key = api_key("gemini")
+    if not key:
+        yield {"error": "Gemini API key not set."}
+        return
+    client = gemini_client(genai, key)
+    last = None
+    for chunk in client.models.generate_content_stream(
+        model=model,
+        contents=gemini_contents(genai, prompt),
+        config=gemini_config(temperature, max_tokens, response_schema),
+    ):
+        last = chunk
+        text = getattr(chunk, "text", None)
+        if text:
+            yield {"delta": text}
+    if last is not None:
+        yield {"usage": usage_from_response(last)}
+    yield {"done": True, "finish_reason": finish_reason_of(last) if last is not None else None}
+
+
+# Native PDF input for Gemini: the original PDF is uploaded once through the Files API
+# and the returned handle is cached by content hash (per credential) until shortly
+# before it expires. Calls made inside attached_file(handle) send the file alongside
+# the prompt, so the model sees the whole document with its layout, tables and images.
+GEMINI_NATIVE_PDF = os.getenv("WOW_GEMINI_NATIVE_PDF", "1") not in ("0", "false", "off")
+GEMINI_FILE_MAX_BYTES = 50 * 1024 * 1024  # Files API limit for PDFs
+GEMINI_FILE_TTL = 48 * 3600  # Files API retention, used when the response has no expiration_time
+GEMINI_FILE_MARGIN = 600  # stop reusing a handle this many seconds before it expires
+GEMINI_FILE_WAIT = 60  # seconds to wait for an upload to leave PROCESSING
+ATTACHED_FILE = contextvars.ContextVar("attached_file", default=None)
+
+
+def file_sha256(stream) -> str:
+    """Hash an uploaded file in chunks and rewind it."""
+    h = hashlib.sha256()
+    stream.seek(0)
+    for chunk in iter(lambda: stream.read(1024 * 1024), b""):
+        h.update(chunk)
+    stream.seek(0)
+    return h.hexdigest()
+
+
+@contextmanager
+def attached_file(handle):
+    """Send handle (a GEMINI_FILES entry) with every Gemini call made inside the block."""
+    token = ATTACHED_FILE.set(handle)
+    try:
+        yield handle
+    finally:
+        try:
+            ATTACHED_FILE.reset(token)
+        except ValueError:
+            pass  # a stream generator finalized from another context
+
+
+def gemini_contents(genai, prompt: str):
+    handle = ATTACHED_FILE.get()
+    if handle is None:
+        return prompt
+    return [genai.types.Part.from_uri(file_uri=handle["uri"], mime_type=handle["mime_type"]), prompt]
+
+
+class GeminiFiles:
+    """Files API handles by (credential, sha256); concurrent uploads of one document are coalesced."""
+
+    def __init__(self):
+        self.handles = {}
+        self.lock = threading.Lock()
+        self.flights = SingleFlight()
+        self.stats = {"uploads": 0, "reused": 0, "failed": 0}
+
+    @staticmethod
+    def _key(sha: str) -> tuple:
+        return hashlib.sha256(api_key("gemini").encode("utf-8")).hexdigest()[:16], sha
+
+    def get(self, sha: str):
+        """The cached handle for a document, or None when unknown or about to expire."""
+        if not sha:
+            return None
+        key = self._key(sha)
+        with self.lock:
+            handle = self.handles.get(key)
+            if handle is not None and handle["expires"] - GEMINI_FILE_MARGIN <= time.time():
+                del self.handles[key]
+                handle = None
+        return handle
+
+    def forget(self, sha: str):
+        with self.lock:
+            self.handles.pop(self._key(sha), None)
+
+    def upload(self, stream, sha: str, name: str = "") -> dict:
+        """Return a cached handle or upload the PDF; the result has "reused", or "error" on failure."""
+        handle = self.get(sha)
+        if handle is not None:
+            self.stats["reused"] += 1
+            return dict(handle, reused=True)
+        res = self.flights.do(self._key(sha)[0] + sha, lambda: self._upload(stream, sha, name))
+        if "error" in res:
+            self.stats["failed"] += 1
+        return dict(res, reused=bool(res.get("coalesced")))
+
+    @traced("gemini.files.upload")
+    def _upload(self, stream, sha: str, name: str) -> dict:
+        genai = lazy_import("google.genai")
+        if genai is None:
+            return {"error": "google-genai (google.genai) not installed."}
+        key = api_key("gemini")
+        if not key:
+            return {"error": "Gemini API key not set."}
+        path = getattr(stream, "name", None)
+        source = path if isinstance(path, str) and os.path.exists(path) else stream
+        stream.seek(0)
+        try:
+            client = gemini_client(genai, key, timeout=PROVIDER_TIMEOUT)
+            f = client.files.upload(
+                file=source, config={"mime_type": "application/pdf", "display_name": (name or sha)[:120]}
+            )
+            deadline = time.monotonic() + GEMINI_FILE_WAIT
+            while getattr(f.state, "name", str(f.state)) == "PROCESSING" and time.monotonic() < deadline:
+                time.sleep(1)
+                f = client.files.get(name=f.name)
+            state = getattr(f.state, "name", str(f.state))
+            if state not in ("ACTIVE", "None"):
+                return {"error": f"Gemini file upload ended in state {state}."}
+        except Exception as e:
+            return {"error": f"Gemini file upload failed: {e}"}
+        finally:
+            stream.seek(0)
+        expires = f.expiration_time.timestamp() if getattr(f, "expiration_time", None) else time.time() + GEMINI_FILE_TTL
+        handle = {"sha256": sha, "name": f.name, "uri": f.uri, "mime_type": f.mime_type or "application/pdf", "expires": expires}
+        with self.lock:
+            self.handles[self._key(sha)] = handle
+        self.stats["uploads"] += 1
+        return dict(handle)
+
+
+GEMINI_FILES = GeminiFiles()
+
+
+def gemini_native(model: str) -> bool:
+    return GEMINI_NATIVE_PDF and provider_for(model) == "gemini"
+
+
+def session_document(form, model: str):
+    """The live Gemini handle for the PDF last transformed in this session, if any."""
+    if not gemini_native(model):
+        return None
+    fields = SESSIONS.get(form.get("session_id") or "") or {}
+    return GEMINI_FILES.get(fields.get("document_sha256") or "")
+
+
+def call_with_document(handle, prompt: str, note: str, fn) -> dict:
+    """fn(prompt + note) with the Gemini file attached; if that fails, fn(prompt) on the text alone."""
+    if handle is None:
+        return fn(prompt)
+    with attached_file(handle):
+        res = fn(prompt + note)
+    if "text" in res:
+        return dict(res, document=handle["sha256"])
+    GEMINI_FILES.forget(handle["sha256"])  # possibly deleted or expired early: upload afresh next time
+    return fn(prompt)
+
+
+def stream_with_document(handle, prompt: str, note: str, make_stream):
+    """Streaming counterpart of call_with_document; falls back only when nothing was streamed yet."""
+    if handle is None:
+        yield from make_stream(prompt)
+        return
+    started = False
+    with attached_file(handle):
+        for ev in make_stream(prompt + note):
+            if "error" in ev and not started:
+                break
+            started = started or "delta" in ev
+            yield ev
+        else:
+            return
+    GEMINI_FILES.forget(handle["sha256"])
+    yield from make_stream(prompt)
+
+
+# Local backend for offline / air-gapped use and short tasks: an OpenAI-compatible
+# server (llama.cpp server, Ollama, vLLM, LM Studio) at WOW_LOCAL_LLM_URL, or a small
+# quantized GGUF model run in-process on CPU with llama-cpp-python (WOW_LOCAL_MODEL_PATH).
+# Select it with the model name "local" or "local:<model id>".
+LOCAL_LLM_URL = os.getenv("WOW_LOCAL_LLM_URL", "").rstrip("/")  # e.g. http://127.0.0.1:8080/v1
+LOCAL_MODEL_PATH = os.getenv("WOW_LOCAL_MODEL_PATH", "")
+LOCAL_MODEL_NAME = os.getenv("WOW_LOCAL_MODEL_NAME", "local")
+LOCAL_N_CTX = int(os.getenv("WOW_LOCAL_N_CTX", "4096"))
+LOCAL_TIMEOUT = float(os.getenv("WOW_LOCAL_TIMEOUT", "120"))
+_LOCAL_LLAMA = {}
+_LOCAL_LLAMA_LOCK = threading.Lock()  # llama.cpp contexts are not thread-safe
+LOCAL_NOT_CONFIGURED = "No local model configured. Set WOW_LOCAL_LLM_URL or WOW_LOCAL_MODEL_PATH."
+
+
+def local_available() -> bool:
+    return bool(LOCAL_LLM_URL or LOCAL_MODEL_PATH)
+
+
+def _local_messages(prompt: str) -> list:
+    return [{"role": "user", "content": prompt}]
+
+
+def _local_http(model: str, prompt: str, max_tokens: int, temperature: float, response_schema: dict, stream: bool):
+    import urllib.request
+
+    body = {
+        "model": model.split(":", 1)[1] if ":" in model else LOCAL_MODEL_NAME,
+        "messages": _local_messages(prompt),
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+        "stream": stream,
+    }
+    if stream:
+        body["stream_options"] = {"include_usage": True}
+    if response_schema:
+        body["response_format"] = {
+            "type": "json_schema",
+            "json_schema": {"name": "structured_output", "schema": response_schema},
+        }
+    headers = {"Content-Type": "application/json"}
+    if api_key("local"):
+        headers["Authorization"] = "Bearer " + api_key("local")
+    req = urllib.request.Request(
+        LOCAL_LLM_URL + "/chat/completions", data=json.dumps(body).encode("utf-8"), headers=headers
+    )
+    return urllib.request.urlopen(req, timeout=LOCAL_TIMEOUT)
+
+
+def _local_llama():
+    if "llm" not in _LOCAL_LLAMA:
+        llama_cpp = lazy_import("llama_cpp")
+        if llama_cpp is None:
+            raise RuntimeError("llama-cpp-python not installed. Install with: pip install llama-cpp-python")
+        _LOCAL_LLAMA["llm"] = llama_cpp.Llama(
+            model_path=LOCAL_MODEL_PATH, n_ctx=LOCAL_N_CTX, n_threads=os.cpu_count(), verbose=False
+        )
+    return _LOCAL_LLAMA["llm"]
+
+
+def _llama_kwargs(max_tokens: int, temperature: float, response_schema: dict) -> dict:
+    kwargs = {"max_tokens": max_tokens, "temperature": temperature}
+    if response_schema:
+        kwargs["response_format"] = {"type": "json_object", "schema": response_schema}
+    return kwargs
+
+
+def _call_local(
+    model: str,
+    prompt: str,
+    max_tokens: int = 12000,
+    temperature: float = 0.2,
+    response_schema: dict = None,
+) -> dict:
+    """Local model via an OpenAI-compatible HTTP server or in-process llama.cpp."""
+    import urllib.error
+
+    try:
+        if LOCAL_LLM_URL:
+            with _local_http(model, prompt, max_tokens, temperature, response_schema, stream=False) as resp:
+                data = json.load(resp)
+        elif LOCAL_MODEL_PATH:
+            with _LOCAL_LLAMA_LOCK:
+                data = _local_llama().create_chat_completion(
+                    messages=_local_messages(prompt), **_llama_kwargs(max_tokens, temperature, response_schema)
+                )
+        else:
+            return {"error": LOCAL_NOT_CONFIGURED}
+    except urllib.error.HTTPError as e:
+        return {"error": f"Local LLM server returned {e.code}: {e.read()[:300].decode('utf-8', 'replace')}"}
+    except Exception as e:
+        return {"error": f"Local LLM call failed: {e}"}
+    choice = (data.get("choices") or [{}])[0]
+    text = (choice.get("message") or {}).get("content") or choice.get("text") or ""
+    return {"text": text, "usage": usage_from_response(data), "finish_reason": choice.get("finish_reason")}
+
+
+def _llama_stream(prompt: str, max_tokens: int, temperature: float, response_schema: dict):
+    """
+    Streamed llama.cpp chunks, produced on a worker thread that holds _LOCAL_LLAMA_LOCK only
+    while generating. A consumer that stops reading cannot keep the lock: closing the stream
+    stops the worker at the next chunk, and an abandoned one still finishes within max_tokens.
+    """
+    import queue
+
+    chunks, stop, done = queue.Queue(), threading.Event(), object()
+
+    def produce():
+        try:
+            with _LOCAL_LLAMA_LOCK:
+                source = _local_llama().create_chat_completion(
+                    messages=_local_messages(prompt), stream=True, **_llama_kwargs(max_tokens, temperature, response_schema)
+                )
+                try:
+                    for chunk in source:
+                        if stop.is_set():
+                            break
+                        chunks.put(chunk)
+                finally:
+                    getattr(source, "close", lambda: None)()
+        except Exception as e:
+            chunks.put(e)
+        finally:
+            chunks.put(done)
+
+    threading.Thread(target=produce, name="local-llm-stream", daemon=True).start()
+    try:
+        while True:
+            item = chunks.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
+def _stream_local(model: str, prompt: str, max_tokens: int, temperature: float, response_schema: dict):
+    def events(chunks):
+        finish = None
+        for chunk in chunks:
+            choice = (chunk.get("choices") or [{}])[0]
+            delta = (choice.get("delta") or {}).get("content") or choice.get("text")
+            if delta:
+                yield {"delta": delta}
+            finish = choice.get("finish_reason") or finish
+            if chunk.get("usage"):
+                yield {"usage": usage_from_response(chunk)}
+        yield {"done": True, "finish_reason": finish}
+
+    if LOCAL_LLM_URL:
+        with _local_http(model, prompt, max_tokens, temperature, response_schema, stream=True) as resp:
+            # Server-sent events: "data: {...}" lines terminated by "data: [DONE]"
+            lines = (raw.decode("utf-8").strip() for raw in resp)
+            payloads = (line[5:].strip() for line in lines if line.startswith("data:"))
+            yield from events(json.loads(p) for p in iter(payloads.__next__, "[DONE]"))
+    elif LOCAL_MODEL_PATH:
+        yield from events(_llama_stream(prompt, max_tokens, temperature, response_schema))
+    else:
+        raise RuntimeError(LOCAL_NOT_CONFIGURED)
+
+
+def _probe_openai(timeout: float):
+    openai = lazy_import("openai")
+    if openai is None or not hasattr(openai, "OpenAI"):
+        raise RuntimeError("openai package not installed on server.")
+    key = api_key("openai")
+    if not key:
+        raise RuntimeError("OpenAI API key not set.")
+    next(iter(openai_client(openai, key, timeout=timeout).models.list()), None)
+
+
+def _probe_gemini(timeout: float):
+    genai = lazy_import("google.genai")
+    if genai is None:
+        raise RuntimeError("google-genai (google.genai) not installed.")
+    key = api_key("gemini")
+    if not key:
+        raise RuntimeError("Gemini API key not set.")
+    next(iter(gemini_client(genai, key, timeout=timeout).models.list(config={"page_size": 1})), None)
+
+
+def _probe_local(timeout: float):
+    import urllib.request
+
+    if LOCAL_LLM_URL:
+        urllib.request.urlopen(LOCAL_LLM_URL + "/models", timeout=timeout).close()
+    elif LOCAL_MODEL_PATH:
+        if not os.path.exists(LOCAL_MODEL_PATH):
+            raise RuntimeError("Local model file not found.")
+    else:
+        raise RuntimeError("No local model configured.")
+
+
+register_provider("openai", ("gpt",), _call_openai, _stream_openai, _probe_openai)
+register_provider("gemini", ("gemini",), _call_gemini, _stream_gemini, _probe_gemini)
+register_provider("local", ("local",), _call_local, _stream_local, _probe_local)
+
+
+# Provider health: rolling latency/error statistics from real calls and cheap background
+# probes (model listing, no tokens), plus a per-provider circuit breaker. While a circuit
+# is open calls fail fast, or are rerouted to WOW_FAILOVER's model for that provider,
+# instead of waiting out an SDK timeout against a provider that is down.
+PROVIDER_TIMEOUT = float(os.getenv("WOW_PROVIDER_TIMEOUT", "120"))
+PROBE_TIMEOUT = float(os.getenv("WOW_PROBE_TIMEOUT", "5"))
+HEALTH_INTERVAL = float(os.getenv("WOW_HEALTH_INTERVAL", "60"))
+HEALTH_MONITOR = os.getenv("WOW_HEALTH_MONITOR", "1") == "1"  # background probes, started with the first request
+HEALTH_WINDOW = 300  # seconds of history in the rolling statistics
+HEALTH_FRESH = 120  # /test_llm trusts a success this recent without probing again
+BREAKER_FAILURES = 3  # consecutive failures that open the circuit
+BREAKER_ERROR_RATE = 0.5  # ... or this error rate over the window
+BREAKER_MIN_CALLS = 6
+BREAKER_COOLDOWN = float(os.getenv("WOW_BREAKER_COOLDOWN", "30"))
+FAILOVER_MODELS = json.loads(os.getenv("WOW_FAILOVER", "{}") or "{}")  # e.g. {"openai": "gemini-2.5-flash"}
+# Errors that say nothing about provider availability
+CONFIG_ERRORS = ("not set", "not installed", "Unsupported", "Monthly budget", "No local model")
+# Rejections of the caller's own request (bad key, unknown model, malformed input): the
+# provider answered, so they never count against its circuit.
+CALLER_ERRORS = re.compile(
+    r"Error code: 4(?:0[0-4]|13|22)\b|\b4(?:0[0-4]|22) [A-Z_]{4,}|Incorrect API key|API key not valid|"
+    r"invalid_api_key|UNAUTHENTICATED|PERMISSION_DENIED|INVALID_ARGUMENT|model_not_found|does not exist",
+    re.IGNORECASE,
+)
+
+
+def breaker_key(provider: str) -> str:
+    """
+    Circuits are kept per provider *and* credential: one tenant's revoked or
+    rate-limited key must not open the circuit for tenants calling with another key.
+    """
+    key = api_key(provider) if provider in API_KEYS else ""
+    if not key:
+        return provider
+    return f"{provider}#{hashlib.sha256(key.encode('utf-8')).hexdigest()[:12]}"
+
+
+def provider_error(error: str) -> bool:
+    """True when an error says something about the provider's availability."""
+    return bool(error) and not any(m in error for m in CONFIG_ERRORS) and not CALLER_ERRORS.search(error)
+
+
+def openai_client(openai, key: str, timeout: float = None):
+    return openai.OpenAI(api_key=key, timeout=timeout or PROVIDER_TIMEOUT, max_retries=1)
+
+
+def gemini_client(genai, key: str, timeout: float = None):
+    try:
+        return genai.Client(api_key=key, http_options={"timeout": int((timeout or PROVIDER_TIMEOUT) * 1000)})
+    except TypeError:
+        return genai.Client(api_key=key)
+
+
+class ProviderHealth:
+    """
+    Rolling per-provider statistics and a closed / open / half_open circuit breaker,
+    keyed by breaker_key() so each credential has its own circuit.
+    """
+
+    def __init__(self):
+        from collections import deque
+
+        self.lock = threading.Lock()
+        self.samples = {}  # provider -> deque of (ts, ok, latency_ms)
+        self.state = {}  # provider -> {"circuit", "opened_at", "failures", "last_ok", "last_error", ...}
+        self._deque = lambda: deque(maxlen=500)
+        self.monitor = None
+
+    def _entry(self, provider: str) -> dict:
+        return self.state.setdefault(
+            provider,
+            {"circuit": "closed", "opened_at": 0.0, "failures": 0, "last_ok": None, "last_error": None,
+             "last_probe": None, "trial": False},
+        )
+
+    def record(self, provider: str, ok: bool, latency_ms: float, error: str = None, probe: bool = False):
+        provider = breaker_key(provider)
+        now = time.time()
+        with self.lock:
+            self.samples.setdefault(provider, self._deque()).append((now, ok, latency_ms))
+            st = self._entry(provider)
+            st["trial"] = False
+            if probe:
+                st["last_probe"] = now
+            if ok:
+                st.update(failures=0, last_ok=now, circuit="closed")
+                return
+            st["failures"] += 1
+            st["last_error"] = {"at": now, "error": (error or "")[:300]}
+            recent = [s for s in self.samples[provider] if s[0] >= now - HEALTH_WINDOW]
+            errors = sum(1 for s in recent if not s[1])
+            if (
+                st["circuit"] == "half_open"
+                or st["failures"] >= BREAKER_FAILURES
+                or (len(recent) >= BREAKER_MIN_CALLS and errors / len(recent) >= BREAKER_ERROR_RATE)
+            ):
+                st.update(circuit="open", opened_at=now)
+
+    def record_result(self, provider: str, res: dict, latency_ms: float):
+        error = res.get("error")
+        if error and not provider_error(error):
+            with self.lock:
+                self._entry(breaker_key(provider))["trial"] = False
+            return
+        self.record(provider, "text" in res, latency_ms, error)
+
+    def allow(self, provider: str) -> bool:
+        """False while the circuit is open; after the cooldown one trial call is let through."""
+        with self.lock:
+            st = self._entry(breaker_key(provider))
+            if st["circuit"] == "closed":
+                return True
+            if st["circuit"] == "open" and time.time() - st["opened_at"] >= BREAKER_COOLDOWN:
+                st["circuit"] = "half_open"
+            if st["circuit"] == "half_open" and not st["trial"]:
+                st["trial"] = True
+                return True
+            return False
+
+    def route(self, model: str):
+        """Model to call: the requested one, its failover while its circuit is open, or None (fail fast)."""
+        provider = provider_for(model)
+        if self.allow(provider):
+            return model
+        fallback = FAILOVER_MODELS.get(provider)
+        if fallback and provider_for(fallback) != provider and self.allow(provider_for(fallback)):
+            return fallback
+        return None
+
+    def open_error(self, model: str) -> dict:
+        provider = provider_for(model)
+        with self.lock:
+            st = self._entry(breaker_key(provider))
+            retry = max(0, int(BREAKER_COOLDOWN - (time.time() - st["opened_at"])))
+        return {"error": f"{provider} is currently unavailable (retry in ~{retry}s).", "circuit_open": True}
+
+    def snapshot(self, provider: str) -> dict:
+        """Health of provider as seen with the current tenant's credential (error text omitted)."""
+        key = breaker_key(provider)
+        now = time.time()
+        with self.lock:
+            st = dict(self._entry(key))
+            recent = [s for s in self.samples.get(key, ()) if s[0] >= now - HEALTH_WINDOW]
+        latencies = sorted(s[2] for s in recent if s[1])
+        st.pop("trial", None)
+        st["last_error"] = (st["last_error"] or {}).get("at")
+        return dict(
+            st,
+            provider=provider,
+            calls=len(recent),
+            error_rate=round(sum(1 for s in recent if not s[1]) / len(recent), 3) if recent else None,
+            p50_ms=round(latencies[len(latencies) // 2], 1) if latencies else None,
+            p95_ms=round(latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))], 1) if latencies else None,
+        )
+
+    def probe(self, provider: str) -> dict:
+        probe = (PROVIDERS.get(provider) or {}).get("probe")
+        if probe is None:
+            return {"ok": False, "error": "No probe for provider."}
+        started = time.perf_counter()
+        try:
+            probe(PROBE_TIMEOUT)
+        except Exception as e:
+            error = str(e)
+            if provider_error(error):
+                self.record(provider, False, (time.perf_counter() - started) * 1000, error, probe=True)
+            return {"ok": False, "error": error}
+        latency = (time.perf_counter() - started) * 1000
+        self.record(provider, True, latency, probe=True)
+        return {"ok": True, "latency_ms": round(latency, 1)}
+
+    def start(self, interval: float = HEALTH_INTERVAL):
+        """Probe every configured provider in a daemon thread (idempotent)."""
+        if self.monitor is not None:
+            return
+        with self.lock:
+            if self.monitor is not None or interval <= 0:
+                return
+            self.monitor = threading.Thread(target=self._loop, args=(interval,), name="health-monitor", daemon=True)
+        self.monitor.start()
+
+    def _loop(self, interval: float):
+        # Runs in the default tenant context, so probes only speak for the server's own keys;
+        # tenants with their own keys have separate circuits fed by their real calls.
+        while True:
+            for provider in list(PROVIDERS):
+                configured = api_key(provider) if provider != "local" else local_available()
+                if configured:
+                    self.probe(provider)
+            time.sleep(interval)
+
+
+HEALTH = ProviderHealth()
+
+
+# Cheap tasks (connection tests, note formatting) can be pinned to an inexpensive or
+# local model by the operator, e.g. WOW_CHEAP_MODEL=local.
+CHEAP_MODEL = os.getenv("WOW_CHEAP_MODEL", "")
+CHEAP_TASKS = {t.strip() for t in os.getenv("WOW_CHEAP_TASKS", "test_llm,transform_note").split(",") if t.strip()}
+
+
+def task_model(form, default: str = "gpt-4o-mini") -> str:
+    """Model for the current operation: WOW_CHEAP_MODEL for cheap tasks, else the form's choice."""
+    if CHEAP_MODEL and (CURRENT_ENDPOINT.get() or "") in CHEAP_TASKS:
+        return CHEAP_MODEL
+    return form.get("model") or default
+
+
+class JSONStreamParser:
+    """
+    Incremental parser for a streamed JSON object.
+    feed() returns (key, value) pairs as soon as they are complete: top-level
+    scalars (strings, numbers, booleans, null) and individual elements of
+    top-level arrays. Nested objects are only available from result().
+    """
+
+    def __init__(self):
+        self.buf = ""
+        self.pos = 0
+        self.stack = []  # open brackets, outermost first
+        self.in_str = False
+        self.esc = False
+        self.expect_key = False
+        self.key = None
+        self.start = None  # start of a string being read, if it is emitted
+        self.item = None  # start of an object / array inside a top-level array
+        self.literal = None  # start of a number / true / false / null being read
+
+    def _value_position(self) -> bool:
+        """Whether a value starting here is a top-level value or a top-level array element."""
+        depth = len(self.stack)
+        return (depth == 1 and not self.expect_key) or (depth == 2 and self.stack[1] == "[")
+
+    def feed(self, text: str) -> list:
+        out = []
+        self.buf += text
+        while self.pos < len(self.buf):
+            i, ch = self.pos, self.buf[self.pos]
+            self.pos += 1
+            if self.in_str:
+                if self.esc:
+                    self.esc = False
+                elif ch == "\\":
+                    self.esc = True
+                elif ch == '"':
+                    self.in_str = False
+                    if self.start is None:
+                        pass
+                    elif len(self.stack) == 1 and self.expect_key:
+                        self.key = json.loads(self.buf[self.start:i + 1])
+                    else:
+                        out.append((self.key, json.loads(self.buf[self.start:i + 1])))
+                continue
+            if self.literal is not None:
+                if ch not in ",}] \t\r\n":
+                    continue
+                out.append((self.key, json.loads(self.buf[self.literal:i])))
+                self.literal = None
+            if ch == '"':
+                self.in_str = True
+                self.start = i if (len(self.stack) == 1 and self.expect_key) or self._value_position() else None
+            elif ch in "{[":
+                if len(self.stack) == 2 and self.stack[1] == "[":
+                    self.item = i
+                self.stack.append(ch)
+                if len(self.stack) == 1:
+                    self.expect_key = True
+            elif ch in "}]":
+                if len(self.stack) == 3 and self.stack[1] == "[":
+                    out.append((self.key, json.loads(self.buf[self.item:i + 1])))
+                if self.stack:
+                    self.stack.pop()
+            elif len(self.stack) == 1 and ch == ",":
+                self.expect_key = True
+            elif len(self.stack) == 1 and ch == ":":
+                self.expect_key = False
+            elif ch not in ", \t\r\n" and self._value_position():
+                self.literal = i
+        return out
+
+    def result(self):
+        """Parse the complete buffer (tolerating markdown code fences)."""
+        return parse_json_output(self.buf)
+
+
+def parse_json_output(text: str):
+    """Parse model JSON output, tolerating surrounding prose or ``` fences."""
+    text = (text or "").strip()
+    try:
+        return json.loads(text)
+    except Exception:
+        pass
+    start, end = text.find("{"), text.rfind("}")
+    if start == -1 or end <= start:
+        raise ValueError("Model did not return a JSON object.")
+    return json.loads(text[start:end + 1])
+
+
+def render_review_markdown(report: dict) -> str:
+    """Render a structured review report (REVIEW_SCHEMA) as markdown."""
+    status_labels = {
+        "met": "✅ Met",
+        "partially_met": "⚠️ Partially met",
+        "not_met": "❌ Not met",
+        "not_applicable": "➖ N/A",
+    }
+    out = ["# Review Report"]
+    if report.get("summary"):
+        out += ["", "## Summary", "", report["summary"].strip()]
+    findings = report.get("findings") or []
+    if findings:
+        out += ["", "## Findings", "", "| Checklist item | Status | Detail | Page |", "|---|---|---|---|"]
+        for f in findings:
+            cells = [
+                f.get("checklist_item", ""),
+                status_labels.get(f.get("status"), f.get("status", "")),
+                f.get("detail", ""),
+                f.get("page", ""),
+            ]
+            out.append("| " + " | ".join(str(c).replace("|", "\\|").replace("\n", " ") for c in cells) + " |")
+    for title, key in (("Recommended Actions", "actions"), ("Missing Documents", "missing_documents")):
+        items = report.get(key) or []
+        if items:
+            out += ["", f"## {title}", ""] + [f"- {item}" for item in items]
+    return "\n".join(out) + "\n"
+
+
+# Server-side session workspaces: the browser sends short ids, field references
+# and small text deltas instead of re-posting full submissions on every call.
+SESSION_MAX_CHARS = int(os.getenv("WOW_SESSION_MAX_CHARS", str(32 * 1024 * 1024)))
+SESSION_TTL = int(os.getenv("WOW_SESSION_TTL", str(7 * 24 * 3600)))
+SESSION_DIR = os.getenv("WOW_SESSION_DIR") or os.path.join(DATA_DIR, ".sessions")
+SESSION_ID_RE = re.compile(r"^[A-Za-z0-9_-]{4,32}$")
+
+
+class SessionStore:
+    """
+    In-memory session workspaces bounded by total text size.
+    Least recently used sessions are spilled to SESSION_DIR as JSON and
+    transparently reloaded on access.
+    """
+
+    def __init__(self, max_chars: int, spill_dir: str):
+        self.max_chars = max_chars
+        self.spill_dir = spill_dir
+        self.sessions = {}  # sid -> {"fields": {...}, "touched": ts}; dict order = LRU order
+        self.size = 0
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def _weight(fields: dict) -> int:
+        return sum(len(v) for v in fields.values() if isinstance(v, str))
+
+    def _path(self, sid: str) -> str:
+        return os.path.join(self.spill_dir, sid + ".json")
+
+    def create(self) -> str:
+        with self.lock:
+            sid = secrets.token_urlsafe(6)
+            while sid in self.sessions or os.path.exists(self._path(sid)):
+                sid = secrets.token_urlsafe(6)
+            self.sessions[sid] = {"fields": {}, "owner": CURRENT_TENANT.get(), "touched": time.time()}
+            self._sweep_disk()
+            return sid
+
+    def get(self, sid: str):
+        """
+        Return the session's fields dict (loading it back from disk if spilled), or None.
+        A session belongs to the tenant that created it; other tenants get None.
+        """
+        if not sid or not SESSION_ID_RE.match(sid):
+            return None
+        tenant = CURRENT_TENANT.get()
+        with self.lock:
+            entry = self.sessions.get(sid)
+            if entry is None:
+                try:
+                    with open(self._path(sid), "r", encoding="utf-8") as f:
+                        spilled = json.load(f)
+                    if spilled.get("owner") != tenant:
+                        return None
+                    entry = {"fields": spilled["fields"], "owner": tenant, "touched": 0}
+                    os.remove(self._path(sid))
+                except Exception:
+                    return None
+                self.size += self._weight(entry["fields"])
+            elif entry["owner"] != tenant:
+                return None
+            else:
+                del self.sessions[sid]
+            entry["touched"] = time.time()
+            self.sessions[sid] = entry
+            self._evict(keep=sid)
+            return entry["fields"]
+
+    def update(self, sid: str, fields: dict = None, deltas: list = None) -> dict:
+        """
+        Set whole fields and/or apply splice deltas ({"field", "start", "end", "text", "base_len"}).
+        Raises KeyError for unknown sessions and ValueError when a delta does not apply.
+        """
+        with self.lock:
+            current = self.get(sid)
+            if current is None:
+                raise KeyError(sid)
+            before = self._weight(current)
+            for name, value in (fields or {}).items():
+                current[name] = "" if value is None else str(value)
+            for d in deltas or []:
+                name = d.get("field")
+                old = current.get(name, "")
+                start, end = int(d.get("start", 0)), int(d.get("end", 0))
+                if d.get("base_len") is not None and int(d["base_len"]) != len(old):
+                    raise ValueError(f"Delta for {name} does not match server copy.")
+                if not 0 <= start <= end <= len(old):
+                    raise ValueError(f"Delta range out of bounds for {name}.")
+                current[name] = old[:start] + (d.get("text") or "") + old[end:]
+            self.size += self._weight(current) - before
+            self._evict(keep=sid)
+            return {k: len(v) for k, v in current.items() if isinstance(v, str)}
+
+    def _evict(self, keep: str = None):
+        """Spill least recently used sessions to disk until under the memory budget."""
+        for sid in list(self.sessions):
+            if self.size <= self.max_chars:
+                break
+            if sid == keep:
+                continue
+            entry = self.sessions.pop(sid)
+            try:
+                os.makedirs(self.spill_dir, exist_ok=True)
+                with open(self._path(sid), "w", encoding="utf-8") as f:
+                    json.dump({"owner": entry["owner"], "fields": entry["fields"]}, f)
+            except Exception:
+                pass
+            self.size -= self._weight(entry["fields"])
+
+    def _sweep_disk(self):
+        """Delete spilled sessions older than SESSION_TTL."""
+        try:
+            cutoff = time.time() - SESSION_TTL
+            for name in os.listdir(self.spill_dir):
+                path = os.path.join(self.spill_dir, name)
+                if name.endswith(".json") and os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+        except Exception:
+            pass
+
+
+SESSIONS = SessionStore(SESSION_MAX_CHARS, SESSION_DIR)
+
+
+def form_text(form, name: str, default: str = "", limit: int = None) -> str:
+    """
+    Read a text input from the form, or from the session workspace when the
+    client sends `<name>_ref` (a session field name) together with session_id.
+    With a limit, at most that many characters are materialized (spooled fields
+    are read from disk only up to the limit).
+    """
+    ref = form.get(name + "_ref")
+    if ref:
+        fields = SESSIONS.get(form.get("session_id") or "")
+        if fields is not None and ref in fields:
+            return fields[ref] if limit is None else fields[ref][:limit]
+    value = form.get(name, default)
+    if isinstance(value, SpooledField):
+        return value.read(limit)
+    return value if limit is None else value[:limit]
+
+
+def read_upload_text(f, limit: int) -> str:
+    """Decode at most `limit` characters of an uploaded text file."""
+    try:
+        return f.stream.read(limit * 4).decode("utf-8", "ignore")[:limit]
+    except Exception:
+        return ""
+
+
+def open_pdf(fitz, stream):
+    """Open an uploaded PDF by path when it was spooled to disk, avoiding a full in-memory copy."""
+    path = getattr(stream, "name", None)
+    if isinstance(path, str) and os.path.exists(path):
+        try:
+            return fitz.open(path, filetype="pdf")
+        except Exception:
+            stream.seek(0)
+    return fitz.open(stream=stream.read(), filetype="pdf")
+
+
+def remember_result(form, kind: str, text: str, source: str = ""):
+    """
+    Store a result in the caller's session workspace (if any) as `<kind>_result`,
+    and in the searchable archive. source is the document the result was derived
+    from; its hash lets the archive be filtered by document.
+    """
+    sid = form.get("session_id")
+    if sid:
+        try:
+            SESSIONS.update(sid, fields={kind + "_result": text})
+        except KeyError:
+            pass
+    archive_result(
+        kind,
+        text,
+        model=form.get("model") or "",
+        agent=str(form.get("agent_id") or ""),
+        doc_hash=hashlib.sha256(source.encode("utf-8")).hexdigest()[:16] if source else "",
+        doc_id=(form.get("doc_id") or "").strip(),
+        session_id=sid or "",
+    )
+
+
+# Result archive: every transform, review, note and agent output is kept in SQLite
+# with an FTS5 index so past answers can be found instead of re-run.
+ARCHIVE_ENABLED = os.getenv("WOW_ARCHIVE", "1") not in ("0", "false", "off")
+ARCHIVE_DB = os.getenv("WOW_ARCHIVE_DB", os.path.join(DATA_DIR, "archive.db"))
+ARCHIVE_LOCK = threading.Lock()
+_ARCHIVE_CONN = None
+
+ARCHIVE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts REAL NOT NULL,
+    day TEXT NOT NULL,
+    tenant TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    endpoint TEXT NOT NULL,
+    model TEXT NOT NULL,
+    agent TEXT NOT NULL,
+    doc_hash TEXT NOT NULL,
+    doc_id TEXT NOT NULL,
+    session_id TEXT NOT NULL,
+    title TEXT NOT NULL,
+    text TEXT NOT NULL,
+    text_hash TEXT NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS results_dedup ON results (tenant, kind, text_hash);
+CREATE INDEX IF NOT EXISTS results_filter ON results (tenant, kind, day);
+CREATE INDEX IF NOT EXISTS results_doc ON results (doc_hash);
+CREATE VIRTUAL TABLE IF NOT EXISTS results_fts USING fts5(
+    title, text, content='results', content_rowid='id', tokenize='porter unicode61'
+);
+CREATE TRIGGER IF NOT EXISTS results_ai AFTER INSERT ON results BEGIN
+    INSERT INTO results_fts (rowid, title, text) VALUES (new.id, new.title, new.text);
+END;
+CREATE TRIGGER IF NOT EXISTS results_ad AFTER DELETE ON results BEGIN
+    INSERT INTO results_fts (results_fts, rowid, title, text) VALUES ('delete', old.id, old.title, old.text);
+END;
+"""
+
+
+def archive_conn():
+    """Shared SQLite connection for the archive (created on first use)."""
+    global _ARCHIVE_CONN
+    if _ARCHIVE_CONN is None:
+        import sqlite3
+
+        os.makedirs(os.path.dirname(ARCHIVE_DB) or ".", exist_ok=True)
+        conn = sqlite3.connect(ARCHIVE_DB, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(ARCHIVE_SCHEMA)
+        _ARCHIVE_CONN = conn
+    return _ARCHIVE_CONN
+
+
+def _result_title(text: str) -> str:
+    for line in text.splitlines():
+        line = re.sub(r"<[^>]+>", "", line).strip("#*-> \t")
+        if line:
+            return line[:120]
+    return ""
+
+
+def archive_result(kind: str, text: str, model: str = "", agent: str = "", doc_hash: str = "", doc_id: str = "", session_id: str = ""):
+    if not ARCHIVE_ENABLED or not (text or "").strip():
+        return
+    now = time.time()
+    try:
+        with ARCHIVE_LOCK:
+            conn = archive_conn()
+            conn.execute(
+                "INSERT OR IGNORE INTO results (ts, day, tenant, kind, endpoint, model, agent, doc_hash, doc_id, "
+                "session_id, title, text, text_hash) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    now,
+                    time.strftime("%Y-%m-%d", time.gmtime(now)),
+                    CURRENT_TENANT.get(),
+                    kind,
+                    CURRENT_ENDPOINT.get() or "",
+                    model,
+                    agent,
+                    doc_hash,
+                    doc_id,
+                    session_id,
+                    _result_title(text),
+                    text,
+                    text_digest(text),
+                ),
+            )
+            conn.commit()
+    except Exception as e:
+        app.logger.warning("archive write failed: %s", e)
+
+
+def fts_query(q: str) -> str:
+    """Turn free text into a safe FTS5 query: quoted terms (AND), keeping trailing * as prefix search."""
+    terms = re.findall(r"[\w][\w()\-.]*\*?", q)
+    return " ".join('"%s"%s' % (t.rstrip("*").replace('"', ""), "*" if t.endswith("*") else "") for t in terms)
+
+
+def search_archive(q: str = "", filters: dict = None, limit: int = 20) -> list:
+    """
+    Search the caller's archived results; filters: kind, model, agent, doc_hash, doc_id, since, until.
+    "The caller" is the server-issued tenant, which outlives sessions (see bind_tenant).
+    """
+    filters = filters or {}
+    match = fts_query(q)
+    if match:
+        sql = (
+            "SELECT r.id, r.ts, r.day, r.kind, r.endpoint, r.model, r.agent, r.doc_hash, r.doc_id, r.title, "
+            "snippet(results_fts, 1, '<mark>', '</mark>', '…', 16) AS snippet, bm25(results_fts) AS rank "
+            "FROM results_fts JOIN results r ON r.id = results_fts.rowid WHERE results_fts MATCH ? AND r.tenant = ?"
+        )
+        args = [match, CURRENT_TENANT.get()]
+    else:
+        sql = (
+            "SELECT r.id, r.ts, r.day, r.kind, r.endpoint, r.model, r.agent, r.doc_hash, r.doc_id, r.title, "
+            "substr(r.text, 1, 200) AS snippet, 0 AS rank FROM results r WHERE r.tenant = ?"
+        )
+        args = [CURRENT_TENANT.get()]
+    for col in ("kind", "model", "agent", "doc_hash", "doc_id"):
+        if filters.get(col):
+            sql += f" AND r.{col} = ?"
+            args.append(filters[col])
+    if filters.get("since"):
+        sql += " AND r.day >= ?"
+        args.append(filters["since"])
+    if filters.get("until"):
+        sql += " AND r.day <= ?"
+        args.append(filters["until"])
+    sql += (" ORDER BY rank, r.ts DESC" if match else " ORDER BY r.ts DESC") + " LIMIT ?"
+    args.append(max(1, min(int(limit), 200)))
+    with ARCHIVE_LOCK:
+        return [dict(r) for r in archive_conn().execute(sql, args).fetchall()]
+
+
+# Near-duplicate cache for note prompts: notes are fingerprinted with a 64-bit
+# SimHash over word shingles so that "same note, one line edited" still hits.
+NOTE_CACHE_SIMILARITY = float(os.getenv("WOW_NOTE_CACHE_SIMILARITY", "0.9"))
+NOTE_CACHE_MODE = os.getenv("WOW_NOTE_CACHE_MODE", "update")  # update | reuse | off
+# tenant: entries are only visible to the tenant that created them. shared (opt-in):
+# identical notes hit across tenants, near matches still never cross tenants.
+NOTE_CACHE_SCOPE = os.getenv("WOW_NOTE_CACHE_SCOPE", "tenant")  # tenant | shared
+NOTE_CACHE_MAX = 512
+
+NOTE_UPDATE_PROMPT = (
+    "You previously produced the RESULT below for an earlier version of a note, following the "
+    "INSTRUCTIONS. The note has since changed as shown in the unified DIFF. Return the full "
+    "updated result reflecting these changes, keeping everything else as it is."
+)
+
+
+def simhash(text: str) -> int:
+    """64-bit SimHash over 3-word shingles."""
+    words = re.findall(r"\w+", text.lower())
+    shingles = [" ".join(words[i:i + 3]) for i in range(max(1, len(words) - 2))] if words else [""]
+    weights = [0] * 64
+    for sh in shingles:
+        h = int.from_bytes(hashlib.blake2b(sh.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(64):
+            weights[bit] += 1 if (h >> bit) & 1 else -1
+    return sum(1 << bit for bit in range(64) if weights[bit] > 0)
+
+
+def simhash_similarity(a: int, b: int) -> float:
+    return 1.0 - bin(a ^ b).count("1") / 64.0
+
+
+class NearDuplicateCache:
+    """Bounded cache of (context key, note fingerprint) -> output (and owning tenant), matched by SimHash similarity."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.entries = []  # oldest first
+        self.lock = threading.Lock()
+
+    def lookup(self, key: str, note: str, threshold: float, owner: str = None):
+        """
+        Return (entry, similarity) for the closest note above threshold, or (None, 0.0).
+        With owner set, only that owner's entries are considered for near matches.
+        """
+        fp = simhash(note)
+        best, best_sim = None, 0.0
+        with self.lock:
+            for entry in self.entries:
+                if entry["key"] != key:
+                    continue
+                if entry["note"] == note:
+                    return entry, 1.0
+                if owner is not None and entry["owner"] != owner:
+                    continue
+                sim = simhash_similarity(fp, entry["fp"])
+                if sim >= threshold and sim > best_sim:
+                    best, best_sim = entry, sim
+        return best, best_sim
+
+    def store(self, key: str, note: str, output: str, owner: str = ""):
+        with self.lock:
+            self.entries = [e for e in self.entries if not (e["key"] == key and e["note"] == note)]
+            self.entries.append({"key": key, "note": note, "fp": simhash(note), "output": output, "owner": owner})
+            del self.entries[:-self.max_entries]
+
+
+NOTE_CACHE = NearDuplicateCache(NOTE_CACHE_MAX)
+
+
+def call_llm_for_note(endpoint: str, model: str, instructions: str, note: str, prompt: str, max_tokens: int) -> dict:
+    """
+    call_llm with the near-duplicate note cache in front of it.
+    - identical note: prior output is returned
+    - similar note: a diff-based update prompt is sent (or the prior output reused in "reuse" mode)
+    The result carries "cache": "exact" | "near" | "miss".
+    """
+    if NOTE_CACHE_MODE == "off":
+        return call_llm_adaptive(model, prompt, max_tokens=max_tokens)
+    tenant = CURRENT_TENANT.get()
+    scope = "" if NOTE_CACHE_SCOPE == "shared" else tenant
+    key = text_digest(scope, endpoint, model, instructions)
+    entry, similarity = NOTE_CACHE.lookup(key, note, NOTE_CACHE_SIMILARITY, owner=tenant)
+
+    if entry is not None and similarity >= 1.0 and entry["note"] == note:
+        return {"text": entry["output"], "cache": "exact"}
+
+    if entry is not None and NOTE_CACHE_MODE == "reuse":
+        return {"text": entry["output"], "cache": "near", "similarity": round(similarity, 3)}
+
+    if entry is not None:
+        import difflib
+
+        diff = "\n".join(
+            difflib.unified_diff(entry["note"].splitlines(), note.splitlines(), "before", "after", n=1, lineterm="")
+        )
+        # Only worth it when the diff is clearly smaller than the note itself
+        if len(diff) < 0.6 * len(note):
+            update_prompt = (
+                NOTE_UPDATE_PROMPT
+                + "\n\nINSTRUCTIONS:\n" + instructions
+                + "\n\nDIFF:\n" + diff
+                + "\n\nRESULT:\n" + entry["output"]
+            )
+            res = call_llm_adaptive(model, update_prompt, max_tokens=max_tokens)
+            if "text" in res:
+                NOTE_CACHE.store(key, note, res["text"], tenant)
+                res.update(cache="near", similarity=round(similarity, 3))
+            return res
+
+    res = call_llm_adaptive(model, prompt, max_tokens=max_tokens)
     if "text" in res:
-        return jsonify({"result": res["text"]})
-    return jsonify({"error": res.get("error", "unknown")}), 500
+        NOTE_CACHE.store(key, note, res["text"], tenant)
+        res["cache"] = "miss"
+    return res
+
+
+# Local keyword extraction: RAKE candidate phrases scored with TF-IDF over the note's
+# paragraphs and boosted by a 510(k) vocabulary. The server adds the coral highlight
+# spans and the keyword summary, so the model no longer spends output tokens on them.
+KEYWORD_TOP_N = int(os.getenv("WOW_NOTE_KEYWORDS", "12"))
+KEYWORD_SPAN = '<span style="color:coral">{}</span>'
+REGULATORY_TERMS = (
+    "510(k)", "traditional 510(k)", "special 510(k)", "abbreviated 510(k)", "De Novo", "PMA",
+    "substantial equivalence", "substantially equivalent", "predicate device", "reference device",
+    "indications for use", "intended use", "technological characteristics", "product code",
+    "device classification", "Class I", "Class II", "Class III", "special controls", "eSTAR",
+    "refuse to accept", "additional information", "deficiency", "pre-submission", "Q-Sub",
+    "biocompatibility", "ISO 10993", "sterilization", "sterility assurance", "shelf life",
+    "electrical safety", "electromagnetic compatibility", "EMC", "IEC 60601", "IEC 62304",
+    "ISO 14971", "risk analysis", "risk management", "software validation", "software documentation",
+    "cybersecurity", "SBOM", "human factors", "usability", "performance testing", "bench testing",
+    "animal testing", "clinical data", "clinical study", "labeling", "instructions for use",
+    "reprocessing", "MR safety", "design controls", "verification", "validation", "FDA", "CDRH",
+)
+KEYWORD_STOPWORDS = frozenset(
+    """a about above after again against all also am an and any are as at be because been before being
+    below between both but by can could did do does doing down during each few for from further had has
+    have having he her here hers him his how i if in into is it its itself just me more most my no nor
+    not now of off on once only or other our ours out over own same she should so some such than that
+    the their theirs them then there these they this those through to too under until up very was we
+    were what when where which while who whom why will with would you your yours per via etc e.g i.e
+    need needs needed please note notes meeting discussed discuss regarding re next new one two must
+    may might shall follow following follows per asked ask asks said update updated schedule scheduled
+    action actions item items pending missing due done complete incomplete today tomorrow week monday
+    tuesday wednesday thursday friday saturday sunday""".split()
+)
+_WORD_RE = re.compile(r"[A-Za-z0-9][A-Za-z0-9()\-]*[A-Za-z0-9)]|[A-Za-z0-9]")
+_PHRASE_SPLIT_RE = re.compile(r"[.,;:!?\n\t\"“”'’|/\[\]{}<>*#=_~`]+|\s-\s")
+# Segments that must not be touched when inserting spans: code, HTML, link targets
+_PROTECTED_RE = re.compile(
+    r"(```.*?```|`[^`\n]*`|<span[^>]*>.*?</span>|<[^>]+>|\]\([^)]*\))", re.DOTALL | re.IGNORECASE
+)
 
 
-@app.route("/transform_checklist", methods=["POST"])
-def transform_checklist():
-    pasted = request.form.get("pasted", "")
-    model = request.form.get("model") or "gpt-4o-mini"
-    max_tokens = int(request.form.get("max_tokens") or 12000)
-    user_prompt = (request.form.get("user_prompt") or "").strip() or CHECKLIST_PROMPT_DEFAULT
+def _rake_phrases(text: str) -> list:
+    phrases = []
+    for chunk in _PHRASE_SPLIT_RE.split(text):
+        current = []
+        for word in _WORD_RE.findall(chunk):
+            if word.lower() in KEYWORD_STOPWORDS or word.isdigit():
+                if current:
+                    phrases.append(current)
+                current = []
+            else:
+                current.append(word)
+        if current:
+            phrases.append(current)
+    return phrases
+
+
+def extract_keywords(text: str, top_n: int = KEYWORD_TOP_N) -> list:
+    """
+    Rank keywords/keyphrases in text. Returns [{"keyword", "score", "count"}], best first.
+    Candidates are 1-3 word n-grams inside RAKE phrases; each word contributes its RAKE
+    degree/frequency weighted by TF-IDF across the note's paragraphs, repeated candidates
+    score higher, and 510(k) vocabulary terms found in the text get a boost.
+    """
+    from collections import Counter
+    import math
+
+    paragraphs = [p for p in re.split(r"\n\s*\n", text) if p.strip()] or [text]
+    doc_freq = Counter()
+    for p in paragraphs:
+        doc_freq.update({w.lower() for w in _WORD_RE.findall(p)})
+    term_freq = Counter(w.lower() for w in _WORD_RE.findall(text))
+    total = sum(term_freq.values()) or 1
+    tfidf = {
+        w: (n / total) * (1.0 + math.log((1 + len(paragraphs)) / (1 + doc_freq[w])))
+        for w, n in term_freq.items()
+    }
+    top_tfidf = max(tfidf.values() or [1.0])
+
+    phrases = _rake_phrases(text)
+    freq, degree = Counter(), Counter()
+    for p in phrases:
+        for w in p:
+            freq[w.lower()] += 1
+            degree[w.lower()] += min(len(p), 3)
+
+    def word_score(w):
+        w = w.lower()
+        return (degree[w] / freq[w]) * (0.5 + tfidf.get(w, 0.0) / top_tfidf)
+
+    counts, surface = Counter(), {}
+    for p in phrases:
+        for n in range(1, min(3, len(p)) + 1):
+            for i in range(len(p) - n + 1):
+                words = p[i:i + n]
+                key = " ".join(w.lower() for w in words)
+                counts[key] += 1
+                surface.setdefault(key, " ".join(words))
+    scores = {}
+    for key, n in counts.items():
+        word = surface[key]
+        if " " not in key and n < 2 and not (word.isupper() and len(word) > 1):
+            continue  # single words only when repeated or an acronym
+        scores[key] = sum(word_score(w) for w in key.split()) * (1 + math.log(n))
+
+    lowered = text.lower()
+    for term in REGULATORY_TERMS:
+        n = len(re.findall(r"(?<![\w-])" + re.escape(term.lower()) + r"(?![\w-])", lowered))
+        if n:
+            key = term.lower()
+            surface[key], counts[key] = term, max(counts[key], n)
+            scores[key] = scores.get(key, 0.0) + 8.0 * (1 + math.log(n))
+
+    ranked = sorted(scores, key=lambda k: (scores[k], -len(k)), reverse=True)
+    chosen = []
+    for key in ranked:
+        words = set(key.split())
+        if len(key) < 2 or any(key in c or c in key or words & set(c.split()) for c in chosen):
+            continue  # skip candidates overlapping an already chosen keyword
+        chosen.append(key)
+        if len(chosen) >= top_n:
+            break
+    return [{"keyword": surface[k], "score": round(scores[k], 3), "count": counts[k]} for k in chosen]
+
+
+def highlight_keywords(markdown: str, keywords: list) -> str:
+    """Wrap keyword occurrences in coral spans, leaving code, HTML and link targets alone."""
+    terms = sorted({k["keyword"] for k in keywords}, key=len, reverse=True)
+    if not terms:
+        return markdown
+    pattern = re.compile(
+        r"(?<![\w-])(" + "|".join(re.escape(t) for t in terms) + r")(?![\w-])", re.IGNORECASE
+    )
+    parts = _PROTECTED_RE.split(markdown)
+    for i in range(0, len(parts), 2):
+        parts[i] = pattern.sub(lambda m: KEYWORD_SPAN.format(m.group(1)), parts[i])
+    return "".join(parts)
+
+
+def keyword_summary(keywords: list) -> str:
+    lines = ["## Keyword summary", ""]
+    lines += ["- " + KEYWORD_SPAN.format(k["keyword"]) + (f" ({k['count']}×)" if k["count"] > 1 else "") for k in keywords]
+    return "\n".join(lines)
+
+
+def annotate_note(result: str, note: str) -> tuple:
+    """Add coral highlights and a keyword summary to an organized note. Returns (markdown, keywords)."""
+    keywords = extract_keywords(note)
+    if not keywords:
+        return result, []
+    text = highlight_keywords(result, keywords)
+    if "keyword summary" not in result.lower():
+        text = text.rstrip() + "\n\n" + keyword_summary(keywords) + "\n"
+    return text, keywords
+
+
+# Request-size governance. Flask would hold every text field in memory (and reject
+# fields over 500KB); here multipart fields above FORM_SPOOL_BYTES are spooled to a
+# temp file while reading and cut off at FORM_FIELD_MAX_BYTES, uploads go straight
+# to disk, and only a few large bodies are parsed at a time.
+FORM_SPOOL_BYTES = int(os.getenv("WOW_FORM_SPOOL_BYTES", str(256 * 1024)))
+FORM_FIELD_MAX_BYTES = int(os.getenv("WOW_FORM_FIELD_MAX_BYTES", str(8 * 1024 * 1024)))
+LARGE_REQUEST_BYTES = int(os.getenv("WOW_LARGE_REQUEST_BYTES", str(2 * 1024 * 1024)))
+LARGE_REQUEST_SLOTS = threading.BoundedSemaphore(int(os.getenv("WOW_LARGE_REQUEST_SLOTS", "2")))
+MEMTRACE = os.getenv("WOW_MEMTRACE", "0") in ("1", "true", "on")
+app.config["MAX_CONTENT_LENGTH"] = int(os.getenv("WOW_MAX_REQUEST_BYTES", str(256 * 1024 * 1024)))
+
+if MEMTRACE:  # tracemalloc is also started on demand by /admin/memory/snapshot
+    tracemalloc.start()
+
+
+class SpooledField:
+    """A large multipart text field kept in a temp file; read it through form_text(limit=...)."""
+
+    def __init__(self, fp, charset: str, size: int, truncated: bool):
+        self.fp = fp
+        self.charset = charset
+        self.size = size
+        self.truncated = truncated
+
+    def read(self, limit: int = None) -> str:
+        self.fp.seek(0)
+        # Up to 4 bytes per character in UTF-8; decode only what the caller will use
+        data = self.fp.read(-1 if limit is None else limit * 4)
+        text = data.decode(self.charset, "replace")
+        return text if limit is None else text[:limit]
+
+    def __str__(self):
+        return self.read()
+
+    def __len__(self):
+        return self.size
+
+
+def upload_stream_factory(total_content_length=None, content_type=None, filename=None, content_length=None):
+    """Small uploads stay in memory; anything else goes to a named temp file PyMuPDF can open by path."""
+    import io
+    import tempfile
+
+    if total_content_length is not None and total_content_length <= FORM_SPOOL_BYTES:
+        return io.BytesIO()
+    return tempfile.NamedTemporaryFile("wb+", prefix="wow-upload-")
+
+
+def _spooling_multipart_parser():
+    from werkzeug.formparser import MultiPartParser
+    from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
+    from werkzeug.datastructures import FileStorage
+
+    class SpoolingMultiPartParser(MultiPartParser):
+        """MultiPartParser that spools large text fields and truncates them while reading.
+
+        Names of fields cut at FORM_FIELD_MAX_BYTES are left in truncated_fields.
+        """
+
+        truncated_fields = ()
+
+        def parse(self, stream, boundary, content_length):
+            import io
+            import tempfile
+
+            decoder = MultipartDecoder(boundary, max_form_memory_size=None, max_parts=self.max_form_parts)
+            fields, files = [], []
+            self.truncated_fields = []
+            part, buf, size, truncated = None, None, 0, False
+            for data in iter(lambda: stream.read(self.buffer_size), b""):
+                decoder.receive_data(data)
+                event = decoder.next_event()
+                while not isinstance(event, (Epilogue, NeedData)):
+                    if isinstance(event, Field):
+                        part, buf, size, truncated = event, io.BytesIO(), 0, False
+                    elif isinstance(event, File):
+                        part, size = event, None
+                        buf = self.start_file_streaming(event, content_length)
+                    elif isinstance(event, Data):
+                        chunk = event.data
+                        if isinstance(part, File):
+                            buf.write(chunk)
+                        else:
+                            room = FORM_FIELD_MAX_BYTES - size
+                            if len(chunk) > room:
+                                chunk, truncated = chunk[:max(room, 0)], True
+                            size += len(chunk)
+                            if isinstance(buf, io.BytesIO) and size > FORM_SPOOL_BYTES:
+                                spool = tempfile.TemporaryFile("wb+", prefix="wow-field-")
+                                spool.write(buf.getbuffer())
+                                buf = spool
+                            buf.write(chunk)
+                        if not event.more_data:
+                            if isinstance(part, File):
+                                buf.seek(0)
+                                files.append((part.name, FileStorage(buf, part.filename, part.name, headers=part.headers)))
+                            else:
+                                charset = self.get_part_charset(part.headers)
+                                if isinstance(buf, io.BytesIO):
+                                    value = buf.getvalue().decode(charset, "replace")
+                                else:
+                                    value = SpooledField(buf, charset, size, truncated)
+                                if truncated:
+                                    self.truncated_fields.append(part.name)
+                                fields.append((part.name, value))
+                    event = decoder.next_event()
+            return self.cls(fields), self.cls(files)
+
+    return SpoolingMultiPartParser
+
+
+class SpoolingFormDataParser(FormDataParser):
+    truncated_fields = ()
+
+    def _parse_multipart(self, stream, mimetype, content_length, options):
+        parser = _spooling_multipart_parser()(
+            stream_factory=self.stream_factory,
+            max_form_memory_size=None,
+            max_form_parts=self.max_form_parts,
+            cls=self.cls,
+        )
+        boundary = options.get("boundary", "").encode("ascii")
+        if not boundary:
+            raise ValueError("Missing boundary")
+        form, files = parser.parse(stream, boundary, content_length)
+        self.truncated_fields = parser.truncated_fields
+        return stream, form, files
+
+
+class GovernedRequest(Request):
+    form_data_parser_class = SpoolingFormDataParser
+
+    _form_parser = None
+
+    def make_form_data_parser(self):
+        self._form_parser = super().make_form_data_parser()
+        return self._form_parser
+
+    @property
+    def truncated_fields(self) -> list:
+        """Form fields cut at FORM_FIELD_MAX_BYTES while parsing this request's body."""
+        return list(self._form_parser.truncated_fields) if self._form_parser is not None else []
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return upload_stream_factory(total_content_length, content_type, filename, content_length)
+
+
+app.request_class = GovernedRequest
+
+
+# On-demand profiling for live diagnostics (admin endpoints below, WOW_ADMIN_TOKEN).
+# Nothing runs while idle: "sampling" starts a thread that walks sys._current_frames()
+# every few ms for N seconds (all threads, wall clock, speedscope output); "cprofile"
+# profiles each request / bridge call that starts inside the window (pstats output).
+PROFILE_MAX_SECONDS = 300
+PROFILE_DEFAULT_SECONDS = 30
+PROFILE_MAX_DEPTH = 128
+MEMORY_SNAPSHOT_KEEP = 8
+MEMORY_TOP = 30
+_APP_FILE = os.path.abspath(__file__)
+
+
+class LiveProfiler:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.session = None  # the running profile, if any
+        self.last = None  # the most recent finished profile
+        self.snapshots = {}  # tracemalloc snapshots by id, oldest first
+
+    # -- CPU ---------------------------------------------------------------
+
+    def start(self, mode: str, seconds: float, interval: float, all_threads: bool = False) -> dict:
+        if mode not in ("sampling", "cprofile"):
+            raise ValueError("mode must be sampling or cprofile")
+        seconds = min(max(seconds, 0.1), PROFILE_MAX_SECONDS)
+        with self.lock:
+            if self.session is not None:
+                raise RuntimeError("A profile is already running; stop it first.")
+            sess = self.session = {
+                "id": hashlib.sha256(os.urandom(8)).hexdigest()[:12],
+                "mode": mode,
+                "started": time.time(),
+                "seconds": seconds,
+                "interval": interval,
+                "all_threads": all_threads,
+                "stop": threading.Event(),
+                "profiles": [],  # cprofile: one per finished request
+                "stacks": {},  # sampling: (thread, frames) -> samples
+                "frames": {},  # sampling: code key -> speedscope frame index
+                "samples": 0,
+            }
+        if mode == "sampling":
+            threading.Thread(target=self._sample, args=(sess,), name="profiler", daemon=True).start()
+        timer = threading.Timer(seconds, self.stop, args=(sess["id"],))
+        timer.daemon = True
+        timer.start()
+        return self.status()
+
+    def stop(self, session_id: str = None) -> dict:
+        with self.lock:
+            sess = self.session
+            if sess is None or (session_id and sess["id"] != session_id):
+                return None
+            self.session = None
+        sess["stop"].set()
+        sess["elapsed"] = round(time.time() - sess["started"], 3)
+        if sess["mode"] == "cprofile":
+            import pstats
+
+            stats = pstats.Stats()
+            for prof in sess["profiles"]:
+                stats.add(prof)
+            sess["stats"], sess["requests"] = stats, len(sess["profiles"])
+            del sess["profiles"]
+        self.last = sess
+        return self.summary(sess)
+
+    def begin(self):
+        """Start a per-request cProfile when a cprofile session is running; cheap otherwise."""
+        sess = self.session
+        if sess is None or sess["mode"] != "cprofile":
+            return None
+        import cProfile
+
+        prof = cProfile.Profile()
+        try:
+            prof.enable()
+        except ValueError:
+            return None  # another profiler is active on this thread
+        return sess, prof
+
+    def end(self, handle):
+        if handle is None:
+            return
+        sess, prof = handle
+        prof.disable()
+        with self.lock:
+            if self.session is sess:
+                sess["profiles"].append(prof)
+
+    @contextmanager
+    def profiled(self):
+        handle = self.begin()
+        try:
+            yield
+        finally:
+            self.end(handle)
+
+    def _sample(self, sess: dict):
+        import sys
+
+        me = threading.get_ident()
+        frames, stacks = sess["frames"], sess["stacks"]
+        while not sess["stop"].wait(sess["interval"]):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack, ours = [], sess["all_threads"]
+                while frame is not None and len(stack) < PROFILE_MAX_DEPTH:
+                    code = frame.f_code
+                    key = (code.co_name, code.co_filename, code.co_firstlineno)
+                    if key not in frames:
+                        frames[key] = len(frames)
+                    stack.append(frames[key])
+                    ours = ours or code.co_filename == _APP_FILE
+                    frame = frame.f_back
+                # Threads that are not running app code (server accept loop, idle pools) are skipped
+                if ours:
+                    k = (names.get(ident, str(ident)), tuple(reversed(stack)))
+                    stacks[k] = stacks.get(k, 0) + 1
+            sess["samples"] += 1
+
+    def status(self) -> dict:
+        sess = self.session
+        return {
+            "running": None if sess is None else {
+                "id": sess["id"],
+                "mode": sess["mode"],
+                "elapsed": round(time.time() - sess["started"], 3),
+                "seconds": sess["seconds"],
+            },
+            "last": None if self.last is None else self.summary(self.last),
+        }
+
+    def summary(self, sess: dict) -> dict:
+        out = {k: sess.get(k) for k in ("id", "mode", "started", "elapsed", "interval")}
+        if sess["mode"] == "cprofile":
+            out["requests"] = sess["requests"]
+            out["functions"] = len(sess["stats"].stats)
+        else:
+            out["samples"] = sess["samples"]
+            out["threads"] = sorted({thread for thread, _ in sess["stacks"]})
+        return out
+
+    def pstats_bytes(self, sess: dict) -> bytes:
+        import marshal
+
+        return marshal.dumps(sess["stats"].stats)  # the format pstats.Stats(path) loads
+
+    def text_report(self, sess: dict, limit: int = 60) -> str:
+        if sess["mode"] == "cprofile":
+            import io
+
+            buf = io.StringIO()
+            sess["stats"].stream = buf
+            sess["stats"].sort_stats("cumulative").print_stats(limit)
+            return buf.getvalue()
+        names = {i: f"{name} ({os.path.basename(path)}:{line})" for (name, path, line), i in sess["frames"].items()}
+        # Collapsed stacks, one line per unique stack: flamegraph.pl / speedscope both read this
+        return "".join(
+            f"{thread};{';'.join(names[i] for i in stack)} {count}\n"
+            for (thread, stack), count in sorted(sess["stacks"].items(), key=lambda kv: -kv[1])
+        )
+
+    def speedscope(self, sess: dict) -> dict:
+        frames = [None] * len(sess["frames"])
+        for (name, path, line), i in sess["frames"].items():
+            frames[i] = {"name": name, "file": path, "line": line}
+        by_thread = {}
+        for (thread, stack), count in sess["stacks"].items():
+            by_thread.setdefault(thread, []).append((list(stack), count * sess["interval"]))
+        profiles = [
+            {
+                "type": "sampled",
+                "name": thread,
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": sum(w for _, w in samples),
+                "samples": [s for s, _ in samples],
+                "weights": [w for _, w in samples],
+            }
+            for thread, samples in sorted(by_thread.items())
+        ]
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": f"wow profile {sess['id']}",
+            "exporter": "wow-510k-assistant",
+            "shared": {"frames": frames},
+            "profiles": profiles,
+        }
+
+    # -- memory ------------------------------------------------------------
+
+    def snapshot(self, frames: int = 5) -> dict:
+        """Take a tracemalloc snapshot, starting tracemalloc first if needed (only allocations after that are seen)."""
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start(max(1, min(frames, 50)))
+        snap = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+        ))
+        current, peak = tracemalloc.get_traced_memory()
+        sid = hashlib.sha256(os.urandom(8)).hexdigest()[:8]
+        with self.lock:
+            self.snapshots[sid] = {"snapshot": snap, "taken": time.time(), "current": current, "peak": peak}
+            while len(self.snapshots) > MEMORY_SNAPSHOT_KEEP:
+                self.snapshots.pop(next(iter(self.snapshots)))
+        return {"id": sid, "tracing_started": started, "current": current, "peak": peak}
+
+    def stop_memory(self):
+        with self.lock:
+            self.snapshots.clear()
+        if tracemalloc.is_tracing() and not MEMTRACE:
+            tracemalloc.stop()
+
+
+PROFILER = LiveProfiler()
+
+
+def memory_stats(stats, limit: int = MEMORY_TOP, diff: bool = False) -> list:
+    out = []
+    for st in stats[:limit]:
+        tb = st.traceback
+        row = {
+            "where": f"{tb[0].filename}:{tb[0].lineno}" if len(tb) else "?",
+            "size": st.size,
+            "count": st.count,
+            "traceback": [f"{fr.filename}:{fr.lineno}" for fr in tb] if len(tb) > 1 else None,
+        }
+        if diff:
+            row.update(size_diff=st.size_diff, count_diff=st.count_diff)
+        out.append(row)
+    return out
+
+
+@app.before_request
+def start_health_monitor():
+    if HEALTH_MONITOR:
+        HEALTH.start()
+
+
+@app.before_request
+def start_request_profile():
+    if PROFILER.session is not None and not (request.endpoint or "").startswith("admin_"):
+        request.profile = PROFILER.begin()
+
+
+@app.teardown_request
+def end_request_profile(exc=None):
+    handle = getattr(request, "profile", None)
+    if handle is not None:
+        request.profile = None
+        PROFILER.end(handle)
+
+
+@app.before_request
+def start_request_trace():
+    if TRACE_ENABLED and request.endpoint not in ("traces_view", "list_traces", "get_trace", "healthz"):
+        # The URL rule, not the path: paths carry session and conversation ids
+        rule = request.url_rule.rule if request.url_rule is not None else "<unmatched>"
+        request.trace_span = start_span(f"{request.method} {rule}", parent=False, endpoint=request.endpoint or "")
+        request.trace_token = CURRENT_SPAN.set(request.trace_span)
+
+
+@app.teardown_request
+def end_request_trace(exc=None):
+    sp = getattr(request, "trace_span", None)
+    if sp is not None:
+        request.trace_span = None
+        CURRENT_SPAN.reset(request.trace_token)
+        end_span(sp, str(exc) if exc else None)
+
+
+@app.before_request
+def govern_request_size():
+    # Runs before bind_tenant, which is the first thing to touch request.form
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+        request.mem_start = tracemalloc.get_traced_memory()[0]
+    if not request.content_length:
+        return
+    with span("form.parse", bytes=request.content_length):
+        if request.content_length > LARGE_REQUEST_BYTES:
+            # Parse large bodies a few at a time so concurrent uploads cannot stack up in memory
+            with LARGE_REQUEST_SLOTS:
+                request.form, request.files
+        else:
+            request.form, request.files
+
+
+@app.after_request
+def report_request_memory(response):
+    if request.truncated_fields:
+        response.headers["X-Form-Truncated"] = ",".join(request.truncated_fields)
+    if tracemalloc.is_tracing() and hasattr(request, "mem_start"):
+        # tracemalloc is process-wide: with concurrent requests the peak is an upper bound
+        peak = tracemalloc.get_traced_memory()[1] - getattr(request, "mem_start", 0)
+        response.headers["X-Peak-Memory"] = str(max(peak, 0))
+        app.logger.info("%s peak python memory %.1f KB", request.endpoint, peak / 1024)
+    return response
+
+
+@app.before_request
+def bind_tenant():
+    # Each request thread gets its own context; call_llm resolves keys from it
+    tenant = tenant_id_for(request.form if request.form else request.args, request.headers, request.cookies)
+    if tenant is None:
+        tenant = request.issued_tenant = issue_tenant()
+    CURRENT_TENANT.set(tenant)
+    CURRENT_ENDPOINT.set(request.endpoint or request.path)
+
+
+@app.after_request
+def set_tenant_cookie(response):
+    tenant = getattr(request, "issued_tenant", None)
+    if tenant:
+        response.set_cookie(
+            TENANT_COOKIE, tenant_token(tenant), max_age=TENANT_COOKIE_MAX_AGE, httponly=True, samesite="Lax"
+        )
+    return response
+
+
+@app.route("/")
+def index():
+    # Available models (extend as needed)
+    model_opts = ["gpt-4o-mini", "gpt-4.1-mini", "gemini-2.5-flash", "gemini-3-flash-preview"]
+    if local_available():
+        model_opts.append("local")
+
+    has_openai_env = bool(os.getenv("OPENAI_API_KEY"))
+    has_gemini_env = bool(os.getenv("GEMINI_API_KEY") or os.getenv("GOOGLE_API_KEY"))
+
+    return render_template_string(
+        INDEX_HTML,
+        painters_json=json.dumps(PAINTERS),
+        models_json=json.dumps(model_opts),
+        agents_json=json.dumps(agents()),
+        agents=agents(),
+        has_openai_env=has_openai_env,
+        has_gemini_env=has_gemini_env,
+        sub_prompt_default=SUBMISSION_PROMPT_DEFAULT,
+        checklist_prompt_default=CHECKLIST_PROMPT_DEFAULT,
+        review_prompt_default=REVIEW_PROMPT_DEFAULT,
+        note_prompt_default=NOTE_PROMPT_DEFAULT,
+        tenant_token=tenant_token(CURRENT_TENANT.get()),
+    )
+
+
+@app.route("/set_api_keys", methods=["POST"])
+def set_api_keys():
+    data = request.get_json() or {}
+    return jsonify(save_api_keys(data, CURRENT_TENANT.get()))
+
+
+def save_api_keys(data: dict, tenant: str = "default") -> dict:
+    """Store keys for one tenant only; other tenants and env defaults are unaffected."""
+    keys = {p: data[p] for p in ("openai", "gemini") if data.get(p)}
+    with TENANT_KEYS_LOCK:
+        TENANT_KEYS[tenant] = dict(TENANT_KEYS.get(tenant) or {}, **keys)
+    return {"status": "saved"}
+
+
+def op_create_session(form, files=None):
+    return {"session_id": SESSIONS.create()}, 200
+
+
+def op_update_session(form, files=None):
+    """form: session_id plus "fields" and/or "deltas" as in SessionStore.update."""
+    sid = form.get("session_id") or ""
+    try:
+        lengths = SESSIONS.update(sid, fields=form.get("fields"), deltas=form.get("deltas"))
+    except KeyError:
+        return {"error": "Unknown session."}, 404
+    except ValueError as e:
+        return {"error": str(e)}, 409
+    changed = set(form.get("fields") or {}) | {d.get("field") for d in form.get("deltas") or []}
+    if changed & set(PREFETCH_INPUTS):
+        PREFETCH.refresh(sid)
+    return {"status": "ok", "fields": lengths}, 200
+
+
+@app.route("/session", methods=["POST"])
+def create_session():
+    return respond(*op_create_session(request.form))
+
+
+@app.route("/session/<sid>", methods=["GET"])
+def get_session(sid):
+    fields = SESSIONS.get(sid)
+    if fields is None:
+        return jsonify({"error": "Unknown session."}), 404
+    name = request.args.get("field")
+    if name:
+        return jsonify({"field": name, "value": fields.get(name, "")})
+    return jsonify({"session_id": sid, "fields": {k: len(v) for k, v in fields.items()}})
+
+
+@app.route("/session/<sid>/update", methods=["POST"])
+def update_session(sid):
+    return respond(*op_update_session(dict(request.get_json(silent=True) or {}, session_id=sid)))
+
+
+def remember_document(form, sha: str):
+    """Record which PDF the session's submission came from ("" when it was not a native upload)."""
+    sid = form.get("session_id")
+    if sid:
+        try:
+            SESSIONS.update(sid, fields={"document_sha256": sha})
+        except KeyError:
+            pass
+
+
+def transform_pdf_natively(form, f, model: str, max_tokens: int, user_prompt: str):
+    """Transform an uploaded PDF through its Gemini file handle; None means fall back to local extraction."""
+    f.stream.seek(0, os.SEEK_END)
+    size = f.stream.tell()
+    if not size or size > GEMINI_FILE_MAX_BYTES:
+        f.stream.seek(0)
+        return None
+    sha = file_sha256(f.stream)
+    handle = GEMINI_FILES.upload(f.stream, sha, f.filename)
+    if "error" in handle:
+        app.logger.info("native PDF upload failed, extracting locally: %s", handle["error"])
+        return None
+    prompt = user_prompt + "\n\nSource: the attached PDF (" + f.filename + ")."
+    with attached_file(handle):
+        res = call_llm_adaptive(model, prompt, max_tokens=max_tokens)
+    if "text" not in res:
+        GEMINI_FILES.forget(sha)
+        app.logger.info("native PDF call failed, extracting locally: %s", res.get("error"))
+        return None
+    remember_document(form, sha)
+    remember_result(form, "submission", res["text"])
+    maybe_prefetch_review(form)
+    document = {"sha256": sha, "reused": handle["reused"], "expires": int(handle["expires"])}
+    return {"result": res["text"], "document": document}, 200
+
+
+def op_transform_submission(form, files=None):
+    model = form.get("model") or "gpt-4o-mini"
+    max_tokens = int(form.get("max_tokens") or 12000)
+    user_prompt = (form.get("user_prompt") or "").strip() or SUBMISSION_PROMPT_DEFAULT
+
+    doc_id = (form.get("doc_id") or "").strip()
+    structured = form.get("extract_mode") == "structured"
+    # Revisions and section selection need the whole text; otherwise only the prompt's share is read
+    limit = None if doc_id or structured else 3000 * COMPACT_READ_FACTOR
+    pasted = form_text(form, "pasted", limit=limit)
+
+    f = (files or {}).get("file")
+    if f and f.filename.lower().endswith(".pdf") and not (doc_id or structured) and gemini_native(model):
+        native = transform_pdf_natively(form, f, model, max_tokens, user_prompt)
+        if native is not None:
+            return native
+    remember_document(form, "")
 
-    f = request.files.get("file")
     text = pasted
+    pages = None
     if f:
-        try:
-            text = f.stream.read().decode("utf-8")
-        except Exception:
-            text = ""
+        fname = f.filename.lower()
+        if fname.endswith(".pdf") and structured:
+            sections = extract_structured_from_pdf_stream(f.stream)
+            pages = [render_structured([s]) for s in sections]
+            text = render_structured(sections)
+            user_prompt += "\n\nKeep the [p. N] page anchors next to headings so findings can cite pages."
+        elif fname.endswith(".pdf"):
+            pages = extract_pages_from_pdf_stream(f.stream)
+            text = "\n\n".join(pages)
+        else:
+            text = read_upload_text(f, limit or FORM_FIELD_MAX_BYTES)
+
+    text, pages, compaction = compact_source(text, pages)
+    source = select_sections(text, "", 3000) if structured else text[:3000]
+    prompt = user_prompt + "\n\nSource:\n" + source
+
+    revision = None
+    if doc_id:
+        # Incremental review works from these full-source sections, not from the
+        # transform below, which only sees the first 3000 characters.
+        sections = source_sections(pages) if pages is not None else split_sections(text)
+        parts = pages if pages is not None else [s["text"] for s in sections]
+        revision = diff_pages(doc_id, parts, sections)
+        # Changed parts the transform prompt cannot see are reported rather than silently dropped
+        revision["outside_source"] = [n for n in revision["changed_pages"] if parts[n - 1].strip()[:80] not in source]
+        key = text_digest(model, max_tokens, prompt)
+        with REVISIONS.lock:
+            prior = REVISIONS.entry(doc_id).get("transform") or {}
+        if prior.get("key") == key:
+            remember_result(form, "submission", prior["result"], source=text)
+            maybe_prefetch_review(form)
+            return {"result": prior["result"], "revision": dict(revision, reused=True), "compaction": compaction}, 200
+
+    res = call_llm_adaptive(model, prompt, max_tokens=max_tokens)
+    if "text" in res:
+        remember_result(form, "submission", res["text"], source=text)
+        maybe_prefetch_review(form)
+        if doc_id:
+            with REVISIONS.lock:
+                REVISIONS.entry(doc_id)["transform"] = {"key": key, "result": res["text"]}
+            return {"result": res["text"], "revision": dict(revision, reused=False), "compaction": compaction}, 200
+        return {"result": res["text"], "compaction": compaction}, 200
+    return {"error": res.get("error", "unknown")}, 500
+
+
+def op_transform_checklist(form, files=None):
+    pasted = form_text(form, "pasted", limit=3000 * COMPACT_READ_FACTOR)
+    model = form.get("model") or "gpt-4o-mini"
+    max_tokens = int(form.get("max_tokens") or 12000)
+    user_prompt = (form.get("user_prompt") or "").strip() or CHECKLIST_PROMPT_DEFAULT
+
+    f = (files or {}).get("file")
+    text = pasted
+    if f:
+        text = read_upload_text(f, 3000 * COMPACT_READ_FACTOR)
+    text, _, compaction = compact_source(text)
 
     prompt = user_prompt + "\n\nSource:\n" + text[:3000]
 
-    res = call_llm(model, prompt, max_tokens=max_tokens)
+    res = call_llm_adaptive(model, prompt, max_tokens=max_tokens)
     if "text" in res:
-        return jsonify({"result": res["text"]})
-    return jsonify({"error": res.get("error", "unknown")}), 500
+        remember_result(form, "checklist", res["text"], source=text)
+        maybe_prefetch_review(form)
+        return {"result": res["text"], "compaction": compaction}, 200
+    return {"error": res.get("error", "unknown")}, 500
 
 
-@app.route("/run_review", methods=["POST"])
-def run_review():
-    submission = request.form.get("submission", "")
-    checklist = request.form.get("checklist", "")
-    model = request.form.get("model") or "gpt-4o-mini"
-    max_tokens = int(request.form.get("max_tokens") or 12000)
-    user_prompt = (request.form.get("user_prompt") or "").strip() or REVIEW_PROMPT_DEFAULT
+def op_run_review(form, files=None):
+    submission = form_text(form, "submission")
+    checklist = form_text(
+        form, "checklist", limit=None if form.get("incremental") in ("1", "true", "on") else 2000 * COMPACT_READ_FACTOR
+    )
+    model = form.get("model") or "gpt-4o-mini"
+    max_tokens = int(form.get("max_tokens") or 12000)
+    user_prompt = (form.get("user_prompt") or "").strip() or REVIEW_PROMPT_DEFAULT
+    doc_id = (form.get("doc_id") or "").strip()
+    incremental = form.get("incremental") in ("1", "true", "on")
+
+    if incremental and doc_id:
+        res = review_incrementally(doc_id, submission, checklist, model, user_prompt, max_tokens)
+        if "text" in res:
+            remember_result(form, "review", res["text"], source=submission)
+            return {"result": res["text"], "revision": res["revision"]}, 200
+        return {"error": res.get("error", "unknown")}, 500
+
+    output_format = form.get("output_format") or "markdown"
+    prompt = build_review_prompt(submission, checklist, user_prompt, output_format)
+    sid = form.get("session_id") or ""
+    prefetched = PREFETCH.take(sid, review_key(model, max_tokens, prompt)) if sid else None
+    document = session_document(form, model)
+    if document is not None:
+        prefetched = None  # speculated without the PDF
+
+    if output_format == "json":
+        if form.get("stream") in ("1", "true", "on"):
+            return {"events": stream_review_events(form, model, prompt, max_tokens, prefetched, submission=submission, attachment=document)}, 200
+        res = prefetched or call_with_document(
+            document, prompt, REVIEW_DOCUMENT_NOTE,
+            lambda p: call_llm_adaptive(model, p, max_tokens=max_tokens, response_schema=REVIEW_SCHEMA),
+        )
+        if "text" not in res:
+            return {"error": res.get("error", "unknown")}, 500
+        try:
+            report = parse_json_output(res["text"])
+        except Exception as e:
+            return {"error": f"Could not parse structured review: {e}", "raw": res["text"]}, 502
+        markdown = render_review_markdown(report)
+        remember_result(form, "review", markdown, source=submission)
+        return {"result": markdown, "report": report, "prefetched": bool(prefetched)}, 200
+
+    res = prefetched or call_with_document(
+        document, prompt, REVIEW_DOCUMENT_NOTE, lambda p: call_llm_adaptive(model, p, max_tokens=max_tokens)
+    )
+    if "text" in res:
+        remember_result(form, "review", res["text"], source=submission)
+        return {"result": res["text"], "prefetched": bool(prefetched)}, 200
+    return {"error": res.get("error", "unknown")}, 500
+
+
+@traced("prompt.build_review")
+def build_review_prompt(submission: str, checklist: str, user_prompt: str, output_format: str = "markdown") -> str:
+    if COMPACT_ENABLED:
+        submission = compact_text(submission)
+        checklist = compact_text(checklist[: 2000 * COMPACT_READ_FACTOR])
+    if "[p. " in submission:
+        user_prompt += "\nCite the [p. N] page anchors from the submission for each finding."
 
     prompt = (
         user_prompt
         + "\n\nCHECKLIST:\n"
         + checklist[:2000]
         + "\n\nSUBMISSION:\n"
-        + submission[:8000]
+        + select_sections(submission, checklist, 8000)
     )
+    if output_format == "json":
+        prompt += (
+            "\n\nReturn a JSON object with: summary, findings (checklist_item, status, detail, page), "
+            "actions, missing_documents."
+        )
+    return prompt
 
-    res = call_llm(model, prompt, max_tokens=max_tokens)
-    if "text" in res:
-        return jsonify({"result": res["text"]})
-    return jsonify({"error": res.get("error", "unknown")}), 500
+
+def stream_review_events(form, model: str, prompt: str, max_tokens: int, prefetched: dict = None, submission: str = "", attachment=None):
+    """
+    Yield events for a streamed structured review: items first, then the rendered report.
+    submission is the reviewed text (archived as the source); attachment is the Gemini file handle, if any.
+    """
+    parser = JSONStreamParser()
+    if prefetched:
+        source = [{"delta": prefetched["text"]}]
+    else:
+        source = stream_with_document(
+            attachment, prompt, REVIEW_DOCUMENT_NOTE,
+            lambda p: stream_llm_continued(model, p, max_tokens=max_tokens, response_schema=REVIEW_SCHEMA),
+        )
+    for ev in source:
+        if "error" in ev:
+            yield {"type": "error", "error": ev["error"]}
+            return
+        if "delta" in ev:
+            for key, value in parser.feed(ev["delta"]):
+                yield {"type": "item", "key": key, "value": value}
+    try:
+        report = parser.result()
+    except Exception as e:
+        yield {"type": "error", "error": f"Could not parse structured review: {e}"}
+        return
+    markdown = render_review_markdown(report)
+    remember_result(form, "review", markdown, source=submission)
+    yield {"type": "done", "result": markdown, "report": report, "prefetched": bool(prefetched)}
 
 
-@app.route("/transform_note", methods=["POST"])
-def transform_note():
-    note = request.form.get("note", "")
-    model = request.form.get("model") or "gpt-4o-mini"
-    max_tokens = int(request.form.get("max_tokens") or 4000)
-    user_prompt = (request.form.get("user_prompt") or "").strip() or NOTE_PROMPT_DEFAULT
+def op_transform_note(form, files=None):
+    note = form_text(form, "note", limit=4000)
+    model = task_model(form)
+    max_tokens = int(form.get("max_tokens") or 4000)
+    user_prompt = (form.get("user_prompt") or "").strip() or NOTE_PROMPT_DEFAULT
 
     prompt = user_prompt + "\n\nRAW NOTE:\n" + note[:4000]
 
-    res = call_llm(model, prompt, max_tokens=max_tokens)
+    res = call_llm_for_note("transform_note", model, user_prompt, note[:4000], prompt, max_tokens)
     if "text" in res:
-        return jsonify({"result": res["text"]})
-    return jsonify({"error": res.get("error", "unknown")}), 500
+        text, keywords = annotate_note(res["text"], note)
+        remember_result(form, "note", text, source=note)
+        return {"result": text, "cache": res.get("cache"), "keywords": keywords}, 200
+    return {"error": res.get("error", "unknown")}, 500
 
 
-@app.route("/run_note_prompt", methods=["POST"])
-def run_note_prompt():
-    note = request.form.get("note", "")
-    model = request.form.get("model") or "gpt-4o-mini"
-    max_tokens = int(request.form.get("max_tokens") or 2000)
-    user_prompt = (request.form.get("user_prompt") or "").strip()
+def op_run_note_prompt(form, files=None):
+    note = form_text(form, "note", limit=6000)
+    model = form.get("model") or "gpt-4o-mini"
+    max_tokens = int(form.get("max_tokens") or 2000)
+    user_prompt = (form.get("user_prompt") or "").strip()
     if not user_prompt:
-        return jsonify({"error": "Custom prompt on note is empty."}), 400
+        return {"error": "Custom prompt on note is empty."}, 400
 
     prompt = user_prompt + "\n\nNOTE CONTENT:\n" + note[:6000]
 
-    res = call_llm(model, prompt, max_tokens=max_tokens)
+    res = call_llm_for_note("run_note_prompt", model, user_prompt, note[:6000], prompt, max_tokens)
     if "text" in res:
-        return jsonify({"result": res["text"]})
-    return jsonify({"error": res.get("error", "unknown")}), 500
+        remember_result(form, "note", res["text"], source=note)
+        return {"result": res["text"], "cache": res.get("cache")}, 200
+    return {"error": res.get("error", "unknown")}, 500
 
 
-@app.route("/run_note_agent", methods=["POST"])
-def run_note_agent():
-    note = request.form.get("note", "")
-    model = request.form.get("model") or "gpt-4o-mini"
-    max_tokens = int(request.form.get("max_tokens") or 2000)
-    agent_id = request.form.get("agent_id") or ""
-    user_prompt = (request.form.get("user_prompt") or "").strip()
+def op_run_note_agent(form, files=None):
+    note = form_text(form, "note", limit=6000)
+    model = form.get("model") or "gpt-4o-mini"
+    max_tokens = int(form.get("max_tokens") or 2000)
+    agent_id = form.get("agent_id") or ""
+    user_prompt = (form.get("user_prompt") or "").strip()
 
-    agent = next((a for a in AGENTS if str(a["id"]) == str(agent_id)), None)
+    agent = next((a for a in agents() if str(a["id"]) == str(agent_id)), None)
     if not agent:
-        return jsonify({"error": f"Agent {agent_id} not found."}), 400
+        return {"error": f"Agent {agent_id} not found."}, 400
 
     base_prompt = agent.get("prompt", "")
     combined_prompt = base_prompt
@@ -1475,24 +5751,966 @@ def run_note_agent():
         combined_prompt += "\n\nAdditional instructions:\n" + user_prompt
 
     prompt = combined_prompt + "\n\nNOTE CONTENT:\n" + note[:6000]
+    document = session_document(form, model) if form.get("with_document") in ("1", "true", "on") else None
 
-    res = call_llm(model, prompt, max_tokens=max_tokens)
+    res = call_with_document(
+        document, prompt, AGENT_DOCUMENT_NOTE, lambda p: call_llm_adaptive(model, p, max_tokens=max_tokens, agent=agent["id"])
+    )
     if "text" in res:
-        return jsonify({"result": res["text"]})
-    return jsonify({"error": res.get("error", "unknown")}), 500
+        remember_result(form, "noteAgent", res["text"], source=note)
+        return {"result": res["text"]}, 200
+    return {"error": res.get("error", "unknown")}, 500
+
+
+def op_test_llm(form, files=None):
+    """
+    Connectivity check from cached provider health; when there is no recent success
+    for the provider, a cheap probe (model listing, no tokens) is run instead of a completion.
+    """
+    model = task_model(form)
+    provider = provider_for(model)
+    health = HEALTH.snapshot(provider)  # per credential, so a cached success is this tenant's key
+    fresh = health["last_ok"] and time.time() - health["last_ok"] < HEALTH_FRESH
+    if fresh and health["circuit"] == "closed":
+        return {"status": "ok", "preview": f"{provider} healthy (cached, p50 {health['p50_ms']} ms)", "health": health}, 200
+    probe = HEALTH.probe(provider)
+    health = HEALTH.snapshot(provider)
+    if probe["ok"]:
+        return {"status": "ok", "preview": f"{provider} reachable ({probe['latency_ms']} ms)", "health": health}, 200
+    return {"status": "error", "error": probe["error"], "health": health}, 500
+
+
+# Speculative prefetch: reviewers nearly always run transform_submission, then
+# transform_checklist, then run_review on the same inputs. Once a session holds
+# both transformed inputs the review is started in the background and handed to
+# the real /run_review request if its prompt matches.
+PREFETCH_DEFAULT = os.getenv("WOW_PREFETCH", "0") in ("1", "true", "on")
+PREFETCH_TTL = int(os.getenv("WOW_PREFETCH_TTL", "900"))
+PREFETCH_WAIT = 300  # seconds a review request waits for a running prefetch
+PREFETCH_INPUTS = ("submission_result", "checklist_result")
+
+
+def review_key(model: str, max_tokens: int, prompt: str) -> str:
+    return text_digest(CURRENT_TENANT.get(), model, max_tokens, prompt)
+
+
+def _lower_thread_priority():
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 10)  # per-thread on Linux
+    except Exception:
+        pass
+
+
+class SpeculativeExecutor:
+    """One speculative review per session, run on a low-priority worker."""
+
+    def __init__(self, workers: int = 1):
+        self.workers = workers
+        self.pool = None
+        self.jobs = {}  # sid -> {"key", "params", "future", "started"}
+        self.lock = threading.Lock()
+        self.stats = {"started": 0, "hits": 0, "misses": 0, "cancelled": 0}
+
+    def _executor(self):
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="prefetch", initializer=_lower_thread_priority
+            )
+        return self.pool
+
+    def schedule(self, sid: str, params: dict):
+        """(Re)start the speculative review for a session from its stored transformed inputs."""
+        fields = SESSIONS.get(sid) or {}
+        submission, checklist = (fields.get(name, "") for name in PREFETCH_INPUTS)
+        if not submission.strip() or not checklist.strip():
+            self.cancel(sid)
+            return
+        prompt = build_review_prompt(submission, checklist, params["user_prompt"], params["output_format"])
+        key = review_key(params["model"], params["max_tokens"], prompt)
+        with self.lock:
+            job = self.jobs.get(sid)
+            if job and job["key"] == key:
+                return
+            if job:
+                self._cancel(job)
+            ctx = contextvars.copy_context()
+            future = self._executor().submit(ctx.run, self._run, params, prompt)
+            self.jobs[sid] = {"key": key, "params": params, "future": future, "started": time.time()}
+            self.stats["started"] += 1
+
+    @staticmethod
+    def _run(params: dict, prompt: str) -> dict:
+        CURRENT_ENDPOINT.set("run_review")
+        schema = REVIEW_SCHEMA if params["output_format"] == "json" else None
+        return call_llm_adaptive(params["model"], prompt, max_tokens=params["max_tokens"], response_schema=schema)
+
+    def refresh(self, sid: str):
+        """Inputs changed: drop the stale speculation and start over with the same review settings."""
+        with self.lock:
+            job = self.jobs.get(sid)
+        if job:
+            self.schedule(sid, job["params"])
+
+    def _cancel(self, job: dict):
+        # A call already in flight cannot be aborted; its result is simply never used
+        job["future"].cancel()
+        self.stats["cancelled"] += 1
+
+    def cancel(self, sid: str):
+        with self.lock:
+            job = self.jobs.pop(sid, None)
+            if job:
+                self._cancel(job)
+
+    def take(self, sid: str, key: str):
+        """Return the speculative result for this exact review, waiting if it is still running."""
+        with self.lock:
+            job = self.jobs.get(sid)
+            if not job or job["key"] != key or time.time() - job["started"] > PREFETCH_TTL:
+                self.stats["misses"] += 1
+                return None
+            del self.jobs[sid]
+        try:
+            res = job["future"].result(timeout=PREFETCH_WAIT)
+        except Exception:
+            res = None
+        if not res or "text" not in res:
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        return res
+
+
+PREFETCH = SpeculativeExecutor()
+
+
+def maybe_prefetch_review(form):
+    """Called after a transform stores its result; starts the review if the caller opted in."""
+    sid = form.get("session_id")
+    if not sid or not (PREFETCH_DEFAULT or form.get("prefetch") in ("1", "true", "on")):
+        return
+    params = {
+        "model": form.get("review_model") or "gpt-4o-mini",
+        "max_tokens": int(form.get("review_max_tokens") or 12000),
+        "user_prompt": (form.get("review_prompt") or "").strip() or REVIEW_PROMPT_DEFAULT,
+        "output_format": form.get("review_format") or "markdown",
+    }
+    PREFETCH.schedule(sid, params)
+
+
+# Follow-up Q&A: a conversation loads the submission once and answers questions
+# against it. On Gemini the submission (and the native PDF, if the session has
+# one) goes into a cachedContents entry, so a follow-up only sends the recent
+# history and the question. Elsewhere the prompt starts with a byte-identical
+# prefix (instructions + submission), which OpenAI's automatic prompt caching
+# and Gemini's implicit caching bill at the cached rate; prompt_cache_key keeps
+# OpenAI follow-ups on the same cache. Conversations live in memory and expire
+# after WOW_QA_TTL idle seconds or are evicted LRU; their caches are deleted
+# with them (and expire provider-side by the same TTL regardless).
+QA_CACHE_ENABLED = os.getenv("WOW_QA_CACHE", "1") not in ("0", "false", "off")
+QA_TTL = int(os.getenv("WOW_QA_TTL", "1800"))
+QA_MAX_CONVERSATIONS = int(os.getenv("WOW_QA_MAX", "64"))
+QA_CONTEXT_CHARS = int(os.getenv("WOW_QA_CONTEXT_CHARS", "400000"))
+QA_HISTORY_TURNS = 6  # earlier Q/A pairs resent with each question
+QA_HISTORY_ANSWER_CHARS = 3000
+QA_PROMPT_DEFAULT = (
+    "You answer follow-up questions about the 510(k) submission below. Answer only from the "
+    "submission, cite [p. N] page anchors or section headings where available, and say plainly "
+    "when the submission does not contain the answer."
+)
+PROMPT_CACHE = contextvars.ContextVar("prompt_cache", default=None)  # {"key", "gemini"} of the conversation
+
+
+@contextmanager
+def prompt_cache(cache: dict):
+    token = PROMPT_CACHE.set(cache)
+    try:
+        yield cache
+    finally:
+        PROMPT_CACHE.reset(token)
+
+
+def pinned_to_gemini() -> bool:
+    """True while a call depends on Gemini-side state (an attached file or cached content)."""
+    return ATTACHED_FILE.get() is not None or bool((PROMPT_CACHE.get() or {}).get("gemini"))
+
+
+def openai_cache_hint() -> dict:
+    """Request kwargs routing a conversation's calls to the OpenAI cache holding its prefix."""
+    key = (PROMPT_CACHE.get() or {}).get("key")
+    return {"extra_body": {"prompt_cache_key": key}} if key else {}
+
+
+def create_gemini_cache(model: str, system: str, context: str, document=None) -> dict:
+    """Put the submission (and PDF) into a Gemini cachedContents entry; {"name", "expires"} or {"error"}."""
+    genai = lazy_import("google.genai")
+    key = api_key("gemini")
+    if genai is None or not key:
+        return {"error": "Gemini is not configured."}
+    contents = [context]
+    if document is not None:
+        contents.insert(0, genai.types.Part.from_uri(file_uri=document["uri"], mime_type=document["mime_type"]))
+    started = time.perf_counter()
+    try:
+        cache = gemini_client(genai, key).caches.create(
+            model=model,
+            config={"contents": contents, "system_instruction": system, "ttl": f"{QA_TTL}s", "display_name": "wow-qa"},
+        )
+    except Exception as e:
+        # e.g. below the model's minimum cacheable size: fall back to the stable-prefix prompt
+        return {"error": f"Gemini context cache unavailable: {e}"}
+    tokens = int(getattr(getattr(cache, "usage_metadata", None), "total_token_count", 0) or 0)
+    if tokens:
+        record_usage(model, {"prompt_tokens": tokens, "completion_tokens": 0, "cached_tokens": tokens}, time.perf_counter() - started, True)
+    return {"name": cache.name, "expires": time.time() + QA_TTL}
+
+
+def extend_gemini_cache(name: str) -> bool:
+    genai = lazy_import("google.genai")
+    try:
+        gemini_client(genai, api_key("gemini")).caches.update(name=name, config={"ttl": f"{QA_TTL}s"})
+        return True
+    except Exception:
+        return False
+
+
+def delete_gemini_cache(tenant: str, name: str):
+    genai = lazy_import("google.genai")
+    with use_tenant(tenant):
+        try:
+            gemini_client(genai, api_key("gemini"), timeout=PROBE_TIMEOUT).caches.delete(name=name)
+        except Exception:
+            pass  # it expires on its own
+
+
+class ConversationStore:
+    """Q&A conversations by id, in LRU order; idle or evicted ones release their Gemini cache."""
+
+    def __init__(self, ttl: int, max_items: int):
+        self.ttl = ttl
+        self.max_items = max_items
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def start(self, conv: dict) -> dict:
+        with self.lock:
+            conv.update(id=secrets.token_urlsafe(9), touched=time.time())
+            self.items[conv["id"]] = conv
+            dropped = self._sweep()
+        self._release(dropped)
+        return conv
+
+    def get(self, cid: str, tenant: str):
+        with self.lock:
+            dropped = self._sweep()
+            conv = self.items.get(cid)
+            if conv is not None and conv["tenant"] == tenant:
+                conv["touched"] = time.time()
+                self.items[cid] = self.items.pop(cid)
+            else:
+                conv = None
+        self._release(dropped)
+        return conv
+
+    def end(self, cid: str, tenant: str) -> bool:
+        with self.lock:
+            conv = self.items.get(cid)
+            if conv is None or conv["tenant"] != tenant:
+                return False
+            del self.items[cid]
+        self._release([conv])
+        return True
+
+    def drop_cache(self, conv: dict):
+        name, conv["gemini_cache"] = conv["gemini_cache"], None
+        if name:
+            self._release([{"tenant": conv["tenant"], "gemini_cache": name}])
+
+    def _sweep(self) -> list:
+        cutoff = time.time() - self.ttl
+        dropped = [conv for conv in self.items.values() if conv["touched"] < cutoff]
+        for conv in dropped:
+            del self.items[conv["id"]]
+        while len(self.items) > self.max_items:
+            dropped.append(self.items.pop(next(iter(self.items))))
+        return dropped
+
+    def _release(self, dropped: list):
+        for conv in dropped:
+            if conv.get("gemini_cache"):
+                threading.Thread(
+                    target=delete_gemini_cache, args=(conv["tenant"], conv["gemini_cache"]), name="qa-cache-delete", daemon=True
+                ).start()
+
+
+CONVERSATIONS = ConversationStore(QA_TTL, QA_MAX_CONVERSATIONS)
+
+
+def start_conversation(form, submission: str) -> dict:
+    model = form.get("model") or "gpt-4o-mini"
+    system = (form.get("user_prompt") or "").strip() or QA_PROMPT_DEFAULT
+    context = (compact_text(submission) if COMPACT_ENABLED else submission)[:QA_CONTEXT_CHARS]
+    document = session_document(form, model)
+    tenant = CURRENT_TENANT.get()
+    conv = {
+        "tenant": tenant,
+        "model": model,
+        "prefix": system + "\n\nSUBMISSION:\n" + context + "\n\n",
+        "document": document,
+        "key": text_digest(tenant, model, system, context, (document or {}).get("sha256", ""))[:32],
+        "turns": [],
+        "lock": threading.Lock(),
+        "gemini_cache": None,
+        "cache_expires": 0,
+        "created": time.time(),
+    }
+    if QA_CACHE_ENABLED and provider_for(model) == "gemini":
+        with span("qa.cache_create", model=model, chars=len(context)):
+            cache = create_gemini_cache(model, system, context, document)
+        if "name" in cache:
+            conv["gemini_cache"], conv["cache_expires"] = cache["name"], cache["expires"]
+        else:
+            app.logger.info("%s", cache["error"])
+    return CONVERSATIONS.start(conv)
+
+
+def qa_history(turns: list) -> str:
+    recent = turns[-QA_HISTORY_TURNS:]
+    if not recent:
+        return ""
+    pairs = ["Q: " + t["question"] + "\nA: " + t["answer"][:QA_HISTORY_ANSWER_CHARS] for t in recent]
+    return "EARLIER QUESTIONS AND ANSWERS:\n" + "\n\n".join(pairs) + "\n\n"
+
+
+def answer_question(conv: dict, question: str, max_tokens: int) -> dict:
+    """One turn; callers hold conv["lock"] so turns of a conversation run in order."""
+    model = conv["model"]
+    tail = qa_history(conv["turns"]) + "QUESTION:\n" + question
+    if conv["gemini_cache"]:
+        if conv["cache_expires"] - time.time() < QA_TTL / 2:
+            if extend_gemini_cache(conv["gemini_cache"]):
+                conv["cache_expires"] = time.time() + QA_TTL
+            else:
+                CONVERSATIONS.drop_cache(conv)
+    if conv["gemini_cache"]:
+        with prompt_cache({"key": conv["key"], "gemini": conv["gemini_cache"]}):
+            res = call_llm_adaptive(model, tail, max_tokens=max_tokens)
+        if "text" in res:
+            return dict(res, cache_mode="gemini_cached_content")
+        CONVERSATIONS.drop_cache(conv)  # expired or rejected: continue on the prefix prompt
+    with prompt_cache({"key": conv["key"]}):
+        res = call_with_document(
+            conv["document"], conv["prefix"] + tail, "", lambda p: call_llm_adaptive(model, p, max_tokens=max_tokens)
+        )
+    return dict(res, cache_mode="prefix")
+
+
+def op_ask(form, files=None):
+    """
+    Ask about a submission. The first question (no conversation_id, or an expired one)
+    needs `submission` / `submission_ref`; later ones only the question and conversation_id.
+    """
+    question = form_text(form, "question", limit=4000).strip()
+    if not question:
+        return {"error": "Question is empty."}, 400
+    max_tokens = int(form.get("max_tokens") or 2000)
+    cid = (form.get("conversation_id") or "").strip()
+    conv = CONVERSATIONS.get(cid, CURRENT_TENANT.get()) if cid else None
+    if conv is None:
+        submission = form_text(form, "submission", limit=QA_CONTEXT_CHARS * COMPACT_READ_FACTOR)
+        if not submission.strip():
+            if cid:
+                return {"error": "Conversation expired; send the submission to start a new one.", "expired": True}, 404
+            return {"error": "Submission is empty."}, 400
+        conv = start_conversation(form, submission)
+
+    with conv["lock"]:
+        res = answer_question(conv, question, max_tokens)
+        if "text" not in res:
+            return {"error": res.get("error", "unknown"), "conversation_id": conv["id"]}, 500
+        conv["turns"].append({"question": question, "answer": res["text"], "ts": time.time()})
+        turn = len(conv["turns"])
+
+    usage = res.get("usage") or {}
+    remember_result(form, "qa", "Q: " + question + "\n\nA: " + res["text"], source=conv["prefix"])
+    return {
+        "result": res["text"],
+        "conversation_id": conv["id"],
+        "turn": turn,
+        "new_conversation": conv["id"] != cid,
+        "cache": {
+            "mode": res["cache_mode"],
+            "prompt_tokens": usage.get("prompt_tokens", 0),
+            "cached_tokens": usage.get("cached_tokens", 0),
+            "cost_usd": round(estimate_cost(res.get("model") or conv["model"], usage), 6) if usage else None,
+        },
+        "expires_in": QA_TTL,
+    }, 200
+
+
+# Core operations are plain functions over a form-like mapping so that the HTTP
+# routes below and the desktop js_api bridge (DesktopApi) share one implementation.
+OPERATIONS = {
+    "transform_submission": op_transform_submission,
+    "transform_checklist": op_transform_checklist,
+    "run_review": op_run_review,
+    "transform_note": op_transform_note,
+    "run_note_prompt": op_run_note_prompt,
+    "run_note_agent": op_run_note_agent,
+    "test_llm": op_test_llm,
+    "ask": op_ask,
+    "create_session": op_create_session,
+    "update_session": op_update_session,
+}
+
+
+def respond(payload: dict, status: int):
+    """Turn an operation result into a Flask response (NDJSON for event streams)."""
+    if "events" in payload:
+        events = payload["events"]
+        # The request's trace stays open until the stream is exhausted, not until teardown
+        root, request.trace_span = getattr(request, "trace_span", None), None
+        profile, request.profile = getattr(request, "profile", None), None  # likewise a running cProfile
+
+        def lines():
+            token = CURRENT_SPAN.set(root) if root else None
+            try:
+                for ev in events:
+                    yield json.dumps(ev) + "\n"
+            finally:
+                PROFILER.end(profile)
+                if root:
+                    try:
+                        CURRENT_SPAN.reset(token)
+                    except ValueError:
+                        pass
+                    end_span(root)
+
+        return Response(stream_with_context(lines()), mimetype="application/x-ndjson")
+    with span("serialize"):
+        return jsonify(payload), status
+
+
+@app.route("/transform_submission", methods=["POST"])
+def transform_submission():
+    return respond(*op_transform_submission(request.form, request.files))
+
+
+@app.route("/transform_checklist", methods=["POST"])
+def transform_checklist():
+    return respond(*op_transform_checklist(request.form, request.files))
+
+
+@app.route("/run_review", methods=["POST"])
+def run_review():
+    return respond(*op_run_review(request.form))
+
+
+@app.route("/transform_note", methods=["POST"])
+def transform_note():
+    return respond(*op_transform_note(request.form))
+
+
+@app.route("/run_note_prompt", methods=["POST"])
+def run_note_prompt():
+    return respond(*op_run_note_prompt(request.form))
+
+
+@app.route("/run_note_agent", methods=["POST"])
+def run_note_agent():
+    return respond(*op_run_note_agent(request.form))
+
+
+@app.route("/ask", methods=["POST"])
+def ask():
+    return respond(*op_ask(request.form))
+
+
+@app.route("/ask/<cid>", methods=["GET", "DELETE"])
+def conversation(cid):
+    """GET: the conversation's turns and cache state; DELETE: end it and release its cache."""
+    if request.method == "DELETE":
+        if not CONVERSATIONS.end(cid, CURRENT_TENANT.get()):
+            return jsonify({"error": "Unknown or expired conversation."}), 404
+        return jsonify({"status": "ended"})
+    conv = CONVERSATIONS.get(cid, CURRENT_TENANT.get())
+    if conv is None:
+        return jsonify({"error": "Unknown or expired conversation."}), 404
+    return jsonify({
+        "conversation_id": cid,
+        "model": conv["model"],
+        "turns": conv["turns"],
+        "cache": {"gemini_cache": bool(conv["gemini_cache"]), "document": bool(conv["document"])},
+        "expires_in": QA_TTL,
+    })
 
 
 @app.route("/test_llm", methods=["POST"])
 def test_llm():
-    model = request.form.get("model") or "gpt-4o-mini"
-    prompt = request.form.get("prompt") or "Say OK if you received this."
-    test_prompt = f"Connection test. {prompt}"
-    res = call_llm(model, test_prompt, max_tokens=32, temperature=0.0)
-    if "text" in res:
-        text = res["text"] or ""
-        preview = text.strip().splitlines()[0] if text.strip() else ""
-        return jsonify({"status": "ok", "preview": preview})
-    return jsonify({"status": "error", "error": res.get("error", "unknown")}), 500
+    return respond(*op_test_llm(request.form))
+
+
+def bridge_payload(params: dict, file: dict = None) -> tuple:
+    """
+    Apply the HTTP request-size governance to a bridge call: a payload above
+    MAX_CONTENT_LENGTH is refused (ValueError), text fields are cut at
+    FORM_FIELD_MAX_BYTES, and an upload is decoded into the same spooling stream
+    an HTTP upload would use (large ones one LARGE_REQUEST_SLOTS slot at a time).
+    Returns (params, files, names of truncated fields).
+    """
+    from contextlib import nullcontext
+
+    data = (file or {}).get("data") or ""
+    size = len(data) * 3 // 4
+    total = size + sum(len(v) if isinstance(v, str) else len(json.dumps(v)) for v in params.values())
+    limit = app.config.get("MAX_CONTENT_LENGTH")
+    if limit and total > limit:
+        raise ValueError(f"Payload too large ({total} bytes, limit {limit}).")
+
+    fields, truncated = {}, []
+    for name, value in params.items():
+        if isinstance(value, str) and len(value) * 4 > FORM_FIELD_MAX_BYTES:
+            raw = value.encode("utf-8")
+            if len(raw) > FORM_FIELD_MAX_BYTES:
+                value = raw[:FORM_FIELD_MAX_BYTES].decode("utf-8", "ignore")
+                truncated.append(name)
+        fields[name] = value
+
+    files = {}
+    if file:
+        import base64
+        from werkzeug.datastructures import FileStorage
+
+        stream = upload_stream_factory(size)
+        with LARGE_REQUEST_SLOTS if total > LARGE_REQUEST_BYTES else nullcontext():
+            stream.write(base64.b64decode(data))
+        stream.seek(0)
+        files["file"] = FileStorage(stream=stream, filename=file.get("name") or "upload")
+    return fields, files, truncated
+
+
+def bridge_tenant(params) -> str:
+    """Bridge calls come from this app's own window, which passes the page's tenant_token."""
+    return tenant_id_for(params) or "desktop"
+
+
+class DesktopApi:
+    """
+    pywebview js_api bridge: exposes the same operations as the HTTP routes so the
+    desktop UI can skip loopback HTTP and multipart encoding.
+    Each method takes a plain dict of the same fields the routes read from the form.
+    """
+
+    def __init__(self):
+        self._window = None
+
+    def _attach(self, window):
+        self._window = window
+
+    @staticmethod
+    @contextmanager
+    def _context(name, params):
+        """Tenant and endpoint of one bridge call (also around draining its event stream)."""
+        token = CURRENT_ENDPOINT.set(name)
+        try:
+            with use_tenant(bridge_tenant(params)):
+                yield
+        finally:
+            CURRENT_ENDPOINT.reset(token)
+
+    def _run(self, name, params, file=None):
+        try:
+            params, files, truncated = bridge_payload(params or {}, file)
+        except ValueError as e:
+            return {"error": str(e)}
+        with self._context(name, params), span(f"bridge {name}", parent=False, endpoint=name), PROFILER.profiled():
+            payload, status = OPERATIONS[name](params, files)
+        if status >= 400:
+            # The HTTP status the route would have returned (e.g. 404 for an unknown session)
+            payload = dict(payload, http_status=status)
+            payload.setdefault("error", f"HTTP {status}")
+        if truncated:
+            # What the X-Form-Truncated header reports on the HTTP path
+            payload = dict(payload, truncated_fields=truncated)
+        return payload
+
+    def set_api_keys(self, data):
+        return save_api_keys(data or {}, bridge_tenant(data))
+
+    def transform_submission(self, params, file=None):
+        return self._run("transform_submission", params, file)
+
+    def transform_checklist(self, params, file=None):
+        return self._run("transform_checklist", params, file)
+
+    def run_review(self, params):
+        payload = self._run("run_review", params)
+        if "events" in payload:
+            # Non-streaming caller: drain the stream and return the final event
+            final = {}
+            with self._context("run_review", params):
+                for ev in payload["events"]:
+                    final = ev
+            return {"result": final.get("result"), "report": final.get("report"), "error": final.get("error")}
+        return payload
+
+    def run_review_stream(self, params, callback):
+        """Stream review events to the page by invoking window[callback](event) via evaluate_js."""
+        params = dict(params or {}, stream="1")
+        payload = self._run("run_review", params)
+        events = payload.get("events") or [dict(payload, type="error" if "error" in payload else "done")]
+        with self._context("run_review", params):
+            for ev in events:
+                if self._window is not None:
+                    self._window.evaluate_js("window[%s](%s)" % (json.dumps(callback), json.dumps(ev)))
+        return {"status": "streamed"}
+
+    def transform_note(self, params):
+        return self._run("transform_note", params)
+
+    def run_note_prompt(self, params):
+        return self._run("run_note_prompt", params)
+
+    def run_note_agent(self, params):
+        return self._run("run_note_agent", params)
+
+    def test_llm(self, params):
+        return self._run("test_llm", params)
+
+    def ask(self, params):
+        return self._run("ask", params)
+
+    def create_session(self, params):
+        return self._run("create_session", params)
+
+    def update_session(self, params):
+        return self._run("update_session", params)
+
+
+# Admin diagnostics: disabled unless WOW_ADMIN_TOKEN is set; send it as X-Admin-Token (or ?token=)
+ADMIN_TOKEN = os.getenv("WOW_ADMIN_TOKEN", "")
+
+
+def is_admin() -> bool:
+    given = request.headers.get("X-Admin-Token") or request.args.get("token") or ""
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(given.encode("utf-8"), ADMIN_TOKEN.encode("utf-8"))
+
+
+def admin_only(fn):
+    @functools.wraps(fn)
+    def inner(*args, **kwargs):
+        if not is_admin():
+            return jsonify({"error": "Admin endpoints require WOW_ADMIN_TOKEN."}), 403
+        return fn(*args, **kwargs)
+
+    return inner
+
+
+@app.route("/usage")
+def usage_report():
+    """
+    Rolled-up usage of the caller's tenant: ?view=daily|monthly (default daily), optional
+    since=YYYY-MM[-DD], model, endpoint. With the admin token, ?all=1 reports every tenant.
+    """
+    monthly = request.args.get("view") == "monthly"
+    view = "usage_monthly" if monthly else "usage_daily"
+    period = "month" if monthly else "day"
+    everyone = request.args.get("all") in ("1", "true", "on") and is_admin()
+    if everyone:
+        sql, args = f"SELECT * FROM {view} WHERE 1 = 1", []
+        filters = ("model", "tenant") if monthly else ("model", "endpoint")
+    else:
+        group = f"{period}, model" if monthly else f"{period}, model, endpoint"
+        latency = "" if monthly else "ROUND(AVG(latency_ms), 1) AS avg_latency_ms, "
+        sql = (
+            f"SELECT {group}, COUNT(*) AS calls, SUM(prompt_tokens) AS prompt_tokens, "
+            "SUM(completion_tokens) AS completion_tokens, SUM(cached_tokens) AS cached_tokens, "
+            f"{latency}ROUND(SUM(cost_usd), 6) AS cost_usd, SUM(coalesced) AS coalesced FROM usage WHERE tenant = ?"
+        )
+        args = [CURRENT_TENANT.get()]
+        filters = ("model",) if monthly else ("model", "endpoint")
+    if request.args.get("since"):
+        sql += f" AND {period} >= ?"
+        args.append(request.args["since"])
+    for col in filters:
+        if request.args.get(col):
+            sql += f" AND {col} = ?"
+            args.append(request.args[col])
+    if not everyone:
+        sql += f" GROUP BY {group}"
+    sql += f" ORDER BY {period} DESC LIMIT 500"
+    with LEDGER_LOCK:
+        rows = [dict(r) for r in ledger_conn().execute(sql, args).fetchall()]
+    if everyone:
+        budgets = {"monthly_usd": BUDGETS.get("monthly_usd"), "spent_this_month_usd": round(month_spend(), 6)}
+    else:
+        budgets = {
+            "monthly_usd": tenant_budget(CURRENT_TENANT.get()),
+            "spent_this_month_usd": round(month_spend(tenant=CURRENT_TENANT.get()), 6),
+        }
+    return jsonify({"view": view, "rows": rows, "budgets": budgets})
+
+
+@app.route("/search")
+def search():
+    """Full-text search over archived results: ?q=..., kind, model, agent, doc_hash, doc_id, since, until, limit."""
+    filters = {k: request.args.get(k) for k in ("kind", "model", "agent", "doc_hash", "doc_id", "since", "until")}
+    try:
+        rows = search_archive(request.args.get("q") or "", filters, request.args.get("limit") or 20)
+    except Exception as e:
+        return jsonify({"error": f"Search failed: {e}"}), 400
+    return jsonify({"results": rows})
+
+
+@app.route("/archive/<int:result_id>")
+def archived_result(result_id):
+    with ARCHIVE_LOCK:
+        row = archive_conn().execute(
+            "SELECT * FROM results WHERE id = ? AND tenant = ?", (result_id, CURRENT_TENANT.get())
+        ).fetchone()
+    if row is None:
+        return jsonify({"error": "Not found."}), 404
+    return jsonify(dict(row))
+
+
+@app.route("/health/providers")
+def provider_health():
+    """Cached provider health and circuit state; never calls a provider."""
+    return jsonify({"providers": [HEALTH.snapshot(name) for name in PROVIDERS]})
+
+
+TRACES_HTML = """
+<!doctype html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Traces</title>
+<style>
+  body { font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', system-ui, sans-serif; margin: 16px; color: #111; }
+  table { border-collapse: collapse; font-size: 0.8rem; }
+  td, th { padding: 3px 8px; border-bottom: 1px solid #eee; text-align: left; }
+  tr.trace { cursor: pointer; }
+  tr.trace:hover { background: #f5f5f5; }
+  #chart { position: relative; margin-top: 16px; font-size: 0.72rem; }
+  .bar { position: absolute; height: 18px; line-height: 18px; overflow: hidden; white-space: nowrap;
+         background: #7aa6da; color: #fff; border-radius: 2px; padding: 0 3px; box-sizing: border-box; }
+  .bar.error { background: #d9534f; }
+  .bar.llm { background: #e58e26; }
+</style>
+</head>
+<body>
+  <h3>Recent traces</h3>
+  <table id="list"><tr><th>Time</th><th>Request</th><th>ms</th><th>Spans</th><th>Status</th></tr></table>
+  <div id="title"></div>
+  <div id="chart"></div>
+<script>
+// Admin token from ?token=..., sent as a header on the API calls
+const token = new URLSearchParams(location.search).get('token') || '';
+const auth = {headers: {'X-Admin-Token': token}};
+async function load(){
+  const r = await fetch('/traces', auth);
+  const data = await r.json();
+  const table = document.getElementById('list');
+  data.traces.forEach(t => {
+    const tr = document.createElement('tr');
+    tr.className = 'trace';
+    tr.innerHTML = '<td>' + new Date(t.start_ns / 1e6).toLocaleTimeString() + '</td><td>' + t.name + '</td><td>'
+      + t.duration_ms.toFixed(1) + '</td><td>' + t.spans + '</td><td>' + t.status + '</td>';
+    tr.onclick = () => show(t.trace_id);
+    table.appendChild(tr);
+  });
+}
+// Flamegraph-style timeline: x = time since the root started, y = nesting depth
+async function show(id){
+  const t = await (await fetch('/traces/' + id, auth)).json();
+  const chart = document.getElementById('chart');
+  chart.innerHTML = '';
+  const width = chart.clientWidth || 1000;
+  const t0 = t.start_ns, total = Math.max(1, t.duration_ms * 1e6);
+  const depth = {};
+  t.spans.forEach(s => { depth[s.span_id] = s.parent_id && depth[s.parent_id] !== undefined ? depth[s.parent_id] + 1 : 0; });
+  let maxDepth = 0;
+  t.spans.forEach(s => {
+    const d = depth[s.span_id];
+    maxDepth = Math.max(maxDepth, d);
+    const el = document.createElement('div');
+    const ms = (s.end_ns - s.start_ns) / 1e6;
+    el.className = 'bar' + (s.status === 'error' ? ' error' : (s.name.startsWith('llm.') ? ' llm' : ''));
+    el.style.left = ((s.start_ns - t0) / total * width) + 'px';
+    el.style.width = Math.max(2, (s.end_ns - s.start_ns) / total * width) + 'px';
+    el.style.top = (d * 20) + 'px';
+    el.textContent = s.name + ' ' + ms.toFixed(1) + ' ms';
+    el.title = s.name + ' (' + ms.toFixed(2) + ' ms, ' + s.thread + ')\\n' + JSON.stringify(s.attrs, null, 1);
+    chart.appendChild(el);
+  });
+  chart.style.height = ((maxDepth + 1) * 20 + 10) + 'px';
+  document.getElementById('title').innerHTML = '<h4>' + t.name + ' · ' + t.duration_ms.toFixed(1) + ' ms · '
+    + '<a href="/traces/' + id + '?format=otlp&token=' + encodeURIComponent(token) + '">OTLP JSON</a></h4>';
+}
+load();
+</script>
+</body>
+</html>
+"""
+
+
+@app.route("/traces")
+@admin_only
+def list_traces():
+    """Recent finished traces, newest first (summary only)."""
+    with _TRACES_LOCK:
+        traces = list(_recent_traces())
+    return jsonify({
+        "traces": [
+            {k: t[k] for k in ("trace_id", "name", "start_ns", "duration_ms", "status")} | {"spans": len(t["spans"])}
+            for t in reversed(traces)
+        ]
+    })
+
+
+@app.route("/traces/<trace_id>")
+@admin_only
+def get_trace(trace_id):
+    with _TRACES_LOCK:
+        trace = next((t for t in _recent_traces() if t["trace_id"] == trace_id), None)
+    if trace is None:
+        return jsonify({"error": "Unknown or expired trace."}), 404
+    return jsonify(otlp_payload(trace) if request.args.get("format") == "otlp" else trace)
+
+
+@app.route("/traces/view")
+@admin_only
+def traces_view():
+    return TRACES_HTML
+
+
+@app.route("/healthz")
+def healthz():
+    # Readiness probe used by run.py before navigating away from the splash screen
+    return jsonify({"status": "ok", "app_import_seconds": APP_IMPORT_SECONDS})
+
+
+@app.route("/debug/prefetch")
+@admin_only
+def debug_prefetch():
+    with PREFETCH.lock:
+        pending = len(PREFETCH.jobs)
+    return jsonify(dict(PREFETCH.stats, pending=pending))
+
+
+@app.route("/debug/gemini_files")
+@admin_only
+def debug_gemini_files():
+    with GEMINI_FILES.lock:
+        cached = len(GEMINI_FILES.handles)
+    return jsonify(dict(GEMINI_FILES.stats, cached=cached))
+
+
+@app.route("/debug/imports")
+@admin_only
+def debug_imports():
+    return jsonify(import_profile())
+
+
+@app.route("/admin/profile", methods=["GET"])
+@admin_only
+def admin_profile_status():
+    return jsonify(PROFILER.status())
+
+
+@app.route("/admin/profile/start", methods=["POST"])
+@admin_only
+def admin_profile_start():
+    """?mode=sampling|cprofile&seconds=N&interval_ms=5&all_threads=1; stops by itself after N seconds."""
+    args = request.values
+    try:
+        return jsonify(PROFILER.start(
+            args.get("mode") or "sampling",
+            float(args.get("seconds") or PROFILE_DEFAULT_SECONDS),
+            min(max(float(args.get("interval_ms") or 5), 1), 100) / 1000,
+            args.get("all_threads") in ("1", "true", "on"),
+        ))
+    except RuntimeError as e:
+        return jsonify({"error": str(e)}), 409
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+
+@app.route("/admin/profile/stop", methods=["POST"])
+@admin_only
+def admin_profile_stop():
+    result = PROFILER.stop()
+    if result is None:
+        return jsonify({"error": "No profile is running."}), 409
+    return jsonify(result)
+
+
+@app.route("/admin/profile/download")
+@admin_only
+def admin_profile_download():
+    """The last finished profile: ?format=pstats (cprofile), speedscope or folded (sampling), text (either)."""
+    sess = PROFILER.last
+    if sess is None:
+        return jsonify({"error": "No finished profile yet."}), 404
+    fmt = request.args.get("format") or ("pstats" if sess["mode"] == "cprofile" else "speedscope")
+    name = f"wow-{sess['mode']}-{sess['id']}"
+    if fmt == "text" or (fmt == "folded" and sess["mode"] == "sampling"):
+        return Response(PROFILER.text_report(sess), mimetype="text/plain")
+    if fmt == "pstats" and sess["mode"] == "cprofile":
+        return Response(
+            PROFILER.pstats_bytes(sess),
+            mimetype="application/octet-stream",
+            headers={"Content-Disposition": f'attachment; filename="{name}.pstats"'},
+        )
+    if fmt == "speedscope" and sess["mode"] == "sampling":
+        return Response(
+            json.dumps(PROFILER.speedscope(sess)),
+            mimetype="application/json",
+            headers={"Content-Disposition": f'attachment; filename="{name}.speedscope.json"'},
+        )
+    return jsonify({"error": f"Format {fmt!r} is not available for a {sess['mode']} profile."}), 400
+
+
+@app.route("/admin/memory/snapshot", methods=["POST"])
+@admin_only
+def admin_memory_snapshot():
+    """Snapshot traced allocations (?frames=N when this starts tracemalloc); returns the top sites by size."""
+    info = PROFILER.snapshot(int(request.values.get("frames") or 5))
+    group = "traceback" if request.values.get("group") == "traceback" else "lineno"
+    snap = PROFILER.snapshots[info["id"]]["snapshot"]
+    return jsonify(dict(info, top=memory_stats(snap.statistics(group), int(request.values.get("limit") or MEMORY_TOP))))
+
+
+@app.route("/admin/memory/diff", methods=["GET", "POST"])
+@admin_only
+def admin_memory_diff():
+    """Growth between ?base=<id> and ?to=<id> (default: a fresh snapshot), largest first."""
+    base = PROFILER.snapshots.get(request.values.get("base") or "")
+    if base is None:
+        return jsonify({"error": "Unknown or expired base snapshot.", "snapshots": list(PROFILER.snapshots)}), 404
+    to_id = request.values.get("to") or PROFILER.snapshot()["id"]
+    to = PROFILER.snapshots.get(to_id)
+    if to is None:
+        return jsonify({"error": "Unknown or expired snapshot."}), 404
+    group = "traceback" if request.values.get("group") == "traceback" else "lineno"
+    stats = to["snapshot"].compare_to(base["snapshot"], group)
+    return jsonify({
+        "base": request.values["base"],
+        "to": to_id,
+        "seconds": round(to["taken"] - base["taken"], 3),
+        "current_diff": to["current"] - base["current"],
+        "top": memory_stats(stats, int(request.values.get("limit") or MEMORY_TOP), diff=True),
+    })
+
+
+@app.route("/admin/memory/stop", methods=["POST"])
+@admin_only
+def admin_memory_stop():
+    PROFILER.stop_memory()
+    return jsonify({"tracing": tracemalloc.is_tracing()})
+
+
+APP_IMPORT_SECONDS = round(time.perf_counter() - _APP_IMPORT_STARTED, 4)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,109 @@
+# bench_transport.py
+"""
+Compare loopback HTTP (multipart POST to the embedded Flask server) with an
+in-process DesktopApi call for note/review payloads of growing size.
+
+The LLM call is replaced by an echo so only transport, form parsing and
+serialization are measured. The in-process side adds a JSON round trip of the
+arguments and result as a stand-in for pywebview's serialization; the real
+JS <-> Python bridge (the webview's IPC) is not exercised, so treat the
+"in-process" column as a lower bound for the desktop bridge.
+
+Caches that would turn repeated runs into lookups (note cache, single-flight,
+speculative prefetch, adaptive max_tokens) are disabled, and the ledger,
+sessions and secret key go to a temporary directory instead of the checkout.
+
+Usage: python bench_transport.py [repeats]
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import logging
+import tempfile
+import threading
+import urllib.request
+
+DATA_DIR = tempfile.mkdtemp(prefix="wow-bench-")
+os.environ.update(
+    WOW_LEDGER_DB=os.path.join(DATA_DIR, "usage.db"),
+    WOW_SESSION_DIR=os.path.join(DATA_DIR, "sessions"),
+    WOW_SECRET_KEY_FILE=os.path.join(DATA_DIR, "secret_key"),
+    WOW_ARCHIVE="0",
+    WOW_BUDGETS="{}",
+    WOW_NOTE_CACHE_MODE="off",
+    WOW_SINGLE_FLIGHT="0",
+    WOW_PREFETCH="0",
+    WOW_ADAPTIVE_MAX_TOKENS="0",
+    WOW_HEALTH_INTERVAL="0",
+)
+
+import app as wow  # noqa: E402  (configured through the environment above)
+
+
+def echo_llm(model, prompt, max_tokens=12000, temperature=0.2, **kwargs):
+    return {"text": prompt[-64:]}
+
+
+def multipart(fields):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(
+            "--%s\r\nContent-Disposition: form-data; name=\"%s\"\r\n\r\n%s\r\n" % (boundary, name, value)
+        )
+    parts.append("--%s--\r\n" % boundary)
+    return "".join(parts).encode("utf-8"), "multipart/form-data; boundary=" + boundary
+
+
+def time_it(fn, repeats):
+    fn()  # warm-up
+    started = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - started) / repeats * 1000
+
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    wow.call_llm = echo_llm
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+    from werkzeug.serving import make_server
+
+    server = make_server("127.0.0.1", 0, wow.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:%d" % server.server_port
+    api = wow.DesktopApi()
+
+    print("%-10s %-12s %12s %12s %8s" % ("payload", "operation", "http ms", "in-proc ms", "speedup"))
+    for size in (10_000, 100_000, 400_000):
+        note = ("Device meeting note line. " * (size // 26 + 1))[:size]
+        for op in ("transform_note", "run_review"):
+            fields = {"note": note, "submission": note, "checklist": "Checklist", "model": "gpt-4o-mini"}
+
+            def via_http():
+                body, ctype = multipart(fields)
+                req = urllib.request.Request(url + "/" + op, data=body, headers={"Content-Type": ctype})
+                with urllib.request.urlopen(req) as resp:
+                    json.loads(resp.read())
+
+            def in_process():
+                params = json.loads(json.dumps(fields))
+                json.dumps(getattr(api, op)(params))
+
+            http_ms = time_it(via_http, repeats)
+            local_ms = time_it(in_process, repeats)
+            print("%-10s %-12s %12.2f %12.2f %7.1fx" % (
+                "%dKB" % (size // 1000), op[:12], http_ms, local_ms, http_ms / max(local_ms, 1e-6)
+            ))
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    finally:
+        shutil.rmtree(DATA_DIR, ignore_errors=True)
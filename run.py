@@ -1,17 +1,103 @@
 # run.py
+import os
+import sys
+import json
+import time
+import logging
 import threading
+import urllib.request
 import webview
-from app import app
 
-def start_flask():
-    app.run(host="127.0.0.1", port=5000, debug=False)
+STARTED = time.perf_counter()
+log = logging.getLogger("wow.startup")
+
+# Shown instantly while the Flask app is imported and the server binds
+SPLASH_HTML = """
+<!doctype html>
+<html>
+<body style="margin:0;height:100vh;display:flex;align-items:center;justify-content:center;
+  font-family:-apple-system,BlinkMacSystemFont,'Segoe UI',system-ui,sans-serif;background:#fff;color:#111">
+  <div style="text-align:center">
+    <div style="font-size:0.8rem;opacity:0.7">WOW 510(k) Assistant</div>
+    <h2 style="margin:6px 0">Starting…</h2>
+    <div id="phase" style="font-size:0.8rem;opacity:0.7">Loading application</div>
+  </div>
+</body>
+</html>
+"""
+
+def phase(name, window=None):
+    ms = (time.perf_counter() - STARTED) * 1000
+    log.info("startup phase %-16s %8.1f ms", name, ms)
+    if window is not None:
+        try:
+            window.evaluate_js("document.getElementById('phase').textContent = %s" % json.dumps(name))
+        except Exception:
+            pass
+
+def start_server(port=0):
+    """Import the app and serve it on 127.0.0.1; port 0 binds an ephemeral port."""
+    from werkzeug.serving import make_server
+    from app import app
+
+    phase("app imported")
+    server = make_server("127.0.0.1", port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="flask", daemon=True).start()
+    return server.server_port
+
+def wait_ready(url, timeout=30.0):
+    """Poll the health endpoint until the server answers."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=1) as resp:
+                if resp.status == 200:
+                    return True
+        except Exception:
+            time.sleep(0.05)
+    return False
+
+def expose_bridge(window):
+    """Expose DesktopApi methods as window.pywebview.api.* (in-process, no HTTP)."""
+    from app import DesktopApi
+
+    api = DesktopApi()
+    api._attach(window)
+    window.expose(*[
+        getattr(api, name) for name in dir(api)
+        if not name.startswith("_") and callable(getattr(api, name))
+    ])
+
+def boot(window):
+    """Runs once the splash window is shown: start the server, wait for readiness, navigate."""
+    phase("window shown", window)
+    port = start_server(int(os.getenv("WOW_PORT", "0")))
+    phase("server bound", window)
+    base = "http://127.0.0.1:%d" % port
+    if not wait_ready(base + "/healthz"):
+        phase("server not ready", window)
+        return
+    phase("server ready", window)
+    if "--bridge" in sys.argv or os.getenv("WOW_BRIDGE") == "1":
+        expose_bridge(window)
+        phase("bridge exposed")
+    window.load_url(base)
+    phase("navigated")
+
+    # Heavy SDKs (openai, google-genai, PyMuPDF) load after the UI is up
+    from app import import_profile, warm_imports
+
+    t = warm_imports()
+    if "--profile-imports" in sys.argv:
+        t.join()
+        print(json.dumps(import_profile(), indent=2))
 
 if __name__ == "__main__":
-    # Run Flask in a separate thread
-    t = threading.Thread(target=start_flask)
-    t.daemon = True
-    t.start()
-
-    # Open PyWebView window pointing to Flask app
-    webview.create_window("My Flask App", "http://127.0.0.1:5000")
-    webview.start()
+    import multiprocessing
+
+    multiprocessing.freeze_support()  # OCR workers are spawned, which re-enters frozen builds here
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(message)s")
+    window = webview.create_window("My Flask App", html=SPLASH_HTML)
+    phase("window created")
+    # Keep cookies between launches: the server-issued tenant cookie is the user's identity
+    webview.start(boot, window, private_mode=False)
@@ -0,0 +1,20 @@
+"""Test setup: every on-disk store of app.py goes to a throwaway directory."""
+import os
+import shutil
+import tempfile
+
+DATA_DIR = tempfile.mkdtemp(prefix="wow-tests-")
+os.environ.update(
+    WOW_LEDGER_DB=os.path.join(DATA_DIR, "usage.db"),
+    WOW_ARCHIVE_DB=os.path.join(DATA_DIR, "archive.db"),
+    WOW_SESSION_DIR=os.path.join(DATA_DIR, "sessions"),
+    WOW_SECRET_KEY_FILE=os.path.join(DATA_DIR, "secret_key"),
+    WOW_TRACE_DIR="",
+    WOW_OTLP_ENDPOINT="",
+    WOW_HEALTH_INTERVAL="0",
+    WOW_BUDGETS="{}",
+)
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(DATA_DIR, ignore_errors=True)
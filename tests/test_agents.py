@@ -0,0 +1,30 @@
+import os
+import subprocess
+import sys
+
+import app as wow
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_import_does_not_load_agents():
+    code = "import sys, app; print(app.AGENTS is None, 'yaml' in sys.modules)"
+    out = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True).stdout
+    assert out.split() == ["True", "False"]
+
+
+def test_agents_load_once_on_first_use(monkeypatch):
+    reads = []
+    agent = {"id": "1", "name": "Labeling", "description": "", "prompt": "p", "default_model": "m", "max_tokens": 100}
+    monkeypatch.setattr(wow, "_read_agents", lambda: reads.append(1) or [agent])
+    monkeypatch.setattr(wow, "AGENTS", None)
+    assert wow.agents() == [agent] and wow.agents() == [agent]
+    assert len(reads) == 1
+    wow.load_agents()  # explicit reload
+    assert len(reads) == 2
+
+
+def test_index_lists_agents(monkeypatch):
+    agent = {"id": "7", "name": "Biocompat reviewer", "description": "", "prompt": "p", "default_model": "m", "max_tokens": 100}
+    monkeypatch.setattr(wow, "AGENTS", [agent])
+    assert "Biocompat reviewer" in wow.app.test_client().get("/").get_data(as_text=True)
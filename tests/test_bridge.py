@@ -0,0 +1,42 @@
+import app as wow
+
+
+def bridge(tenant="t-bridge"):
+    return wow.DesktopApi(), wow.tenant_token(tenant)
+
+
+def test_run_restores_the_endpoint(monkeypatch):
+    seen = []
+    monkeypatch.setitem(wow.OPERATIONS, "probe", lambda form, files=None: (seen.append(wow.CURRENT_ENDPOINT.get()) or {}, 200))
+    before = wow.CURRENT_ENDPOINT.get()
+    api, token = bridge()
+    api._run("probe", {"tenant_token": token})
+    assert seen == ["probe"] and wow.CURRENT_ENDPOINT.get() == before
+
+
+def test_sessions_round_trip_through_the_bridge():
+    api, token = bridge()
+    sid = api.create_session({"tenant_token": token})["session_id"]
+    res = api.update_session({"tenant_token": token, "session_id": sid, "fields": {"note": "hello world"}})
+    assert res == {"status": "ok", "fields": {"note": 11}}
+    delta = {"field": "note", "start": 6, "end": 11, "text": "there", "base_len": 11}
+    assert api.update_session({"tenant_token": token, "session_id": sid, "deltas": [delta]})["status"] == "ok"
+    with wow.use_tenant("t-bridge"):
+        assert wow.SESSIONS.get(sid)["note"] == "hello there"
+
+
+def test_bridge_session_errors_carry_the_http_status():
+    api, token = bridge()
+    res = api.update_session({"tenant_token": token, "session_id": "nosuchid", "fields": {"note": "x"}})
+    assert res == {"error": "Unknown session.", "http_status": 404}
+    sid = api.create_session({"tenant_token": token})["session_id"]
+    _, other = bridge("t-someone-else")
+    assert api.update_session({"tenant_token": other, "session_id": sid, "fields": {"note": "x"}})["http_status"] == 404
+
+
+def test_http_session_routes_match_the_bridge():
+    client = wow.app.test_client()
+    sid = client.post("/session").get_json()["session_id"]
+    res = client.post(f"/session/{sid}/update", json={"fields": {"note": "abc"}})
+    assert res.status_code == 200 and res.get_json()["fields"] == {"note": 3}
+    assert client.post("/session/nosuchid/update", json={"fields": {}}).status_code == 404
@@ -0,0 +1,122 @@
+import threading
+
+import pytest
+
+import app as wow
+
+MODEL = "budget-model"
+
+
+@pytest.fixture
+def budgets(monkeypatch):
+    budgets = {"prices": {MODEL: [1e6, 0, 1e6], "cheap-model": [0, 0, 0]}}  # $1 per token
+    monkeypatch.setattr(wow, "BUDGETS", budgets)
+    monkeypatch.setattr(wow, "SPEND", wow.MonthSpend())
+    return budgets
+
+
+def spend(tenant, dollars, model=MODEL, coalesced=False):
+    with wow.use_tenant(tenant):
+        wow.record_usage(model, {"prompt_tokens": dollars, "completion_tokens": 0}, 0.1, True, coalesced=coalesced)
+
+
+def test_tenant_limit_and_default(budgets):
+    budgets["tenants"] = {"*": 5, "t-big": 50}
+    spend("t-small", 5)
+    spend("t-big", 5)
+    with wow.use_tenant("t-small"):
+        assert wow.apply_budget(MODEL, 100)[2] == "Monthly LLM budget exhausted for this user."
+    with wow.use_tenant("t-big"):
+        assert wow.apply_budget(MODEL, 100) == (MODEL, 100, None)
+
+
+def test_model_limit_falls_back_and_caps(budgets):
+    limit = wow.SPEND.get(model=MODEL) + 3  # other tests spend on MODEL too
+    budgets.update(models={MODEL: limit}, fallback_models={MODEL: "cheap-model"}, max_tokens_cap={"cheap-model": 64})
+    with wow.use_tenant("t-model"):
+        assert wow.apply_budget(MODEL, 1000) == (MODEL, 1000, None)
+        spend("t-model", 3)
+        assert wow.apply_budget(MODEL, 1000) == ("cheap-model", 64, None)
+        del budgets["fallback_models"]
+        assert "exhausted" in wow.apply_budget(MODEL, 1000)[2]
+
+
+def test_budget_checks_use_running_totals(budgets, monkeypatch):
+    budgets.update(monthly_usd=10**9, tenants={"*": 10**9}, models={MODEL: 10**9})
+    wow.SPEND.get()  # load from the ledger once
+    queries = []
+    real = wow.ledger_conn
+
+    def counting_conn():
+        conn = real()
+        queries.append(conn)
+        return conn
+
+    monkeypatch.setattr(wow, "ledger_conn", counting_conn)
+    with wow.use_tenant("t-fast"):
+        for _ in range(20):
+            assert wow.apply_budget(MODEL, 100)[2] is None
+    assert queries == []
+    spend("t-fast", 7)  # counted in memory as it is written
+    assert wow.SPEND.get(tenant="t-fast") == 7
+
+
+def test_totals_reload_from_ledger(budgets):
+    spend("t-reload", 4)
+    assert wow.MonthSpend().get(tenant="t-reload") == wow.month_spend(tenant="t-reload") == 4
+
+
+def test_coalesced_waiter_is_charged_but_provider_spend_counted_once(budgets, monkeypatch):
+    release, entered = threading.Event(), threading.Event()
+
+    def slow_provider(model, prompt, max_tokens, temperature, response_schema):
+        entered.set()
+        release.wait(5)
+        return {"text": "answer", "usage": {"prompt_tokens": 2, "completion_tokens": 1}, "finish_reason": "stop"}
+
+    monkeypatch.setattr(wow, "SINGLE_FLIGHT", True)
+    monkeypatch.setattr(wow, "_call_provider", slow_provider)
+    monkeypatch.setattr(wow, "HEALTH", wow.ProviderHealth())
+    server, model_before = wow.SPEND.get(), wow.SPEND.get(model=MODEL)
+    coalesced = wow.CALL_FLIGHTS.stats["coalesced"]
+    results = {}
+
+    def call(tenant):
+        with wow.use_tenant(tenant):
+            results[tenant] = wow.call_llm(MODEL, "same prompt", max_tokens=10)
+
+    leader = threading.Thread(target=call, args=("t-leader",))
+    leader.start()
+    assert entered.wait(5)
+    waiter = threading.Thread(target=call, args=("t-waiter",))
+    waiter.start()
+    for _ in range(500):
+        if wow.CALL_FLIGHTS.stats["coalesced"] > coalesced:
+            break
+        threading.Event().wait(0.01)
+    release.set()
+    leader.join(5)
+    waiter.join(5)
+    assert results["t-waiter"].get("coalesced") is True
+    assert wow.SPEND.get(tenant="t-leader") == wow.SPEND.get(tenant="t-waiter") == 3
+    assert wow.SPEND.get() - server == wow.SPEND.get(model=MODEL) - model_before == 3
+    assert wow.month_spend() == wow.MonthSpend().get()
+
+
+def test_old_ledger_gains_coalesced_column(monkeypatch, tmp_path):
+    import sqlite3
+
+    path = str(tmp_path / "old.db")
+    old = sqlite3.connect(path)
+    old.executescript(
+        wow.LEDGER_SCHEMA.replace(",\n    coalesced INTEGER NOT NULL DEFAULT 0", "")
+        .replace(",\n           SUM(coalesced) AS coalesced", "")
+        .replace(", SUM(coalesced) AS coalesced", "")
+    )
+    old.close()
+    monkeypatch.setattr(wow, "LEDGER_DB", path)
+    monkeypatch.setattr(wow, "_LEDGER_CONN", None)
+    conn = wow.ledger_conn()
+    assert "coalesced" in {r[1] for r in conn.execute("PRAGMA table_info(usage)")}
+    assert "coalesced" in conn.execute("SELECT * FROM usage_monthly").description[-1]
+    conn.close()
@@ -0,0 +1,49 @@
+import random
+
+import app as wow
+
+WORDS = "device sterile catheter predicate biocompatibility testing shelf life labeling software hazard bench".split()
+
+
+def body(seed):
+    rnd = random.Random(seed)
+    return "\n".join(" ".join(rnd.choice(WORDS) for _ in range(12)) for _ in range(8))
+
+
+def pages(n=5):
+    return [
+        f"ACME CONFIDENTIAL\n## Device Description [p. {i}]\n\n{body(i)}\n\nPage {i} of {n}"
+        for i in range(1, n + 1)
+    ]
+
+
+def test_compact_text_squeezes_layout_noise():
+    text = "Contents\n1. Scope ........ 4\n\n\n\n   -   indented    item\n12\n"
+    assert wow.compact_text(text) == "Contents\n1. Scope 4\n\n   - indented item"
+
+
+def test_compact_pages_strips_repeated_headers_but_not_headings():
+    out, stats = wow.compact_pages(pages())
+    assert all("ACME CONFIDENTIAL" not in p and "Page " not in p for p in out)
+    assert all(f"## Device Description [p. {i}]" in p for i, p in enumerate(out, 1))
+    assert stats["boilerplate_lines"] == 10 and stats["uncompacted_pages"] == 0
+    assert stats["ratio"] < 1.0
+
+
+def test_anchor_lines_are_never_boilerplate():
+    anchored = [f"[p. {i}]\n{body(i)}" for i in range(1, 5)]
+    out, _ = wow.compact_pages(anchored)
+    assert all(p.startswith(f"[p. {i}]") for i, p in enumerate(out, 1))
+
+
+def test_page_that_would_lose_most_content_is_kept():
+    same = ["HEADER\n" + "the same sentence on every page\n" * 20 for _ in range(4)]
+    out, stats = wow.compact_pages(same)
+    assert out == same and stats["uncompacted_pages"] == 4
+
+
+def test_compact_source_honors_switch(monkeypatch):
+    text, _, stats = wow.compact_source("a    b\n\n\n\nc")
+    assert text == "a b\n\nc" and stats["chars_in"] == 11
+    monkeypatch.setattr(wow, "COMPACT_ENABLED", False)
+    assert wow.compact_source("a    b", ["a    b"]) == ("a    b", ["a    b"], None)
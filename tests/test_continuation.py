@@ -0,0 +1,81 @@
+import app as wow
+
+
+def test_stitch_trims_overlap():
+    previous = "The device is sterilized by ethylene oxide and"
+    assert wow.stitch(previous, "ethylene oxide and packaged in Tyvek.") == " packaged in Tyvek."
+
+
+def test_stitch_drops_restated_last_line():
+    previous = "- item one\n- item two is long"
+    assert wow.stitch(previous, "- item two is long enough\n- item three") == " enough\n- item three"
+
+
+def test_stitch_unwraps_spurious_code_fence():
+    previous = "Summary so far"
+    assert wow.stitch(previous, "```markdown\n and the rest.\n```") == " and the rest.\n"
+
+
+def test_stitch_keeps_fence_opened_by_previous_text():
+    previous = "```python\nx = 1\n"
+    assert wow.stitch(previous, "```\nmore") == "```\nmore"
+
+
+def test_stitch_without_overlap_appends_piece():
+    assert wow.stitch("abc", "completely new text") == "completely new text"
+
+
+def test_continued_call_stitches_rounds(monkeypatch):
+    pieces = iter([
+        {"text": "Findings: the predicate device is", "finish_reason": "length", "usage": {"completion_tokens": 10}},
+        {"text": "predicate device is cleared under K123456.", "finish_reason": "stop", "usage": {"completion_tokens": 10}},
+    ])
+    prompts = []
+
+    def fake_call(model, prompt, max_tokens=0, **kwargs):
+        prompts.append(prompt)
+        return next(pieces)
+
+    monkeypatch.setattr(wow, "call_llm", fake_call)
+    res = wow.call_llm_continued("gpt-4o-mini", "Review.", max_tokens=100, per_call=10)
+    assert res["text"] == "Findings: the predicate device is cleared under K123456."
+    assert res["continuations"] == 1
+    assert res["usage"]["completion_tokens"] == 20
+    assert "cut off" in prompts[1]
+
+
+def test_continued_call_respects_total_budget(monkeypatch):
+    monkeypatch.setattr(
+        wow, "call_llm",
+        lambda model, prompt, max_tokens=0, **kw: {"text": "x" * 40, "finish_reason": "length", "usage": {"completion_tokens": 10}},
+    )
+    res = wow.call_llm_continued("gpt-4o-mini", "p", max_tokens=20, per_call=10)
+    assert res["continuations"] == 1
+
+
+def test_adaptive_seed_uses_stitched_totals_not_pieces(monkeypatch):
+    endpoint, model = "seed-test", "gpt-4o-mini"
+    monkeypatch.setattr(wow, "OUTPUT_STATS", {})
+    monkeypatch.setattr(wow, "ADAPTIVE_MAX_TOKENS", True)
+    token = wow.CURRENT_ENDPOINT.set(endpoint)
+    try:
+        # Each logical answer is 300 tokens, delivered as a 250-token piece cut at the limit plus 50 more
+        for _ in range(wow.ADAPTIVE_MIN_SAMPLES):
+            pieces = iter([
+                {"text": "a" * 1000, "finish_reason": "length", "usage": {"completion_tokens": 250}},
+                {"text": "b" * 200, "finish_reason": "stop", "usage": {"completion_tokens": 50}},
+            ])
+            monkeypatch.setattr(wow, "call_llm", lambda *a, **kw: next(pieces))
+            wow.call_llm_adaptive(model, "p", max_tokens=4000)
+            # What call_llm itself logs per piece: rows that must not feed the seed
+            wow.record_usage(model, {"completion_tokens": 250}, 0.1, True)
+            wow.record_usage(model, {"completion_tokens": 50}, 0.1, True)
+    finally:
+        wow.CURRENT_ENDPOINT.reset(token)
+    with wow.LEDGER_LOCK:
+        rows = wow.ledger_conn().execute(
+            "SELECT tokens FROM output_lengths WHERE endpoint = ? AND model = ?", (endpoint, model)
+        ).fetchall()
+    assert [r[0] for r in rows] == [300] * wow.ADAPTIVE_MIN_SAMPLES
+    monkeypatch.setattr(wow, "OUTPUT_STATS", {})  # a restart: samples come back from the ledger
+    assert wow.choose_max_tokens(endpoint, "", model, 4000) == int(300 * wow.ADAPTIVE_HEADROOM) + 64
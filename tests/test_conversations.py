@@ -0,0 +1,68 @@
+import re
+import shutil
+import subprocess
+
+import pytest
+
+import app as wow
+
+
+def conv(tenant, cache=None):
+    return {"tenant": tenant, "gemini_cache": cache, "turns": []}
+
+
+def test_conversations_are_private_to_their_tenant():
+    store = wow.ConversationStore(ttl=3600, max_items=10)
+    c = store.start(conv("alice"))
+    assert store.get(c["id"], "alice") is c
+    assert store.get(c["id"], "bob") is None
+    assert store.end(c["id"], "bob") is False
+    assert store.end(c["id"], "alice") is True
+    assert store.get(c["id"], "alice") is None
+
+
+def test_idle_and_evicted_conversations_release_their_cache(monkeypatch):
+    released = []
+    monkeypatch.setattr(wow, "delete_gemini_cache", lambda tenant, name: released.append(name))
+    store = wow.ConversationStore(ttl=3600, max_items=2)
+    first = store.start(conv("t", "cachedContents/1"))
+    second = store.start(conv("t"))
+    store.get(first["id"], "t")  # touch: second is now least recently used
+    store.start(conv("t", "cachedContents/3"))
+    assert store.get(second["id"], "t") is None and store.get(first["id"], "t") is first
+    first["touched"] -= 7200
+    store.start(conv("t"))
+    assert store.get(first["id"], "t") is None
+    for thread in list(wow.threading.enumerate()):
+        if thread.name == "qa-cache-delete":
+            thread.join(timeout=5)
+    assert released == ["cachedContents/1"]
+
+
+def test_history_keeps_recent_turns_trimmed():
+    turns = [{"question": f"q{i}", "answer": "a" * 5000} for i in range(10)]
+    history = wow.qa_history(turns)
+    assert history.startswith("EARLIER QUESTIONS AND ANSWERS:")
+    assert history.count("Q: ") == wow.QA_HISTORY_TURNS and "q9" in history and "q0" not in history
+    assert "a" * (wow.QA_HISTORY_ANSWER_CHARS + 1) not in history
+    assert wow.qa_history([]) == ""
+
+
+def test_openai_cache_hint_follows_conversation_context():
+    assert wow.openai_cache_hint() == {}
+    token = wow.PROMPT_CACHE.set({"key": "conv-1"})
+    try:
+        assert wow.openai_cache_hint() == {"extra_body": {"prompt_cache_key": "conv-1"}}
+        assert wow.pinned_to_gemini() is False
+    finally:
+        wow.PROMPT_CACHE.reset(token)
+
+
+def test_index_page_script_parses():
+    node = shutil.which("node")
+    if node is None:
+        pytest.skip("node is not installed")
+    html = wow.app.test_client().get("/").get_data(as_text=True)
+    script = "\n".join(re.findall(r"<script>(.*?)</script>", html, re.S))
+    check = subprocess.run([node, "--check", "-"], input=script, capture_output=True, text=True)
+    assert check.returncode == 0, check.stderr
@@ -0,0 +1,16 @@
+import pytest
+
+import app as wow
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(wow, "ADMIN_TOKEN", "admin-secret")
+    return wow.app.test_client()
+
+
+@pytest.mark.parametrize("path", ["/debug/prefetch", "/debug/gemini_files", "/debug/imports"])
+def test_debug_routes_are_admin_only(client, path):
+    assert client.get(path).status_code == 403
+    assert client.get(path, headers={"X-Admin-Token": "wrong"}).status_code == 403
+    assert client.get(path, headers={"X-Admin-Token": "admin-secret"}).status_code == 200
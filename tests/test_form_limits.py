@@ -0,0 +1,69 @@
+import base64
+import io
+
+import pytest
+from flask import request
+
+import app as wow
+
+
+def parse(data):
+    with wow.app.test_request_context("/", method="POST", data=data, content_type="multipart/form-data"):
+        return dict(request.form), dict(request.files), list(request.truncated_fields)
+
+
+def test_small_fields_stay_strings():
+    form, files, truncated = parse({"note": "short note", "model": "gpt-4o-mini"})
+    assert form == {"note": "short note", "model": "gpt-4o-mini"} and not truncated
+
+
+def test_large_field_is_spooled(monkeypatch):
+    monkeypatch.setattr(wow, "FORM_SPOOL_BYTES", 1024)
+    text = "é" * 5000
+    form, _, truncated = parse({"note": text})
+    field = form["note"]
+    assert isinstance(field, wow.SpooledField)
+    assert field.read(10) == "é" * 10
+    assert str(field) == text and not truncated
+    assert wow.form_text(form, "note", limit=3) == "ééé"
+
+
+def test_oversized_field_is_truncated(monkeypatch):
+    monkeypatch.setattr(wow, "FORM_SPOOL_BYTES", 1024)
+    monkeypatch.setattr(wow, "FORM_FIELD_MAX_BYTES", 4096)
+    form, _, truncated = parse({"note": "x" * 10000, "model": "m"})
+    assert len(form["note"]) == 4096 and form["note"].truncated
+    assert truncated == ["note"] and form["model"] == "m"
+
+
+def test_parser_reports_truncation_without_a_request(monkeypatch):
+    monkeypatch.setattr(wow, "FORM_FIELD_MAX_BYTES", 10)
+    body = b"--b\r\nContent-Disposition: form-data; name=\"note\"\r\n\r\n" + b"y" * 50 + b"\r\n--b--\r\n"
+    parser = wow.SpoolingFormDataParser()
+    _, form, _ = parser.parse(io.BytesIO(body), "multipart/form-data", len(body), {"boundary": "b"})
+    assert form["note"] == "y" * 10 and parser.truncated_fields == ["note"]
+
+
+def test_upload_is_streamed_to_file():
+    payload = b"%PDF-1.4 fake" * 100
+    data = {"file": (io.BytesIO(payload), "doc.pdf")}
+    with wow.app.test_request_context("/", method="POST", data=data, content_type="multipart/form-data"):
+        upload = request.files["file"]
+        assert upload.filename == "doc.pdf"
+        assert upload.stream.read() == payload
+
+
+def test_bridge_payload_truncates_like_http(monkeypatch):
+    monkeypatch.setattr(wow, "FORM_FIELD_MAX_BYTES", 100)
+    fields, files, truncated = wow.bridge_payload({"note": "é" * 80, "model": "m"})
+    assert truncated == ["note"] and len(fields["note"].encode("utf-8")) <= 100
+    assert fields["model"] == "m" and files == {}
+
+
+def test_bridge_payload_decodes_upload_and_refuses_oversized(monkeypatch):
+    data = base64.b64encode(b"hello " * 50).decode()
+    _, files, _ = wow.bridge_payload({}, {"name": "a.txt", "data": data})
+    assert files["file"].stream.read() == b"hello " * 50
+    monkeypatch.setitem(wow.app.config, "MAX_CONTENT_LENGTH", 100)
+    with pytest.raises(ValueError):
+        wow.bridge_payload({}, {"name": "a.txt", "data": data})
@@ -0,0 +1,94 @@
+import io
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import app as wow
+
+
+class FakeFiles:
+    def __init__(self):
+        self.uploads = []
+        self.gate = None
+        self.fail = False
+
+    def upload(self, file, config):
+        if self.gate is not None:
+            self.gate.wait(5)
+        if self.fail:
+            raise RuntimeError("quota")
+        self.uploads.append(config["display_name"])
+        n = len(self.uploads)
+        return SimpleNamespace(
+            name=f"files/{n}", uri=f"https://files/{n}", mime_type="application/pdf",
+            state=SimpleNamespace(name="ACTIVE"), expiration_time=None,
+        )
+
+
+@pytest.fixture
+def files(monkeypatch):
+    fake = FakeFiles()
+    real_import = wow.lazy_import
+    monkeypatch.setattr(wow, "lazy_import", lambda name: object() if name == "google.genai" else real_import(name))
+    monkeypatch.setattr(wow, "gemini_client", lambda genai, key, timeout=None: SimpleNamespace(files=fake))
+    monkeypatch.setitem(wow.API_KEYS, "gemini", "server-key")
+    store = wow.GeminiFiles()
+    store.fake = fake
+    return store
+
+
+def pdf():
+    return io.BytesIO(b"%PDF-1.4 test")
+
+
+def test_handle_is_reused_by_document_hash(files):
+    first = files.upload(pdf(), "sha-a", "a.pdf")
+    again = files.upload(pdf(), "sha-a", "a.pdf")
+    assert first["reused"] is False and again["reused"] is True
+    assert again["uri"] == first["uri"] and files.fake.uploads == ["a.pdf"]
+    files.upload(pdf(), "sha-b", "b.pdf")
+    assert files.fake.uploads == ["a.pdf", "b.pdf"]
+
+
+def test_handles_are_per_credential(files, monkeypatch):
+    files.upload(pdf(), "sha-a", "a.pdf")
+    monkeypatch.setitem(wow.TENANT_KEYS, "t-own-key", {"gemini": "tenant-key"})
+    with wow.use_tenant("t-own-key"):
+        assert files.get("sha-a") is None
+        assert files.upload(pdf(), "sha-a", "a.pdf")["reused"] is False
+    assert len(files.fake.uploads) == 2
+
+
+def test_handle_near_expiry_is_not_reused(files):
+    handle = files.upload(pdf(), "sha-a", "a.pdf")
+    with files.lock:
+        files.handles[files._key("sha-a")]["expires"] = time.time() + wow.GEMINI_FILE_MARGIN - 1
+    assert files.get("sha-a") is None
+    assert files.upload(pdf(), "sha-a", "a.pdf")["uri"] != handle["uri"]
+
+
+def test_concurrent_uploads_are_coalesced(files):
+    files.fake.gate = threading.Event()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(files.upload(pdf(), "sha-a", "a.pdf"))) for _ in range(3)]
+    for t in threads:
+        t.start()
+    for _ in range(500):
+        if files.flights.stats["coalesced"] == 2:
+            break
+        time.sleep(0.01)
+    files.fake.gate.set()
+    for t in threads:
+        t.join(5)
+    assert files.fake.uploads == ["a.pdf"]
+    assert sorted(r["reused"] for r in results) == [False, True, True]
+
+
+def test_failed_upload_is_not_cached(files):
+    files.fake.fail = True
+    assert "quota" in files.upload(pdf(), "sha-a", "a.pdf")["error"]
+    assert files.get("sha-a") is None and files.stats["failed"] == 1
+    files.fake.fail = False
+    assert "error" not in files.upload(pdf(), "sha-a", "a.pdf")
@@ -0,0 +1,69 @@
+import json
+
+import pytest
+
+import app as wow
+
+REPORT = {
+    "summary": "Two gaps, one \"critical\".",
+    "score": -12.5e1,
+    "complete": False,
+    "reviewer": None,
+    "meta": {"pages": 3, "notes": ["not", "emitted"]},
+    "findings": [
+        {"checklist_item": "Predicate device", "status": "met", "page": 2},
+        {"checklist_item": "Labeling [21 CFR 801]", "status": "not_met", "detail": "}{ braces in text"},
+    ],
+    "actions": ["Add labeling", 7, True],
+}
+
+
+def feed_in_chunks(text, size):
+    parser, events = wow.JSONStreamParser(), []
+    for i in range(0, len(text), size):
+        events += parser.feed(text[i:i + size])
+    return parser, events
+
+
+EXPECTED = [
+    ("summary", REPORT["summary"]),
+    ("score", REPORT["score"]),
+    ("complete", False),
+    ("reviewer", None),
+    ("findings", REPORT["findings"][0]),
+    ("findings", REPORT["findings"][1]),
+    ("actions", "Add labeling"),
+    ("actions", 7),
+    ("actions", True),
+]
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64, 10_000])
+def test_split_chunks_give_the_same_events(size):
+    text = json.dumps(REPORT, indent=2 if size % 2 else None)
+    parser, events = feed_in_chunks(text, size)
+    assert events == EXPECTED
+    assert parser.result() == REPORT
+
+
+def test_number_is_emitted_only_once_it_is_terminated():
+    parser = wow.JSONStreamParser()
+    assert parser.feed('{"count": 12') == []
+    assert parser.feed("34") == []
+    assert parser.feed("}") == [("count", 1234)]
+
+
+def test_fenced_output_still_parses():
+    text = "```json\n" + json.dumps(REPORT) + "\n```"
+    parser, events = feed_in_chunks(text, 5)
+    assert events == EXPECTED and parser.result() == REPORT
+
+
+def test_streamed_review_archives_the_submission(monkeypatch):
+    archived = []
+    monkeypatch.setattr(wow, "remember_result", lambda form, kind, text, source="": archived.append((kind, source)))
+    events = list(wow.stream_review_events(
+        {}, "gpt-4o-mini", "prompt", 1000, prefetched={"text": json.dumps(REPORT)}, submission="the 510(k) text",
+    ))
+    assert [e["type"] for e in events] == ["item"] * len(EXPECTED) + ["done"]
+    assert events[-1]["report"] == REPORT and archived == [("review", "the 510(k) text")]
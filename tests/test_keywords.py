@@ -0,0 +1,40 @@
+import app as wow
+
+NOTE = """Biocompatibility testing per ISO 10993 is planned for the catheter.
+
+The catheter shaft uses the same polymer as the predicate device.
+Sterilization validation covers the catheter shaft and the hub.
+
+Open items: shelf life testing and biocompatibility of the hub adhesive."""
+
+
+def test_extract_keywords_ranks_repeated_and_regulatory_terms():
+    keywords = wow.extract_keywords(NOTE, top_n=6)
+    words = [k["keyword"].lower() for k in keywords]
+    assert len(keywords) <= 6
+    # 510(k) vocabulary is boosted above ordinary repeated words ...
+    assert "biocompatibility" in words and "iso 10993" in words
+    # ... which still make the list when there is room
+    assert any("catheter" in k["keyword"].lower() for k in wow.extract_keywords(NOTE, top_n=12))
+    assert keywords == sorted(keywords, key=lambda k: k["score"], reverse=True)
+    for i, a in enumerate(words):  # chosen keywords never overlap
+        assert not any(set(a.split()) & set(b.split()) for b in words[i + 1:])
+
+
+def test_extract_keywords_on_empty_text():
+    assert wow.extract_keywords("") == []
+
+
+def test_highlight_skips_code_and_links():
+    keywords = [{"keyword": "catheter", "score": 1.0, "count": 2}]
+    text = "The catheter is `catheter_id` and [catheter](http://x/catheter)."
+    out = wow.highlight_keywords(text, keywords)
+    assert out.count(wow.KEYWORD_SPAN.format("catheter")) == 2
+    assert "`catheter_id`" in out and "(http://x/catheter)" in out
+
+
+def test_annotate_note_adds_summary_once():
+    text, keywords = wow.annotate_note("# Organized\n\nThe catheter shaft.", NOTE)
+    assert keywords and text.count("## Keyword summary") == 1
+    again, _ = wow.annotate_note(text, NOTE)
+    assert again.count("## Keyword summary") == 1
@@ -0,0 +1,76 @@
+import threading
+import time
+
+import pytest
+
+import app as wow
+
+
+class FakeLlama:
+    def __init__(self, n_chunks, delay=0.0):
+        self.n_chunks = n_chunks
+        self.delay = delay
+        self.produced = 0
+
+    def create_chat_completion(self, messages, stream=False, **kwargs):
+        def chunks():
+            for i in range(self.n_chunks):
+                time.sleep(self.delay)
+                self.produced += 1
+                yield {"choices": [{"delta": {"content": f"t{i} "}, "finish_reason": None}]}
+            yield {"choices": [{"delta": {}, "finish_reason": "stop"}]}
+
+        return chunks()
+
+
+@pytest.fixture
+def llama(monkeypatch):
+    fake = FakeLlama(n_chunks=5)
+    monkeypatch.setattr(wow, "LOCAL_LLM_URL", "")
+    monkeypatch.setattr(wow, "LOCAL_MODEL_PATH", "/models/fake.gguf")
+    monkeypatch.setattr(wow, "_local_llama", lambda: fake)
+    return fake
+
+
+def wait_unlocked(timeout=5.0):
+    acquired = wow._LOCAL_LLAMA_LOCK.acquire(timeout=timeout)
+    if acquired:
+        wow._LOCAL_LLAMA_LOCK.release()
+    return acquired
+
+
+def test_stream_local_yields_deltas_and_finish(llama):
+    events = list(wow._stream_local("local", "hi", 100, 0.2, None))
+    assert "".join(e.get("delta", "") for e in events) == "t0 t1 t2 t3 t4 "
+    assert events[-1] == {"done": True, "finish_reason": "stop"}
+    assert wait_unlocked(0.1)
+
+
+def test_closed_stream_releases_the_lock(llama):
+    llama.n_chunks, llama.delay = 10_000, 0.001
+    stream = wow._stream_local("local", "hi", 100, 0.2, None)
+    next(stream)
+    stream.close()
+    assert wait_unlocked()
+    assert llama.produced < 10_000
+
+
+def test_abandoned_stream_does_not_hold_the_lock(llama):
+    llama.n_chunks = 50
+    stream = wow._stream_local("local", "hi", 100, 0.2, None)
+    next(stream)  # read once, then never touched again (but still referenced)
+    assert wait_unlocked()
+    other = threading.Thread(target=lambda: list(wow._stream_local("local", "again", 100, 0.2, None)))
+    other.start()
+    other.join(timeout=5)
+    assert not other.is_alive()
+    del stream
+
+
+def test_unconfigured_local_stream_is_a_provider_error(monkeypatch):
+    monkeypatch.setattr(wow, "LOCAL_LLM_URL", "")
+    monkeypatch.setattr(wow, "LOCAL_MODEL_PATH", "")
+    with pytest.raises(RuntimeError, match="No local model configured"):
+        next(wow._stream_local("local", "hi", 100, 0.2, None))
+    events = list(wow._stream_provider("local", "hi", 100))
+    assert events == [{"error": "Streaming call failed: " + wow.LOCAL_NOT_CONFIGURED}]
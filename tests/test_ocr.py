@@ -0,0 +1,50 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import app as wow
+
+fitz = pytest.importorskip("fitz")
+
+
+@pytest.fixture
+def ocr(monkeypatch):
+    calls = []
+    pool = ThreadPoolExecutor(max_workers=2)
+    monkeypatch.setattr(wow, "OCR_CACHE", {})
+    monkeypatch.setattr(wow, "_ocr_pool", lambda: pool)
+    monkeypatch.setattr(wow, "_ocr_page_worker", lambda pdf, dpi, lang: calls.append(pdf) or "scanned text")
+    yield calls
+    pool.shutdown(wait=True)
+
+
+def scanned_doc():
+    doc = fitz.open()
+    doc.new_page().insert_text((72, 72), "This page has a perfectly good text layer already.")
+    doc.new_page()
+    return doc
+
+
+def test_only_pages_without_text_are_ocrd_and_cached(ocr):
+    doc = scanned_doc()
+    pages = wow.ocr_missing_pages(doc, [p.get_text() for p in doc])
+    assert pages[1] == "scanned text" and "text layer" in pages[0]
+    assert len(ocr) == 1 and len(wow.OCR_CACHE) == 1
+    wow.ocr_missing_pages(doc, [p.get_text() for p in doc])
+    assert len(ocr) == 1  # served from the page-hash cache
+
+
+def test_timed_out_page_is_empty_now_and_cached_later(ocr, monkeypatch):
+    gate = threading.Event()
+    monkeypatch.setattr(wow, "OCR_TIMEOUT", 0.2)
+    monkeypatch.setattr(wow, "_ocr_page_worker", lambda pdf, dpi, lang: gate.wait(5) and "late text")
+    doc = scanned_doc()
+    pages = wow.ocr_missing_pages(doc, [p.get_text() for p in doc])
+    assert pages[1] == "" and wow.OCR_CACHE == {}
+    gate.set()
+    for _ in range(100):
+        if wow.OCR_CACHE:
+            break
+        threading.Event().wait(0.01)
+    assert list(wow.OCR_CACHE.values()) == ["late text"]
@@ -0,0 +1,58 @@
+import json
+import time
+
+import pytest
+
+import app as wow
+
+ADMIN = {"X-Admin-Token": "admin-secret"}
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(wow, "ADMIN_TOKEN", "admin-secret")
+    monkeypatch.setattr(wow, "PROFILER", wow.LiveProfiler())
+    yield wow.app.test_client()
+    wow.PROFILER.stop()
+    wow.PROFILER.stop_memory()
+
+
+def test_profiling_endpoints_are_admin_only(client):
+    for method, path in [("get", "/admin/profile"), ("post", "/admin/profile/start"), ("post", "/admin/memory/snapshot")]:
+        assert getattr(client, method)(path).status_code == 403
+
+
+def test_sampling_profile_round_trip(client):
+    started = client.post("/admin/profile/start?mode=sampling&seconds=5&interval_ms=1&all_threads=1", headers=ADMIN)
+    assert started.get_json()["running"]["mode"] == "sampling"
+    assert client.post("/admin/profile/start?mode=sampling", headers=ADMIN).status_code == 409
+    deadline = time.time() + 2
+    while wow.PROFILER.session["samples"] < 5 and time.time() < deadline:
+        time.sleep(0.01)
+    summary = client.post("/admin/profile/stop", headers=ADMIN).get_json()
+    assert summary["samples"] >= 5
+    speedscope = json.loads(client.get("/admin/profile/download", headers=ADMIN).get_data())
+    assert speedscope["profiles"] and speedscope["shared"]["frames"]
+    assert client.get("/admin/profile/download?format=pstats", headers=ADMIN).status_code == 400
+    assert client.post("/admin/profile/stop", headers=ADMIN).status_code == 409
+
+
+def test_cprofile_covers_requests_started_in_the_window(client):
+    client.post("/admin/profile/start?mode=cprofile&seconds=5", headers=ADMIN)
+    client.get("/healthz")
+    client.get("/healthz")
+    summary = client.post("/admin/profile/stop", headers=ADMIN).get_json()
+    assert summary["requests"] == 2 and summary["functions"] > 0
+    report = client.get("/admin/profile/download?format=text", headers=ADMIN).get_data(as_text=True)
+    assert "healthz" in report
+
+
+def test_memory_snapshot_and_diff(client):
+    base = client.post("/admin/memory/snapshot?frames=3", headers=ADMIN).get_json()
+    assert base["tracing_started"] is True
+    hoard = [bytearray(1024) for _ in range(200)]
+    diff = client.post(f"/admin/memory/diff?base={base['id']}", headers=ADMIN).get_json()
+    assert diff["current_diff"] > 100_000 and diff["top"]
+    assert client.post("/admin/memory/diff?base=nope", headers=ADMIN).status_code == 404
+    del hoard
+    assert client.post("/admin/memory/stop", headers=ADMIN).get_json() == {"tracing": wow.MEMTRACE}
@@ -0,0 +1,91 @@
+import pytest
+
+import app as wow
+
+OUTAGE = {"error": "OpenAI error: Connection error."}
+
+
+@pytest.fixture
+def health(monkeypatch):
+    monkeypatch.setitem(wow.API_KEYS, "openai", "sk-server")
+    monkeypatch.setattr(wow, "FAILOVER_MODELS", {})
+    return wow.ProviderHealth()
+
+
+def test_consecutive_failures_open_the_circuit(health):
+    for _ in range(wow.BREAKER_FAILURES - 1):
+        health.record_result("openai", OUTAGE, 10)
+    assert health.snapshot("openai")["circuit"] == "closed"
+    health.record_result("openai", OUTAGE, 10)
+    assert health.snapshot("openai")["circuit"] == "open"
+    assert health.route("gpt-4o-mini") is None
+
+
+def test_half_open_trial_closes_or_reopens(health, monkeypatch):
+    for _ in range(wow.BREAKER_FAILURES):
+        health.record_result("openai", OUTAGE, 10)
+    monkeypatch.setattr(wow, "BREAKER_COOLDOWN", 0)
+    assert health.allow("openai") is True  # the single trial call
+    assert health.allow("openai") is False
+    health.record_result("openai", OUTAGE, 10)
+    assert health.snapshot("openai")["circuit"] == "open"
+    assert health.allow("openai") is True
+    health.record_result("openai", {"text": "ok"}, 10)
+    assert health.snapshot("openai")["circuit"] == "closed"
+
+
+@pytest.mark.parametrize("error", [
+    "OpenAI error: Error code: 401 - {'error': {'message': 'Incorrect API key provided'}}",
+    "OpenAI error: Error code: 404 - {'error': {'code': 'model_not_found'}}",
+    "Gemini error: 400 INVALID_ARGUMENT. API key not valid.",
+    "OpenAI API key not set.",
+    "Monthly budget for gpt-4o-mini exhausted.",
+])
+def test_caller_errors_never_trip(health, error):
+    for _ in range(wow.BREAKER_FAILURES * 3):
+        health.record_result("openai", {"error": error}, 10)
+    assert health.snapshot("openai")["circuit"] == "closed"
+
+
+def test_circuits_are_per_credential(health):
+    for _ in range(wow.BREAKER_FAILURES):
+        health.record_result("openai", OUTAGE, 10)
+    with wow.TENANT_KEYS_LOCK:
+        wow.TENANT_KEYS["tenant-own-key"] = {"openai": "sk-tenant"}
+    try:
+        with wow.use_tenant("tenant-own-key"):
+            assert health.allow("openai") is True
+            assert health.snapshot("openai")["circuit"] == "closed"
+        assert health.allow("openai") is False
+    finally:
+        with wow.TENANT_KEYS_LOCK:
+            wow.TENANT_KEYS.pop("tenant-own-key", None)
+
+
+def test_open_error_does_not_echo_provider_errors(health):
+    secret = "OpenAI error: upstream said something about another tenant's request"
+    for _ in range(wow.BREAKER_FAILURES):
+        health.record_result("openai", {"error": secret}, 10)
+    res = health.open_error("gpt-4o-mini")
+    assert res["circuit_open"] and "another tenant" not in res["error"]
+    assert not isinstance(health.snapshot("openai")["last_error"], str)
+
+
+def test_failover_routes_while_open(health, monkeypatch):
+    monkeypatch.setattr(wow, "FAILOVER_MODELS", {"openai": "gemini-2.5-flash"})
+    for _ in range(wow.BREAKER_FAILURES):
+        health.record_result("openai", OUTAGE, 10)
+    assert health.route("gpt-4o-mini") == "gemini-2.5-flash"
+
+
+def test_monitor_starts_with_the_first_request_not_the_health_get(health, monkeypatch):
+    started = []
+    monkeypatch.setattr(health, "start", lambda *a: started.append(a))
+    monkeypatch.setattr(wow, "HEALTH", health)
+    client = wow.app.test_client()
+    monkeypatch.setattr(wow, "HEALTH_MONITOR", False)
+    assert client.get("/health/providers").status_code == 200
+    assert started == []
+    monkeypatch.setattr(wow, "HEALTH_MONITOR", True)
+    client.get("/healthz")
+    assert len(started) == 1
@@ -0,0 +1,103 @@
+import app as wow
+
+
+def page(n, extra=""):
+    return f"## Section {n} [p. {n}]\n\nBody of page {n} about sterilization and labeling.{extra}"
+
+
+def test_split_sections_on_headings_and_size():
+    text = "Intro line\n\n# A\n\none\n\n## B\n\n" + "\n\n".join(["x" * 4000] * 3)
+    sections = wow.split_sections(text)
+    assert [s["title"] for s in sections[:3]] == ["Intro line", "A", "B (part 1)"]
+    assert all(len(s["text"]) <= wow.SECTION_MAX_CHARS for s in sections)
+
+
+def test_source_sections_pack_pages_with_stable_boundaries(monkeypatch):
+    monkeypatch.setattr(wow, "REVIEW_SECTION_PAGES", 4)
+    pages = [page(n) for n in range(1, 11)]
+    sections = wow.source_sections(pages)
+    assert [s["pages"] for s in sections] == [[1, 2, 3, 4], [5, 6, 7, 8], [9, 10]]
+    assert sections[1]["title"] == "Pages 5-8"
+    start, end = sections[1]["offsets"][2]
+    assert sections[1]["text"][start:end] == page(7)
+
+    pages[5] = page(6, " Edited.")
+    edited = wow.source_sections(pages)
+    digest = lambda s: wow.text_digest(s["title"], s["text"])  # noqa: E731
+    assert [digest(s) for s in edited] != [digest(s) for s in sections]
+    assert digest(edited[0]) == digest(sections[0]) and digest(edited[2]) == digest(sections[2])
+
+
+def test_source_sections_respect_char_budget(monkeypatch):
+    monkeypatch.setattr(wow, "REVIEW_SECTION_CHARS", 200)
+    pages = [page(1), page(2), page(3), "x " * 400]
+    sections = wow.source_sections(pages)
+    assert all(len(s["text"]) <= 200 or s["pages"] == [4] for s in sections)
+    assert [s["pages"] for s in sections][:2] == [[1, 2], [3]]
+    assert all(s["title"].startswith("Page 4 (part") for s in sections[2:])
+
+
+def test_diff_pages_reports_changes_per_tenant():
+    first = wow.diff_pages("doc-diff", [page(1), page(2)])
+    assert first["changed_pages"] == [1, 2] and first["previous_pages"] == 0
+    second = wow.diff_pages("doc-diff", [page(1), page(2, " New."), page(3)])
+    assert second["changed_pages"] == [2, 3] and second["previous_pages"] == 2
+    with wow.use_tenant("someone-else"):
+        assert wow.diff_pages("doc-diff", [page(1)])["previous_pages"] == 0
+
+
+def test_revision_store_is_bounded():
+    store = wow.RevisionStore(ttl=3600, max_items=2)
+    with store.lock:
+        store.entry("a")["pages"] = ["1"]
+        store.entry("b")
+        store.entry("a")  # touch: "b" is now least recently used
+        store.entry("c")
+        assert {doc for _, doc in store.items} == {"a", "c"}
+        store.items[(wow.CURRENT_TENANT.get(), "a")]["touched"] -= 7200
+        store.entry("c")
+        assert {doc for _, doc in store.items} == {"c"}
+
+
+def test_review_reuses_unchanged_sections(monkeypatch):
+    calls = []
+
+    def fake_llm(model, prompt, max_tokens=0, **kwargs):
+        calls.append(prompt)
+        return {"text": f"finding {len(calls)}"}
+
+    monkeypatch.setattr(wow, "call_llm_adaptive", fake_llm)
+    monkeypatch.setattr(wow, "REVIEW_SECTION_PAGES", 4)
+    pages = [page(n) for n in range(1, 13)]
+    wow.diff_pages("doc-review", pages, wow.source_sections(pages))
+    res = wow.review_incrementally("doc-review", "", "checklist", "gpt-4o-mini", "Review.", 1000)
+    assert res["revision"] == {"sections": 3, "changed": 3, "reused": 0}
+    assert len(calls) == 3  # one call per pack, not per page
+
+    pages[5] = page(6, " Edited.")
+    wow.diff_pages("doc-review", pages, wow.source_sections(pages))
+    # The submission text (a regenerated transform) does not matter: sections come from the source
+    res = wow.review_incrementally("doc-review", "regenerated", "checklist", "gpt-4o-mini", "Review.", 1000)
+    assert res["revision"] == {"sections": 3, "changed": 1, "reused": 2}
+    # Only the edited page is sent, together with the pack's prior findings
+    assert "Edited." in calls[-1] and "PRIOR FINDINGS" in calls[-1]
+    assert page(5) not in calls[-1] and page(7) not in calls[-1]
+
+
+def test_review_keeps_successful_sections_when_one_fails(monkeypatch):
+    calls = []
+
+    def flaky_llm(model, prompt, max_tokens=0, **kwargs):
+        calls.append(prompt)
+        if "Page 2" in prompt and len(calls) <= 2:
+            return {"error": "provider down"}
+        return {"text": "ok"}
+
+    monkeypatch.setattr(wow, "call_llm_adaptive", flaky_llm)
+    monkeypatch.setattr(wow, "REVIEW_SECTION_PAGES", 1)
+    pages = [page(1), page(2)]
+    wow.diff_pages("doc-flaky", pages, wow.source_sections(pages))
+    assert wow.review_incrementally("doc-flaky", "", "c", "gpt-4o-mini", "Review.", 100) == {"error": "provider down"}
+    res = wow.review_incrementally("doc-flaky", "", "c", "gpt-4o-mini", "Review.", 100)
+    assert res["revision"] == {"sections": 2, "changed": 1, "reused": 1}
+    assert len(calls) == 3
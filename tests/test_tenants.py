@@ -0,0 +1,72 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+import app as wow
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_token_round_trip_and_tampering():
+    token = wow.tenant_token("t-alice")
+    assert wow.tenant_id_for({"tenant_token": token}) == "t-alice"
+    assert wow.tenant_id_for(headers={"X-Tenant-Token": token}) == "t-alice"
+    assert wow.tenant_id_for(cookies={wow.TENANT_COOKIE: token}) == "t-alice"
+    assert wow.tenant_id_for({"tenant_token": token[:-2] + "xx"}) is None
+    assert wow.tenant_id_for({"tenant_token": "t-alice"}) is None  # client-chosen ids are not trusted
+    assert wow.tenant_id_for({}) is None
+
+
+def run_python(code, **env):
+    env = dict(os.environ, **env)
+    env.pop("WOW_SECRET_KEY", None)
+    return subprocess.run([sys.executable, "-c", code], cwd=ROOT, env=env, capture_output=True, text=True, check=True)
+
+
+def test_secret_key_is_resolved_lazily_in_the_data_dir(tmp_path):
+    data = tmp_path / "data"
+    env = dict(WOW_DATA_DIR=str(data), WOW_SECRET_KEY_FILE="", WOW_HEALTH_INTERVAL="0")
+    run_python("import app", **env)
+    assert not (data / ".secret_key").exists()
+    first = run_python("import app; print(app.tenant_token('t-x'))", **env).stdout
+    key = data / ".secret_key"
+    assert key.exists() and (key.stat().st_mode & 0o777) == 0o600
+    # The same key is reused, so issued identities survive a restart
+    assert run_python("import app; print(app.tenant_token('t-x'))", **env).stdout == first
+
+
+def test_secret_key_from_env(monkeypatch):
+    monkeypatch.setenv("WOW_SECRET_KEY", "k" * 40)
+    assert wow.load_secret_key() == b"k" * 40
+
+
+@pytest.fixture
+def clients():
+    alice, bob = wow.app.test_client(), wow.app.test_client()
+    alice.get("/healthz")
+    bob.get("/healthz")
+    assert alice.get_cookie(wow.TENANT_COOKIE).value != bob.get_cookie(wow.TENANT_COOKIE).value
+    return alice, bob
+
+
+def test_sessions_are_private_to_their_tenant(clients):
+    alice, bob = clients
+    sid = alice.post("/session").get_json()["session_id"]
+    alice.post(f"/session/{sid}/update", json={"fields": {"submission": "alice's device"}})
+    assert alice.get(f"/session/{sid}?field=submission").get_json()["value"] == "alice's device"
+    assert bob.get(f"/session/{sid}").status_code == 404
+    assert bob.post(f"/session/{sid}/update", json={"fields": {"submission": "x"}}).status_code == 404
+
+
+def test_archive_is_private_to_its_tenant(clients, monkeypatch):
+    monkeypatch.setattr(wow, "ARCHIVE_ENABLED", True)
+    alice, bob = clients
+    with wow.use_tenant(wow.tenant_id_for(cookies={wow.TENANT_COOKIE: alice.get_cookie(wow.TENANT_COOKIE).value})):
+        wow.archive_result("review", "Findings for the zebrafish catheter submission.")
+    hits = alice.get("/search?q=zebrafish").get_json()["results"]
+    assert len(hits) == 1
+    assert bob.get("/search?q=zebrafish").get_json()["results"] == []
+    assert alice.get(f"/archive/{hits[0]['id']}").status_code == 200
+    assert bob.get(f"/archive/{hits[0]['id']}").status_code == 404
@@ -0,0 +1,64 @@
+import pytest
+
+import app as wow
+
+ADMIN = {"X-Admin-Token": "admin-secret"}
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(wow, "TRACE_ENABLED", True)
+    monkeypatch.setattr(wow, "ADMIN_TOKEN", "admin-secret")
+    monkeypatch.setattr(wow, "export_trace", lambda trace: None)
+    monkeypatch.setattr(wow, "RECENT_TRACES", None)
+    return wow.app.test_client()
+
+
+def last_trace():
+    return list(wow._recent_traces())[-1]
+
+
+def test_nested_spans_form_one_trace(client):
+    with wow.span("root", parent=False):
+        with wow.span("child", step=1) as child:
+            child["attrs"]["extra"] = True
+        with pytest.raises(ValueError), wow.span("failing"):
+            raise ValueError("boom")
+    trace = last_trace()
+    root, child, failing = trace["spans"]
+    assert trace["name"] == "root" and trace["status"] == "ok"
+    assert child["parent_id"] == failing["parent_id"] == root["span_id"]
+    assert {sp["trace_id"] for sp in trace["spans"]} == {trace["trace_id"]}
+    assert child["attrs"] == {"step": 1, "extra": True}
+    assert failing["status"] == "error" and "boom" in failing["attrs"]["error"]
+
+
+def test_traced_decorator_records_attrs(client):
+    @wow.traced("work", lambda n: {"n": n})
+    def work(n):
+        return n * 2
+
+    with wow.span("root", parent=False):
+        assert work(21) == 42
+    assert [(sp["name"], sp["attrs"]) for sp in last_trace()["spans"]][1] == ("work", {"n": 21})
+
+
+def test_span_after_its_trace_closed_starts_a_new_trace(client):
+    with wow.span("request", parent=False) as req:
+        pass
+    late = wow.start_span("prefetch", parent=req)
+    assert late["trace_id"] != req["trace_id"] and late["attrs"]["follows_trace"] == req["trace_id"]
+    wow.end_span(late)
+
+
+def test_request_traces_use_the_url_rule_and_are_admin_only(client):
+    client.get("/session/abcd1234")
+    assert client.get("/traces").status_code == 403
+    traces = client.get("/traces", headers=ADMIN).get_json()["traces"]
+    assert traces[0]["name"] == "GET /session/<sid>"
+    trace = client.get(f"/traces/{traces[0]['trace_id']}", headers=ADMIN).get_json()
+    assert trace["spans"][0]["attrs"]["endpoint"] == "get_session"
+    otlp = client.get(f"/traces/{traces[0]['trace_id']}?format=otlp", headers=ADMIN).get_json()
+    spans = otlp["resourceSpans"][0]["scopeSpans"][0]["spans"]
+    assert spans[0]["name"] == "GET /session/<sid>" and "parentSpanId" not in spans[0]
+    assert client.get("/traces/unknown", headers=ADMIN).status_code == 404